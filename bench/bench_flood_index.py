@@ -0,0 +1,96 @@
+"""
+Бенчмарк индекса почти-повторов: скорость приёма сообщений (SimHash + FloodIndex.add)
+и качество на синтетическом потоке, где обычные пользователи болтают,
+а флудеры повторяют одно сообщение с мелкими правками (цифры, смайлы, регистр).
+
+Запуск:
+  python bench/bench_flood_index.py
+  python bench/bench_flood_index.py --messages 200000 --flooders 50 --copypaste 0.05
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("BOT_TOKEN_REPORT", "123456:bench")
+os.environ.setdefault("ALLOWED_CHAT_ID", "-1")
+os.environ.setdefault("ADMIN_CHAT_ID", "-2")
+
+from bot_report import FLOOD_AUTO_MUTE_COUNT, FloodIndex, simhash  # noqa: E402
+
+CHAT_ID = -1001
+WORDS = ["привет", "кто", "играет", "сегодня", "вечером", "го", "катку", "норм", "ахах", "ок", "да", "нет",
+         "скинь", "ссылку", "на", "сервер", "опять", "лагает", "обнова", "вышла", "кстати", "видел", "стрим"]
+SPAM = ["КУПИ ПОДПИСКУ СО СКИДКОЙ ТОЛЬКО СЕГОДНЯ", "заходите на мой канал там раздача", "ааааааааа админ ответь",
+        "продам аккаунт недорого пишите в лс", "кто хочет бесплатные скины переходите"]
+
+
+def mutate(text, rng):
+    """Мелкая правка: число, смайл, регистр или лишний символ"""
+    choice = rng.randrange(4)
+    if choice == 0:
+        return f"{text} {rng.randint(1, 999)}"
+    if choice == 1:
+        return f"{text} {rng.choice(['!!!', ')))', '🔥', '😂'])}"
+    if choice == 2:
+        return text.upper() if rng.random() < 0.5 else text.lower()
+    position = rng.randrange(len(text))
+    return text[:position] + rng.choice("аеоы.") + text[position:]
+
+
+def make_stream(count, users, flooders, flood_share, copypaste, rng):
+    """(user_id, текст, флуд ли) в порядке прихода; время - 20 сообщений в секунду"""
+    stream = []
+    for _ in range(count):
+        if rng.random() < flood_share:
+            flooder = rng.randrange(flooders)
+            stream.append((1_000_000 + flooder, mutate(SPAM[flooder % len(SPAM)], rng), True))
+        elif rng.random() < copypaste:
+            stream.append((rng.randrange(users), " ".join(rng.choice(WORDS) for _ in range(rng.randint(300, 600))), False))
+        else:
+            stream.append((rng.randrange(users), " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 10))), False))
+    return stream
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=100_000)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--flooders", type=int, default=20)
+    parser.add_argument("--flood-share", type=float, default=0.05, help="доля флуда в потоке")
+    parser.add_argument("--copypaste", type=float, default=0.01, help="доля длинных сообщений")
+    parser.add_argument("--window", type=float, default=120)
+    parser.add_argument("--distance", type=int, default=8)
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    stream = make_stream(args.messages, args.users, args.flooders, args.flood_share, args.copypaste, rng)
+
+    started = time.perf_counter()
+    for _, text, _ in stream:
+        simhash(text)
+    hash_seconds = time.perf_counter() - started
+
+    index = FloodIndex(args.window, args.distance)
+    detected = set()
+    false_alarms = set()
+    started = time.perf_counter()
+    for i, (user_id, text, is_flood) in enumerate(stream):
+        user_series, _ = index.add(CHAT_ID, user_id, text, now=i / 20)
+        if user_series.count >= FLOOD_AUTO_MUTE_COUNT:
+            (detected if is_flood else false_alarms).add(user_id)
+    index_seconds = time.perf_counter() - started
+
+    print(f"сообщений: {args.messages}, пользователей: {args.users}, флудеров: {args.flooders}")
+    print(f"SimHash:          {args.messages / hash_seconds:>10.0f} сообщений/с ({hash_seconds / args.messages * 1e6:.1f} мкс)")
+    print(f"FloodIndex.add:   {args.messages / index_seconds:>10.0f} сообщений/с ({index_seconds / args.messages * 1e6:.1f} мкс)")
+    print(f"флудеров найдено: {len(detected)}/{args.flooders} (порог {FLOOD_AUTO_MUTE_COUNT} повторов)")
+    print(f"ложных срабатываний: {len(false_alarms)}/{args.users} обычных пользователей")
+    stats = index.stats()
+    print(f"серий: авторов {stats['users']}, чатов {stats['chats']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Бенчмарк: новый httpx.AsyncClient на каждый запрос против общего клиента с пулом.
+
+Запуск: python bench/bench_http_client.py [кол-во запросов]
+"""
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("BOT_TOKEN_REPORT", "123456:bench")
+os.environ.setdefault("ALLOWED_CHAT_ID", "-1")
+os.environ.setdefault("ADMIN_CHAT_ID", "-2")
+
+import httpx  # noqa: E402
+
+import bot_report  # noqa: E402
+from fake_openrouter import FakeOpenRouter  # noqa: E402
+
+PAYLOAD = {"model": "openrouter/auto", "messages": [{"role": "user", "content": "bench"}]}
+
+
+def report(name, samples):
+    samples = sorted(samples)
+    p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+    print(f"{name:<28} mean={statistics.mean(samples) * 1000:7.2f} ms  "
+          f"p50={statistics.median(samples) * 1000:7.2f} ms  p99={p99 * 1000:7.2f} ms")
+
+
+async def per_call_client(url, n):
+    samples = []
+    for _ in range(n):
+        start = time.perf_counter()
+        async with httpx.AsyncClient(timeout=30) as client:
+            await client.post(url, json=PAYLOAD)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+async def shared_client(url, n):
+    samples = []
+    client = bot_report.get_http_client()
+    for _ in range(n):
+        start = time.perf_counter()
+        await client.post(url, json=PAYLOAD)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+async def check_with_ai_calls(n):
+    samples = []
+    for _ in range(n):
+        start = time.perf_counter()
+        await bot_report.check_with_ai("bench")
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+async def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    server = await FakeOpenRouter().start()
+    # Бэкенды собираются из env при импорте, поэтому подменяем сам список
+    bot_report.llm_backends[:] = [bot_report.LLMBackend(bot_report.OPENROUTER_MODEL, server.url)]
+    try:
+        report("до: AsyncClient на вызов", await per_call_client(server.url, n))
+        report("после: общий клиент", await shared_client(server.url, n))
+        report("после: check_with_ai", await check_with_ai_calls(n))
+    finally:
+        await bot_report.close_http_client()
+        await server.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,52 @@
+"""
+Микробенчмарк: стоимость сбора контекста (15 сообщений до заданного id)
+в зависимости от размера окна истории. Сравнивает старый линейный проход
+по deque с bisect-поиском по ChatHistory.
+
+Запуск: python bench/bench_message_history.py
+"""
+import os
+import random
+import sys
+import timeit
+from collections import deque
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("BOT_TOKEN_REPORT", "123456:bench")
+os.environ.setdefault("ALLOWED_CHAT_ID", "-1")
+os.environ.setdefault("ADMIN_CHAT_ID", "-2")
+
+from bot_report import ChatHistory, MessageRecord  # noqa: E402
+
+LOOKUPS = 2000
+
+
+def linear_scan(cache, message_id):
+    context_messages = []
+    for msg_data in cache:
+        if msg_data.message_id < message_id:
+            context_messages.append(msg_data)
+    return context_messages[-15:]
+
+
+def main():
+    print(f"{'окно':>8} {'линейно, мкс':>14} {'bisect, мкс':>12}")
+    for size in (150, 1_000, 10_000, 100_000):
+        # Бюджет в байтах ровно на size одинаковых записей
+        history = ChatHistory(size * MessageRecord(1, 1, 'user', 'text').nbytes())
+        cache = deque(maxlen=size)
+        for message_id in range(1, size * 2):
+            record = MessageRecord(message_id, 1, 'user', 'text')
+            history.append(record)
+            cache.append(record)
+
+        targets = [random.randint(size, size * 2) for _ in range(LOOKUPS)]
+        it = iter(targets * 2)
+        linear = timeit.timeit(lambda: linear_scan(cache, next(it)), number=LOOKUPS) / LOOKUPS
+        it = iter(targets * 2)
+        indexed = timeit.timeit(lambda: history.before(next(it), 15), number=LOOKUPS) / LOOKUPS
+        print(f"{size:>8} {linear * 1e6:>14.1f} {indexed * 1e6:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Бенчмарк памяти истории сообщений: сколько сообщений помещается в заданный
+бюджет RAM при старом представлении (dict + datetime, отдельная строка имени
+на каждое сообщение) и при MessageRecord (__slots__, интернированные имена,
+время - int), с обрезкой длинных текстов и без неё.
+
+Реальный расход меряется через tracemalloc, рядом - оценка, по которой
+ChatHistory вытесняет старые сообщения.
+
+Запуск:
+  python bench/bench_message_memory.py
+  python bench/bench_message_memory.py --budget-mb 4 --users 500 --copypaste 0.05
+"""
+import argparse
+import os
+import random
+import sys
+import tracemalloc
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("BOT_TOKEN_REPORT", "123456:bench")
+os.environ.setdefault("ALLOWED_CHAT_ID", "-1")
+os.environ.setdefault("ADMIN_CHAT_ID", "-2")
+
+from bot_report import ChatHistory, MessageRecord  # noqa: E402
+
+WORDS = ["привет", "да", "нет", "лол", "кто", "играет", "сегодня", "вечером", "го", "катку", "норм", "ахах", "ок"]
+
+
+def make_messages(count, users, copypaste):
+    """Текст в основном короткий, доля copypaste - длинная копипаста на 2-4 КБ"""
+    rng = random.Random(1)
+    names = [f"user_{i}" for i in range(users)]
+    messages = []
+    for message_id in range(1, count + 1):
+        user = rng.randrange(users)
+        if rng.random() < copypaste:
+            text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(300, 600)))
+        else:
+            text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 12)))
+        # Байты декодируются при замере: как и при разборе апдейта, каждая строка - новый объект
+        messages.append((message_id, 100_000_000 + user, names[user].encode(), text.encode()))
+    return messages
+
+
+def old_record(message_id, user_id, username, text, max_chars):
+    return {'message_id': message_id, 'user_id': user_id, 'username': username,
+            'text': text, 'timestamp': datetime.now()}
+
+
+def new_record(message_id, user_id, username, text, max_chars):
+    return MessageRecord(message_id, user_id, username, text[:max_chars] if max_chars else text)
+
+
+def measure(factory, messages, max_chars):
+    """Байт на сообщение по tracemalloc"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    records = [factory(mid, uid, name.decode(), text.decode(), max_chars) for mid, uid, name, text in messages]
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return used / len(records), records
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--budget-mb", type=float, default=8, help="бюджет RAM на историю одного чата")
+    parser.add_argument("--messages", type=int, default=50_000, help="сколько сообщений сгенерировать для замера")
+    parser.add_argument("--users", type=int, default=300)
+    parser.add_argument("--copypaste", type=float, default=0.02, help="доля длинных сообщений")
+    args = parser.parse_args()
+
+    budget = int(args.budget_mb * 2**20)
+    messages = make_messages(args.messages, args.users, args.copypaste)
+    print(f"Бюджет {args.budget_mb} МБ, {args.users} пользователей, копипаста {args.copypaste:.0%}\n")
+    print(f"{'представление':<34} {'байт/сообщ':>11} {'влезает':>9} {'оценка':>9}")
+
+    variants = [
+        ("dict + datetime", old_record, 0),
+        ("MessageRecord", new_record, 0),
+        ("MessageRecord, текст до 1000", new_record, 1000),
+        ("MessageRecord, текст до 300", new_record, 300),
+    ]
+    for title, factory, max_chars in variants:
+        per_message, records = measure(factory, messages, max_chars)
+        fits = int(budget / per_message)
+        if factory is new_record:
+            # Сколько сообщений оставит ChatHistory с таким бюджетом по своей оценке
+            history = ChatHistory(budget)
+            for record in records:
+                history.append(record)
+            estimate = len(history) if len(history) < len(records) else f">{len(records)}"
+        else:
+            estimate = "-"
+        print(f"{title:<34} {per_message:>11.0f} {fits:>9} {estimate!s:>9}")
+        del records
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Нагрузочный тест webhook-режима: воспроизводит записанные апдейты
+(JSON Lines, по одному Update на строку) против локального /webhook
+и считает апдейты/сек и p99 задержки обработки.
+
+Без файла генерирует обычные сообщения в нескольких чатах.
+
+Запуск: python bench/bench_webhook.py [updates.jsonl] [--concurrency 64]
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("BOT_TOKEN_REPORT", "123456:bench")
+os.environ.setdefault("ALLOWED_CHAT_ID", "-1001")
+os.environ.setdefault("ADMIN_CHAT_ID", "-2")
+
+import aiohttp  # noqa: E402
+from aiohttp import web  # noqa: E402
+
+import bot_report  # noqa: E402
+
+
+def synthetic_updates(count, chats=4):
+    now = int(time.time())
+    for i in range(1, count + 1):
+        chat_id = bot_report.ALLOWED_CHAT_ID if i % chats == 0 else -1000 - i % chats
+        yield {
+            "update_id": i,
+            "message": {
+                "message_id": i,
+                "date": now,
+                "chat": {"id": chat_id, "type": "supergroup", "title": "bench"},
+                "from": {"id": 1000 + i % 50, "is_bot": False, "first_name": f"user{i % 50}"},
+                "text": f"сообщение номер {i}"
+            }
+        }
+
+
+def recorded_updates(path):
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("updates", nargs="?")
+    parser.add_argument("--count", type=int, default=20000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    args = parser.parse_args()
+
+    updates = list(recorded_updates(args.updates) if args.updates else synthetic_updates(args.count))
+
+    workers = bot_report.webhook_workers
+    workers.start()
+    runner = web.AppRunner(bot_report.create_webhook_app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    url = f"http://127.0.0.1:{port}{bot_report.WEBHOOK_PATH}"
+    headers = {"X-Telegram-Bot-Api-Secret-Token": bot_report.WEBHOOK_SECRET}
+
+    pending = iter(updates)
+    rejected = 0
+
+    async def sender(session):
+        nonlocal rejected
+        for update in pending:
+            async with session.post(url, json=update, headers=headers) as response:
+                if response.status != 200:
+                    rejected += 1
+
+    started = time.perf_counter()
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*(sender(session) for _ in range(args.concurrency)))
+    await workers.stop()
+    elapsed = time.perf_counter() - started
+    await runner.cleanup()
+
+    latencies = list(workers.latencies)
+    print(f"апдейтов: {workers.processed}, отклонено: {rejected}, время: {elapsed:.2f}с")
+    print(f"пропускная способность: {workers.processed / elapsed:.0f} апдейтов/сек")
+    print(f"задержка обработки: p50={percentile(latencies, 0.5) * 1000:.2f} мс  "
+          f"p99={percentile(latencies, 0.99) * 1000:.2f} мс")
+    await bot_report.bot.session.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
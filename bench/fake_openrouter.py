@@ -0,0 +1,125 @@
+"""
+Локальная заглушка OpenRouter /api/v1/chat/completions для бенчмарков.
+
+Задержка задаётся числом, callable или строкой распределения (см. parse_latency),
+набор вердиктов - строкой вида "OK=0.7,MUTE=0.2,WARN=0.1". Поддерживает
+потоковый режим (stream: true) и пакетные запросы с JSON-массивом в ответе.
+"""
+import asyncio
+import json
+import random
+import re
+
+from aiohttp import web
+
+DEFAULT_DURATIONS = {"MUTE": 35, "BAN": None, "WARN": None, "OK": None}
+_CASE_RE = re.compile(r"^\[(\d+)\]$", re.MULTILINE)
+
+
+def parse_latency(spec):
+    """
+    "0.2" или "fixed:0.2"       - постоянная задержка
+    "uniform:0.1,0.5"          - равномерно от 0.1 до 0.5 с
+    "exp:0.3"                  - экспоненциально со средним 0.3 с
+    "lognormal:-1.5,0.6"       - логнормально (mu, sigma)
+    "slow:0.2,5,0.1"           - 0.2 с, но с вероятностью 0.1 - 5 с (медленная модель)
+    """
+    if callable(spec) or isinstance(spec, (int, float)):
+        return spec
+    kind, _, args = spec.partition(":")
+    if not args:
+        return float(kind)
+    values = [float(value) for value in args.split(",")]
+    if kind == "fixed":
+        return values[0]
+    if kind == "uniform":
+        return lambda: random.uniform(values[0], values[1])
+    if kind == "exp":
+        return lambda: random.expovariate(1 / values[0])
+    if kind == "lognormal":
+        return lambda: random.lognormvariate(values[0], values[1])
+    if kind == "slow":
+        return lambda: values[1] if random.random() < values[2] else values[0]
+    raise ValueError(f"Неизвестное распределение задержки: {spec}")
+
+
+def parse_verdict_mix(spec):
+    mix = []
+    for item in spec.split(","):
+        action, _, weight = item.partition("=")
+        action = action.strip().upper()
+        mix.append(({"action": action, "duration": DEFAULT_DURATIONS.get(action), "reason": "fake"},
+                    float(weight or 1)))
+    return mix
+
+
+class FakeOpenRouter:
+    def __init__(self, latency=0.0, verdicts=None, host="127.0.0.1", port=0):
+        self.latency = parse_latency(latency)
+        if isinstance(verdicts, str):
+            verdicts = parse_verdict_mix(verdicts)
+        self.verdicts = verdicts or [({"action": "OK", "duration": None, "reason": "fake"}, 1.0)]
+        self.host = host
+        self.port = port
+        self.requests = 0
+        self.verdicts_served = 0
+        self._runner = None
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}/api/v1/chat/completions"
+
+    def _pick_verdict(self):
+        verdicts, weights = zip(*self.verdicts)
+        return dict(random.choices(verdicts, weights=weights)[0])
+
+    def _content(self, body):
+        user_text = body["messages"][-1]["content"]
+        cases = _CASE_RE.findall(user_text)
+        if cases:
+            # Пакетный запрос: по вердикту на каждый [номер]
+            self.verdicts_served += len(cases)
+            return json.dumps([{"id": int(case), **self._pick_verdict()} for case in cases], ensure_ascii=False)
+        self.verdicts_served += 1
+        return json.dumps(self._pick_verdict(), ensure_ascii=False)
+
+    async def _handle(self, request):
+        self.requests += 1
+        body = await request.json()
+        delay = self.latency() if callable(self.latency) else self.latency
+        if delay:
+            await asyncio.sleep(delay)
+        content = self._content(body)
+        usage = {"prompt_tokens": len(json.dumps(body["messages"], ensure_ascii=False)) // 3,
+                 "completion_tokens": len(content) // 3}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+
+        if not body.get("stream"):
+            return web.json_response({"choices": [{"message": {"content": content}}], "usage": usage})
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        await response.write(b": OPENROUTER PROCESSING\n\n")
+        # Отдаём вердикт кусками и добавляем "болтовню" после JSON, как делают модели
+        for chunk in [content[i:i + 8] for i in range(0, len(content), 8)] + ["\n\nНадеюсь, это помогло!"] * 5:
+            event = {"choices": [{"delta": {"content": chunk}}]}
+            await response.write(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8"))
+            await asyncio.sleep(0.005)
+        await response.write(f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n".encode("utf-8"))
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/api/v1/chat/completions", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
@@ -0,0 +1,143 @@
+"""
+Локальная заглушка Telegram Bot API для нагрузочных тестов.
+
+Отдаёт апдейты через getUpdates (long polling) и записывает вызовы
+restrictChatMember, sendMessage, deleteMessage и остальных методов,
+которыми пользуется бот. Бот подключается через TELEGRAM_API_URL.
+"""
+import asyncio
+import json
+import time
+
+from aiohttp import web
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "ReportBot", "username": "report_bot"}
+
+
+class FakeTelegram:
+    def __init__(self, admin_ids=(), latency=0.0, host="127.0.0.1", port=0):
+        self.admin_ids = set(admin_ids)
+        self.latency = latency
+        self.host = host
+        self.port = port
+        self.calls = []  # (время, метод, параметры)
+        self.listeners = []  # callback(время, метод, параметры)
+        self._updates = []
+        self._next_update_id = 1
+        self._next_message_id = 1_000_000
+        self._has_updates = asyncio.Event()
+        self._runner = None
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}"
+
+    # ---------- апдейты ----------
+
+    def push_update(self, update: dict) -> int:
+        update_id = self._next_update_id
+        self._next_update_id += 1
+        self._updates.append({"update_id": update_id, **update})
+        self._has_updates.set()
+        return update_id
+
+    def push_message(self, chat_id, message_id, user_id, text, reply_to=None, first_name=None):
+        message = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup", "title": "loadtest"},
+            "from": {"id": user_id, "is_bot": False, "first_name": first_name or f"user{user_id}"},
+            "text": text
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        if reply_to is not None:
+            message["reply_to_message"] = reply_to
+        return self.push_update({"message": message})
+
+    @property
+    def pending_updates(self) -> int:
+        return len(self._updates)
+
+    # ---------- вызовы ----------
+
+    def calls_of(self, method: str) -> list:
+        return [params for _, name, params in self.calls if name == method]
+
+    def _message(self, chat_id, text):
+        self._next_message_id += 1
+        return {
+            "message_id": self._next_message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "supergroup", "title": "loadtest"},
+            "from": BOT_USER,
+            "text": text or ""
+        }
+
+    async def _get_updates(self, params):
+        offset = int(params.get("offset", 0) or 0)
+        limit = int(params.get("limit", 100) or 100)
+        timeout = float(params.get("timeout", 0) or 0)
+        self._updates = [update for update in self._updates if update["update_id"] >= offset]
+        if not self._updates and timeout:
+            self._has_updates.clear()
+            try:
+                await asyncio.wait_for(self._has_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self._updates[:limit]
+
+    def _result(self, method, params):
+        if method == "getMe":
+            return BOT_USER
+        if method in ("sendMessage", "editMessageText"):
+            return self._message(params.get("chat_id", 0), params.get("text"))
+        if method == "getChatAdministrators":
+            return [{"status": "creator", "is_anonymous": False,
+                     "user": {"id": admin_id, "is_bot": False, "first_name": f"admin{admin_id}"}}
+                    for admin_id in self.admin_ids]
+        if method == "getChatMember":
+            user_id = int(params.get("user_id", 0))
+            status = "creator" if user_id in self.admin_ids else "member"
+            member = {"status": status, "user": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}}
+            if status == "creator":
+                member["is_anonymous"] = False
+            return member
+        return True
+
+    async def _handle(self, request):
+        method = request.match_info["method"]
+        params = dict(await request.post()) if request.body_exists else {}
+        for key, value in params.items():
+            if isinstance(value, str) and value[:1] in "{[":
+                try:
+                    params[key] = json.loads(value)
+                except ValueError:
+                    pass
+
+        if method == "getUpdates":
+            return web.json_response({"ok": True, "result": await self._get_updates(params)})
+
+        if self.latency:
+            await asyncio.sleep(self.latency() if callable(self.latency) else self.latency)
+        now = time.perf_counter()
+        self.calls.append((now, method, params))
+        for listener in self.listeners:
+            listener(now, method, params)
+        return web.json_response({"ok": True, "result": self._result(method, params)})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        self._has_updates.set()
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
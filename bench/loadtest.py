@@ -0,0 +1,223 @@
+"""
+Сквозной нагрузочный тест бота без внешних сервисов.
+
+Поднимает заглушки Telegram Bot API и OpenRouter, запускает bot_report.main()
+как есть (бот ходит в заглушки через TELEGRAM_API_URL и OPENROUTER_URL)
+и прогоняет сценарии:
+
+  steady    - обычный поток сообщений с редкими /rep
+  raid      - всплеск /rep: много спамеров, на каждого жалуются несколько человек
+  unmuteall - админ размучивает сразу много пользователей
+
+Для каждого сценария печатает пропускную способность, p50/p99 задержки и память.
+
+Запуск:
+  python bench/loadtest.py raid --spammers 50 --reporters 5 --llm-latency uniform:0.2,0.8
+  python bench/loadtest.py unmuteall --users 300 --set TG_CHAT_RATE=100
+"""
+import argparse
+import asyncio
+import os
+import resource
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from fake_openrouter import FakeOpenRouter  # noqa: E402
+from fake_telegram import FakeTelegram  # noqa: E402
+
+CHAT_ID = -1001000000001
+ADMIN_CHAT_ID = -1001000000002
+ADMIN_USER_ID = 42
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else float("nan")
+
+
+class ReplyTracker:
+    """Запоминает момент первого ответа бота на каждое сообщение"""
+
+    def __init__(self):
+        self.replies = {}  # message_id -> время
+
+    def __call__(self, now, method, params):
+        if method != "sendMessage":
+            return
+        target = (params.get("reply_parameters") or {}).get("message_id") or params.get("reply_to_message_id")
+        if target is not None:
+            self.replies.setdefault(int(target), now)
+
+
+async def wait_until(predicate, timeout, interval=0.01):
+    deadline = time.perf_counter() + timeout
+    while not predicate():
+        if time.perf_counter() > deadline:
+            return False
+        await asyncio.sleep(interval)
+    return True
+
+
+async def settle(bot_report, timeout):
+    """Ждёт, пока бот доделает начатое: хендлеры (удаление, ограничение), отложенные и фоновые задачи"""
+    return await wait_until(
+        lambda: bot_report.active_handlers.count == 0 and not bot_report.detached_tasks
+        and bot_report.background_jobs.queue_depth() == 0,
+        timeout
+    )
+
+
+def print_result(name, count, elapsed, latencies, unit="апдейтов"):
+    current, peak = tracemalloc.get_traced_memory()
+    rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"\n=== {name} ===")
+    print(f"{unit}: {count} за {elapsed:.2f}с -> {count / elapsed:.1f}/с")
+    if latencies:
+        print(f"задержка: p50={percentile(latencies, 0.5) * 1000:.1f} мс  p99={percentile(latencies, 0.99) * 1000:.1f} мс"
+              f"  (n={len(latencies)})")
+    print(f"память Python: сейчас {current / 2**20:.1f} МБ, пик {peak / 2**20:.1f} МБ, max RSS {rss_mb:.1f} МБ")
+
+
+async def scenario_steady(tg, tracker, args):
+    """Поток сообщений с заданной частотой; каждое N-е - /rep на безобидное сообщение"""
+    injected = {}
+    message_id = 1
+    started = time.perf_counter()
+    for i in range(args.messages):
+        message_id += 1
+        user_id = 1000 + i % 200
+        if i % args.rep_every == args.rep_every - 1:
+            target = {
+                "message_id": message_id - 1, "date": int(time.time()),
+                "chat": {"id": CHAT_ID, "type": "supergroup"},
+                "from": {"id": user_id + 1, "is_bot": False, "first_name": "target"}, "text": "лол"
+            }
+            tg.push_message(CHAT_ID, message_id, 500_000 + i, "/rep", reply_to=target)
+            injected[message_id - 1] = time.perf_counter()
+        else:
+            tg.push_message(CHAT_ID, message_id, user_id, f"обычное сообщение {i}")
+        if args.rate:
+            await asyncio.sleep(1 / args.rate)
+
+    await wait_until(lambda: tg.pending_updates == 0 and all(t in tracker.replies for t in injected), args.timeout)
+    elapsed = time.perf_counter() - started
+    latencies = [tracker.replies[t] - t0 for t, t0 in injected.items() if t in tracker.replies]
+    print_result("steady", args.messages, elapsed, latencies)
+
+
+async def scenario_raid(tg, tracker, args, bot_report):
+    """Спамеры пишут, затем на каждого одновременно жалуются несколько человек"""
+    targets = {}
+    message_id = 10_000
+    for i in range(args.spammers):
+        message_id += 1
+        text = f"КУПИ ПОДПИСКУ СКИДКА {i} {time.time_ns()}"
+        tg.push_message(CHAT_ID, message_id, 700_000 + i, text)
+        targets[message_id] = {
+            "message_id": message_id, "date": int(time.time()),
+            "chat": {"id": CHAT_ID, "type": "supergroup"},
+            "from": {"id": 700_000 + i, "is_bot": False, "first_name": f"spammer{i}"}, "text": text
+        }
+    await wait_until(lambda: tg.pending_updates == 0, args.timeout)
+
+    injected = {}
+    reporter = 800_000
+    started = time.perf_counter()
+    for round_ in range(args.reporters):
+        for target_id, target in targets.items():
+            reporter += 1
+            message_id += 1
+            tg.push_message(CHAT_ID, message_id, reporter, "/rep", reply_to=target)
+            injected.setdefault(target_id, time.perf_counter())
+
+    await wait_until(lambda: all(t in tracker.replies for t in injected), args.timeout)
+    elapsed = time.perf_counter() - started
+    latencies = [tracker.replies[t] - t0 for t, t0 in injected.items() if t in tracker.replies]
+    print_result("raid", args.spammers * args.reporters, elapsed, latencies, unit="/rep")
+    # Удаление идёт после ответа - считаем вызовы, когда бот всё доделал
+    await settle(bot_report, args.timeout)
+    print(f"restrictChatMember: {len(tg.calls_of('restrictChatMember'))}, "
+          f"ответов: {len(tracker.replies)}, удалено: {len(tg.calls_of('deleteMessage'))}")
+
+
+async def scenario_unmuteall(tg, tracker, args, bot_report):
+    """Админ размучивает args.users пользователей одной командой"""
+    for i in range(args.users):
+        bot_report.muted_users[bot_report.member_key(CHAT_ID, 900_000 + i)] = {'chat_id': CHAT_ID, 'message_id': i}
+
+    unmuted = {}
+    tg.listeners.append(
+        lambda now, method, params: unmuted.setdefault(params.get("user_id"), now)
+        if method == "restrictChatMember" else None
+    )
+    started = time.perf_counter()
+    tg.push_message(CHAT_ID, 50_000, ADMIN_USER_ID, "/unmuteall")
+    await wait_until(lambda: len(unmuted) >= args.users, args.timeout)
+    elapsed = time.perf_counter() - started
+    latencies = [t - started for t in unmuted.values()]
+    print_result("unmuteall", len(unmuted), elapsed, latencies, unit="размутов")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("scenario", choices=["steady", "raid", "unmuteall"])
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--rate", type=float, default=0, help="сообщений в секунду (0 - без паузы)")
+    parser.add_argument("--rep-every", type=int, default=100)
+    parser.add_argument("--spammers", type=int, default=50)
+    parser.add_argument("--reporters", type=int, default=5, help="жалоб на каждое спам-сообщение")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--llm-latency", default="uniform:0.2,0.8")
+    parser.add_argument("--verdicts", default="MUTE=0.6,WARN=0.2,OK=0.2")
+    parser.add_argument("--tg-latency", type=float, default=0.005)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+                        help="переменная окружения для бота, например TG_CHAT_RATE=100")
+    args = parser.parse_args()
+
+    tracemalloc.start()
+    tg = await FakeTelegram(admin_ids=[ADMIN_USER_ID], latency=args.tg_latency).start()
+    llm = await FakeOpenRouter(latency=args.llm_latency, verdicts=args.verdicts).start()
+    tracker = ReplyTracker()
+    tg.listeners.append(tracker)
+
+    os.environ.update({
+        "BOT_TOKEN_REPORT": "123456:loadtest",
+        "ALLOWED_CHAT_ID": str(CHAT_ID),
+        "ADMIN_CHAT_ID": str(ADMIN_CHAT_ID),
+        "TELEGRAM_API_URL": tg.base_url,
+        "OPENROUTER_URL": llm.url,
+        "METRICS_PORT": "0",
+        "SLOW_REPORT_SECONDS": "0",
+        "SNAPSHOT_FILE": ""  # не трогать сохранённое состояние настоящего бота
+    })
+    for item in args.set:
+        key, _, value = item.partition("=")
+        os.environ[key] = value
+
+    import bot_report
+
+    bot_task = asyncio.create_task(bot_report.main())
+    await wait_until(lambda: any(method == "getMe" for _, method, _ in tg.calls), 10)
+    try:
+        if args.scenario == "steady":
+            await scenario_steady(tg, tracker, args)
+        elif args.scenario == "raid":
+            await scenario_raid(tg, tracker, args, bot_report)
+        else:
+            await scenario_unmuteall(tg, tracker, args, bot_report)
+        print(f"запросов к LLM: {llm.requests} (вердиктов {llm.verdicts_served})")
+    finally:
+        # Заглушки останавливаем только после того, как бот дождался своих запросов
+        await settle(bot_report, args.timeout)
+        await bot_report.dp.stop_polling()
+        await bot_task
+        await tg.stop()
+        await llm.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
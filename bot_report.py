@@ -1,56 +1,1301 @@
 import asyncio
+import atexit
+import bisect
+import contextlib
+import contextvars
+import gzip
+import hashlib
+import heapq
+import itertools
 import json
 import logging
+import logging.handlers
 import os
+import queue
+import re
+import secrets
+import shutil
+import sqlite3
+import sys
+import time
+import unicodedata
+from array import array
 from datetime import datetime, timedelta
-from collections import deque
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
-from aiogram import Bot, Dispatcher, types, F
+from aiogram import Bot, Dispatcher, BaseMiddleware, types, F
 from aiogram.types import ChatPermissions, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.filters import Command
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
+from aiohttp import web
 import httpx
 
 load_dotenv()
 
-# Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('report_bot.log', encoding='utf-8'),
-        logging.StreamHandler()
-    ]
-)
+# Настройка логирования: запись на диск идёт в фоновом потоке через очередь,
+# чтобы медленный диск не блокировал event loop
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+REPORTED_LOG_FILE = os.getenv("REPORTED_LOG_FILE", "reported_messages.jsonl")
+REPORTED_LOG_MAX_BYTES = int(os.getenv("REPORTED_LOG_MAX_BYTES", str(50 * 1024 * 1024)))
+REPORTED_LOG_ROTATE_HOURS = float(os.getenv("REPORTED_LOG_ROTATE_HOURS", "24"))  # 0 - только по размеру
+REPORTED_LOG_BACKUPS = int(os.getenv("REPORTED_LOG_BACKUPS", "30"))
+REPORTED_LOG_COMPRESS = os.getenv("REPORTED_LOG_COMPRESS", "1") == "1"
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """Одна запись - одна JSON-строка; поля берутся из extra={'audit': {...}}"""
+
+    def format(self, record):
+        entry = {'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds')}
+        entry.update(getattr(record, 'audit', None) or {'message': record.getMessage()})
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def _gzip_rotator(source, dest):
+    with open(source, 'rb') as src, gzip.open(dest, 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(source)
+
+
+class AuditFileHandler(logging.handlers.RotatingFileHandler):
+    """Ротация по размеру И по времени, старые файлы опционально сжимаются в .gz"""
+
+    def __init__(self, filename, max_bytes, backup_count, interval, compress):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+        self.interval = interval
+        self.rollover_at = time.time() + interval if interval else None
+        if compress:
+            self.namer = lambda name: f"{name}.gz"
+            self.rotator = _gzip_rotator
+
+    def shouldRollover(self, record):
+        if self.rollover_at is not None and time.time() >= self.rollover_at:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        if self.rollover_at is not None:
+            self.rollover_at = time.time() + self.interval
+
+
+log_queue = queue.Queue()
+reported_log_queue = queue.Queue()
+
+_log_file_handler = logging.FileHandler('report_bot.log', encoding='utf-8')
+_log_stream_handler = logging.StreamHandler()
+for _handler in (_log_file_handler, _log_stream_handler):
+    _handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+# QueueHandler только переносит текст записи; формат LOG_FORMAT применяют обработчики на стороне listener,
+# иначе basicConfig навесит свой формат и строка отформатируется дважды
+_log_queue_handler = logging.handlers.QueueHandler(log_queue)
+_log_queue_handler.setFormatter(logging.Formatter("%(message)s"))
+logging.basicConfig(level=logging.INFO, handlers=[_log_queue_handler])
 logger = logging.getLogger(__name__)
 
-# Отдельный логгер для reported сообщений
+# Отдельный логгер для reported сообщений (JSON Lines, с ротацией)
 reported_logger = logging.getLogger('reported_messages')
-reported_handler = logging.FileHandler('reported_messages.log', encoding='utf-8')
-reported_handler.setFormatter(logging.Formatter('%(asctime)s - %(message)s'))
-reported_logger.addHandler(reported_handler)
+reported_handler = AuditFileHandler(
+    REPORTED_LOG_FILE,
+    max_bytes=REPORTED_LOG_MAX_BYTES,
+    backup_count=REPORTED_LOG_BACKUPS,
+    interval=REPORTED_LOG_ROTATE_HOURS * 3600,
+    compress=REPORTED_LOG_COMPRESS
+)
+reported_handler.setFormatter(JsonLinesFormatter())
+reported_logger.addHandler(logging.handlers.QueueHandler(reported_log_queue))
 reported_logger.setLevel(logging.INFO)
 
-# Кэш последних сообщений (до 50 сообщений в памяти)
-message_cache = deque(maxlen=150)
+log_listeners = [
+    logging.handlers.QueueListener(log_queue, _log_file_handler, _log_stream_handler),
+    logging.handlers.QueueListener(reported_log_queue, reported_handler)
+]
+for _listener in log_listeners:
+    _listener.start()
+    # При выходе дописываем всё, что осталось в очереди
+    atexit.register(_listener.stop)
 
-# Данные о задействованных пользователях (для размута)
-muted_users = {}  # user_id -> {'chat_id': ..., 'message_id': ...}
-banned_users = {}  # user_id -> {'chat_id': ..., 'message_id': ...} для разбана
-pending_bans = {}  # user_id -> {'chat_id': ..., 'target_id': ..., 'reason': ..., 'message_id': ...} для подтверждения BAN
 
-# Кулдаун для /rep команды (30 сек)
-rep_cooldown = {}  # user_id -> timestamp
+def log_queue_depth() -> int:
+    """Сколько записей ждут записи на диск"""
+    return log_queue.qsize() + reported_log_queue.qsize()
+
+# Идущие проверки /rep, чтобы несколько жалоб на одно сообщение не запускали ИИ повторно
+inflight_reports = {}  # (chat_id, message_id) -> asyncio.Future с вердиктом
+
+
+def parse_chat_config(spec: str, path: str = "") -> dict:
+    """Таблица чатов: строка "чат:админ-чат,чат:админ-чат" и/или JSON-файл {"чат": админ-чат}"""
+    chats = {}
+    if path and os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            for chat_id, admin_chat_id in json.load(f).items():
+                chats[int(chat_id)] = int(admin_chat_id)
+    for item in spec.split(","):
+        item = item.strip()
+        if item:
+            chat_id, _, admin_chat_id = item.partition(":")
+            chats[int(chat_id)] = int(admin_chat_id)
+    return chats
+
 
 # ================= КОНФИГ =================
 TG_TOKEN = os.getenv("BOT_TOKEN_REPORT")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")  # свой Bot API сервер (local bot api или заглушка для нагрузочных тестов)
 OPENROUTER_KEY = os.getenv("OPENROUTER_KEY")
-ALLOWED_CHAT_ID = int(os.getenv("ALLOWED_CHAT_ID"))
-ADMIN_CHAT_ID = int(os.getenv("ADMIN_CHAT_ID"))
+ALLOWED_CHAT_ID = int(os.getenv("ALLOWED_CHAT_ID", "0"))
+ADMIN_CHAT_ID = int(os.getenv("ADMIN_CHAT_ID", "0"))
+
+# Модерируемые чаты и их админ-чаты (CHATS и/или CHATS_FILE); ALLOWED_CHAT_ID/ADMIN_CHAT_ID - вариант для одного чата
+CHAT_ADMINS = parse_chat_config(os.getenv("CHATS", ""), os.getenv("CHATS_FILE", ""))
+if ALLOWED_CHAT_ID:
+    CHAT_ADMINS.setdefault(ALLOWED_CHAT_ID, ADMIN_CHAT_ID)
+ADMIN_CHATS = set(CHAT_ADMINS.values())
+
+# HTTP-клиент OpenRouter (один на весь процесс, keep-alive пул)
+OPENROUTER_URL = os.getenv("OPENROUTER_URL", "https://openrouter.ai/api/v1/chat/completions")
+OPENROUTER_HTTP2 = os.getenv("OPENROUTER_HTTP2", "0") == "1"
+OPENROUTER_MAX_CONNECTIONS = int(os.getenv("OPENROUTER_MAX_CONNECTIONS", "20"))
+OPENROUTER_MAX_KEEPALIVE = int(os.getenv("OPENROUTER_MAX_KEEPALIVE", "10"))
+OPENROUTER_KEEPALIVE_EXPIRY = float(os.getenv("OPENROUTER_KEEPALIVE_EXPIRY", "60"))
+OPENROUTER_CONNECT_TIMEOUT = float(os.getenv("OPENROUTER_CONNECT_TIMEOUT", "5"))
+OPENROUTER_READ_TIMEOUT = float(os.getenv("OPENROUTER_READ_TIMEOUT", "30"))
+OPENROUTER_MODEL = os.getenv("OPENROUTER_MODEL", "openrouter/auto")
+OPENROUTER_STREAM = os.getenv("OPENROUTER_STREAM", "0") == "1"  # SSE-поток с ранним извлечением вердикта
+
+# Несколько моделей/эндпоинтов по порядку: "модель" или "модель@url" через запятую
+LLM_BACKENDS = os.getenv("LLM_BACKENDS", "")
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "1") == "1"
+HEDGE_DELAY = os.getenv("HEDGE_DELAY", "p90")  # секунды или "p90" - наблюдаемый p90 основного бэкенда
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "1.0"))
+HEDGE_DEFAULT_DELAY = float(os.getenv("HEDGE_DEFAULT_DELAY", "4.0"))  # пока статистики нет
+BREAKER_WINDOW = int(os.getenv("BREAKER_WINDOW", "20"))
+BREAKER_MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", "5"))
+BREAKER_ERROR_RATE = float(os.getenv("BREAKER_ERROR_RATE", "0.5"))
+BREAKER_SLOW_SECONDS = float(os.getenv("BREAKER_SLOW_SECONDS", "15"))  # p90 выше - бэкенд считается медленным
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", "60"))
+
+# История сообщений для контекста (отдельное окно на каждый чат, ограничено размером в памяти)
+MESSAGE_HISTORY_BYTES = int(os.getenv("MESSAGE_HISTORY_BYTES", str(8 * 1024 * 1024)))
+MESSAGE_TEXT_MAX_CHARS = int(os.getenv("MESSAGE_TEXT_MAX_CHARS", "0"))  # 0 - хранить текст целиком
+CONTEXT_MESSAGES = int(os.getenv("CONTEXT_MESSAGES", "15"))
+CONTEXT_RELATED = int(os.getenv("CONTEXT_RELATED", "8"))  # из них в первую очередь: цепочка ответов и переписка с жалобщиком
+REPLY_EXCHANGE_DEPTH = int(os.getenv("REPLY_EXCHANGE_DEPTH", "16"))  # сколько последних ответов помнить для пары пользователей
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1200"))  # бюджет на историю диалога
+CONTEXT_MESSAGE_MAX_CHARS = int(os.getenv("CONTEXT_MESSAGE_MAX_CHARS", "300"))  # длинные сообщения обрезаются
+PROMPT_CACHE = os.getenv("PROMPT_CACHE", "1") == "1"  # пометить системный промпт для кэша у провайдера
+
+# Кэш вердиктов ИИ (повторы одного и того же текста не идут в OpenRouter)
+VERDICT_CACHE_SIZE = int(os.getenv("VERDICT_CACHE_SIZE", "5000"))
+VERDICT_CACHE_TTL = float(os.getenv("VERDICT_CACHE_TTL", "21600"))  # 6 часов
+VERDICT_CACHE_CONTEXT_DEPTH = int(os.getenv("VERDICT_CACHE_CONTEXT_DEPTH", "2"))
+VERDICT_CACHE_FILE = os.getenv("VERDICT_CACHE_FILE", "")  # пусто - не сохранять между перезапусками
+
+# Локальный пре-фильтр (очевидные случаи решаются без ИИ)
+PREFILTER_ENABLED = os.getenv("PREFILTER_ENABLED", "1") == "1"
+PHISHING_DOMAINS_FILE = os.getenv("PHISHING_DOMAINS_FILE", "phishing_domains.txt")
+PHISHING_KEYWORDS_FILE = os.getenv("PHISHING_KEYWORDS_FILE", "phishing_keywords.txt")
+HARMLESS_WORDS_FILE = os.getenv("HARMLESS_WORDS_FILE", "harmless_words.txt")
+FLOOD_REPEAT_THRESHOLD = int(os.getenv("FLOOD_REPEAT_THRESHOLD", "3"))
+
+# Индекс почти-повторов (правило 1.1): SimHash каждого сообщения по автору и по чату
+FLOOD_WINDOW = float(os.getenv("FLOOD_WINDOW", "120"))  # серия повторов рвётся после такой паузы, сек
+FLOOD_MAX_DISTANCE = int(os.getenv("FLOOD_MAX_DISTANCE", "8"))  # сколько бит из 64 может отличаться у похожих
+SIMHASH_MAX_SHINGLES = int(os.getenv("SIMHASH_MAX_SHINGLES", "512"))
+FLOOD_AUTO_MUTE = os.getenv("FLOOD_AUTO_MUTE", "0") == "1"
+FLOOD_AUTO_MUTE_COUNT = int(os.getenv("FLOOD_AUTO_MUTE_COUNT", "5"))
+FLOOD_MUTE_MINUTES = int(os.getenv("FLOOD_MUTE_MINUTES", "35"))
+
+# Пакетная отправка проверок в ИИ во время наплыва /rep
+LLM_BATCH_ENABLED = os.getenv("LLM_BATCH_ENABLED", "0") == "1"
+LLM_BATCH_WINDOW = float(os.getenv("LLM_BATCH_WINDOW_MS", "300")) / 1000
+LLM_BATCH_MAX = int(os.getenv("LLM_BATCH_MAX", "8"))
+
+# Кэш списка админов (вместо get_chat_member на каждое нажатие)
+ADMIN_CACHE_TTL = float(os.getenv("ADMIN_CACHE_TTL", "300"))
+
+# Массовые действия (/unmuteall и т.п.): параллельность и лимиты Telegram
+BULK_CONCURRENCY = int(os.getenv("BULK_CONCURRENCY", "8"))
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "25"))  # запросов в секунду на бота
+TG_CHAT_RATE = float(os.getenv("TG_CHAT_RATE", "10"))  # запросов в секунду на чат
+BULK_MAX_RETRIES = int(os.getenv("BULK_MAX_RETRIES", "5"))
+BULK_PROGRESS_INTERVAL = float(os.getenv("BULK_PROGRESS_INTERVAL", "3"))
+
+# Фоновые некритичные действия (уведомления админам): не задерживают ответ в чате, повторяются при ошибках
+BACKGROUND_WORKERS = int(os.getenv("BACKGROUND_WORKERS", "4"))
+BACKGROUND_QUEUE_SIZE = int(os.getenv("BACKGROUND_QUEUE_SIZE", "1000"))
+BACKGROUND_RETRIES = int(os.getenv("BACKGROUND_RETRIES", "5"))
+BACKGROUND_BACKOFF = float(os.getenv("BACKGROUND_BACKOFF", "1"))  # пауза перед повтором, удваивается
+
+# Время жизни состояния модерации (записи удаляются сами по истечении)
+REP_COOLDOWN = float(os.getenv("REP_COOLDOWN", "30"))
+MUTE_DEFAULT_MINUTES = int(os.getenv("MUTE_DEFAULT_MINUTES", "30"))  # если ИИ не указал длительность мута
+MUTE_MAX_MINUTES = 366 * 24 * 60  # дольше Telegram всё равно считает мут бессрочным
+# Общий срок ожидания вердикта /rep и /repno, потом дело уходит админам (0 - без срока).
+# Если включаете, ставьте больше OPENROUTER_READ_TIMEOUT с задержкой хеджа, иначе медленные вердикты уйдут админам
+REP_DEADLINE = float(os.getenv("REP_DEADLINE", "0"))
+REP_EFFECT_TIMEOUT = float(os.getenv("REP_EFFECT_TIMEOUT", "10"))  # на каждое действие Telegram после вердикта (0 - без ограничения)
+REP_FALLBACK_TIMEOUT = float(os.getenv("REP_FALLBACK_TIMEOUT", "3"))  # на ответ "передано админам" после срыва срока
+MUTE_STATE_TTL = float(os.getenv("MUTE_STATE_TTL", "86400"))  # если длительность мута неизвестна
+BAN_STATE_TTL = float(os.getenv("BAN_STATE_TTL", "604800"))  # кнопка разбана помнит пользователя неделю
+BAN_CONFIRM_TIMEOUT = float(os.getenv("BAN_CONFIRM_TIMEOUT", "86400"))
+STATE_SWEEP_INTERVAL = float(os.getenv("STATE_SWEEP_INTERVAL", "30"))
+
+# Тёплый перезапуск: состояние модерации и история чатов дописываются в SQLite (WAL) и подхватываются после деплоя
+SNAPSHOT_FILE = os.getenv("SNAPSHOT_FILE", "")  # например bot_state.sqlite3; пусто - не сохранять
+SNAPSHOT_INTERVAL = float(os.getenv("SNAPSHOT_INTERVAL", "5"))  # как часто сбрасывать изменения на диск, сек
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", "20"))  # сколько ждать идущие хендлеры при остановке
+
+# Режим получения апдейтов: polling или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # публичный https-адрес, например https://bot.example.com/webhook
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "8"))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+
+# Метрики Prometheus на локальном /metrics (0 - выключено)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+SLOW_REPORT_SECONDS = float(os.getenv("SLOW_REPORT_SECONDS", "5"))  # 0 - не логировать медленные обработки
+
+# Шардирование: координатор получает апдейты и раздаёт чаты SHARD_WORKERS процессам (0 - всё в одном процессе)
+SHARD_WORKERS = int(os.getenv("SHARD_WORKERS", "0"))
+SHARD_SOCKET = os.getenv("SHARD_SOCKET", "")  # задаётся координатором: этот процесс - шард
+SHARD_SOCKET_DIR = os.getenv("SHARD_SOCKET_DIR", "/tmp/report-bot")
+SHARD_VNODES = int(os.getenv("SHARD_VNODES", "100"))
+
+# Общее состояние (кулдауны, заявки на BAN, кэш вердиктов): memory - в этом процессе, socket - у координатора
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory")
+STATE_SOCKET = os.getenv("STATE_SOCKET", os.path.join(SHARD_SOCKET_DIR, "state.sock"))
+STATE_TIMEOUT = float(os.getenv("STATE_TIMEOUT", "5"))
+
+# Автомодерация: дешёвая оценка каждого сообщения, в ИИ уходят только подозрительные
+AUTOMOD_ENABLED = os.getenv("AUTOMOD_ENABLED", "0") == "1"
+AUTOMOD_THRESHOLD = float(os.getenv("AUTOMOD_THRESHOLD", "0.6"))
+AUTOMOD_LLM_PER_MINUTE = float(os.getenv("AUTOMOD_LLM_PER_MINUTE", "10"))
+AUTOMOD_QUEUE_SIZE = int(os.getenv("AUTOMOD_QUEUE_SIZE", "100"))
+AUTOMOD_WORKERS = int(os.getenv("AUTOMOD_WORKERS", "2"))
+AUTOMOD_RATE_WINDOW = float(os.getenv("AUTOMOD_RATE_WINDOW", "10"))  # окно для частоты сообщений пользователя, сек
 # =========================================
 
-bot = Bot(token=TG_TOKEN)
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 30)
+
+
+def _format_labels(names, values) -> str:
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.values = {}  # значения меток -> число
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for key, value in self.values.items():
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = {}  # значения меток -> [счётчики по бакетам..., sum, count]
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        data = self.values.get(key)
+        if data is None:
+            data = self.values[key] = [0] * len(self.buckets) + [0.0, 0]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            data[index] += 1
+        data[-2] += value
+        data[-1] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for key, data in self.values.items():
+            cumulative = 0
+            for bucket, count in zip(self.buckets, data):
+                cumulative += count
+                labels = _format_labels(self.labels + ("le",), key + (bucket,))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.labels + ('le',), key + ('+Inf',))} {data[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {data[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {data[-1]}")
+        return lines
+
+
+class Gauge:
+    """Значение считается в момент запроса /metrics (глубина очередей, размеры кэшей)"""
+
+    def __init__(self, name: str, help_text: str, fn, kind: str = "gauge"):
+        self.name = name
+        self.help_text = help_text
+        self.fn = fn
+        self.kind = kind
+
+    def render(self) -> list:
+        try:
+            value = self.fn()
+        except Exception as e:
+            logger.error(f"❌ Ошибка метрики {self.name}: {e}")
+            return []
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}", f"{self.name} {value}"]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name: str, help_text: str, labels=()) -> Counter:
+        metric = Counter(name, help_text, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help_text: str, labels=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        metric = Histogram(name, help_text, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name: str, help_text: str, fn, kind: str = "gauge") -> Gauge:
+        metric = Gauge(name, help_text, fn, kind)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+HANDLER_SECONDS = metrics.histogram("report_bot_handler_seconds", "Время обработки апдейта хендлером", ["handler"])
+STAGE_SECONDS = metrics.histogram("report_bot_stage_seconds", "Время этапов обработки /rep и /repno", ["stage"])
+TELEGRAM_SECONDS = metrics.histogram("report_bot_telegram_request_seconds", "Время запросов к Telegram Bot API", ["method"])
+TELEGRAM_ERRORS = metrics.counter("report_bot_telegram_errors_total", "Ошибки Telegram Bot API", ["method", "error"])
+LLM_SECONDS = metrics.histogram("report_bot_llm_request_seconds", "Время запроса вердикта к модели", ["backend"])
+AI_ERRORS = metrics.counter("report_bot_ai_errors_total", "Ошибки запросов к модели", ["backend"])
+VERDICTS = metrics.counter("report_bot_verdicts_total", "Вердикты по действию и уровню", ["action", "tier"])
+REPLY_SECONDS = metrics.histogram("report_bot_reply_seconds", "Время от команды до ответа в чате", ["action"])
+BACKGROUND_JOBS = metrics.counter("report_bot_background_jobs_total", "Фоновые задачи по итогу", ["job", "result"])
+STATE_FALLBACKS = metrics.counter("report_bot_state_fallbacks_total", "Обращения к общему состоянию, выполненные локально из-за ошибки", ["namespace"])
+DEADLINE_MISSES = metrics.counter("report_bot_deadline_misses_total", "Этап, на котором /rep или /repno вышли за общий срок", ["command", "stage"])
+
+# Разбивка текущей обработки по этапам (для лога медленных обработок)
+current_stages = contextvars.ContextVar("current_stages", default=None)
+
+
+def add_stage_time(name: str, seconds: float):
+    stages = current_stages.get()
+    if stages is not None:
+        stages[name] = stages.get(name, 0.0) + seconds
+
+
+@contextlib.contextmanager
+def stage(name: str):
+    """Замер этапа: пишет в гистограмму и в разбивку текущей обработки"""
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        elapsed = time.monotonic() - started
+        STAGE_SECONDS.observe(elapsed, stage=name)
+        add_stage_time(name, elapsed)
+
+
+class ActiveHandlers:
+    """Счётчик идущих хендлеров: при остановке бот ждёт, пока они доработают"""
+
+    def __init__(self):
+        self.count = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    def enter(self):
+        self.count += 1
+        self._idle.clear()
+
+    def leave(self):
+        self.count -= 1
+        if not self.count:
+            self._idle.set()
+
+    async def drain(self, timeout: float) -> bool:
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+
+active_handlers = ActiveHandlers()
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Время каждого хендлера + лог медленных обработок с разбивкой по этапам"""
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object is not None else "unknown"
+        stages = {}
+        token = current_stages.set(stages)
+        started = time.monotonic()
+        active_handlers.enter()
+        try:
+            return await handler(event, data)
+        finally:
+            active_handlers.leave()
+            total = time.monotonic() - started
+            current_stages.reset(token)
+            HANDLER_SECONDS.observe(total, handler=name)
+            if SLOW_REPORT_SECONDS and total >= SLOW_REPORT_SECONDS:
+                breakdown = ", ".join(f"{key} {value:.2f}с" for key, value in stages.items()) or "без этапов"
+                logger.warning(f"🐢 Медленная обработка {name}: {total:.2f}с ({breakdown})")
+
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """Время и ошибки каждого запроса к Bot API по методам"""
+
+    async def __call__(self, make_request, bot, method):
+        name = getattr(method, "__api_method__", type(method).__name__)
+        started = time.monotonic()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            TELEGRAM_ERRORS.inc(method=name, error=type(e).__name__)
+            raise
+        finally:
+            elapsed = time.monotonic() - started
+            TELEGRAM_SECONDS.observe(elapsed, method=name)
+            # Сообщения в админ-чат отдельно от публичных ответов
+            if name == "sendMessage" and getattr(method, "chat_id", None) in ADMIN_CHATS:
+                name = "sendMessage(admin)"
+            add_stage_time(name, elapsed)
+
+
+bot = Bot(
+    token=TG_TOKEN,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+)
+bot.session.middleware(TelegramMetricsMiddleware())
 dp = Dispatcher()
+for _observer in (dp.message, dp.callback_query, dp.chat_member):
+    _observer.middleware(HandlerMetricsMiddleware())
+
+# Общий HTTP-клиент для OpenRouter, создаётся в main() и закрывается при остановке
+http_client = None
+
+
+def create_http_client():
+    """Создаёт долгоживущий httpx-клиент с пулом соединений и раздельными таймаутами"""
+    http2 = OPENROUTER_HTTP2
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            logger.warning("⚠️ OPENROUTER_HTTP2=1, но пакет h2 не установлен - работаю по HTTP/1.1")
+            http2 = False
+
+    return httpx.AsyncClient(
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=OPENROUTER_MAX_CONNECTIONS,
+            max_keepalive_connections=OPENROUTER_MAX_KEEPALIVE,
+            keepalive_expiry=OPENROUTER_KEEPALIVE_EXPIRY
+        ),
+        timeout=httpx.Timeout(
+            OPENROUTER_READ_TIMEOUT,
+            connect=OPENROUTER_CONNECT_TIMEOUT,
+            pool=OPENROUTER_CONNECT_TIMEOUT
+        )
+    )
+
+
+def get_http_client():
+    """Возвращает общий клиент; создаёт его лениво, если main() ещё не запускался"""
+    global http_client
+    if http_client is None or http_client.is_closed:
+        http_client = create_http_client()
+    return http_client
+
+
+async def close_http_client():
+    global http_client
+    if http_client is not None and not http_client.is_closed:
+        await http_client.aclose()
+    http_client = None
+
+
+class MessageRecord:
+    """
+    Сообщение в истории: __slots__ вместо dict, имя автора интернировано
+    (одна строка на пользователя), время - целые секунды epoch вместо datetime.
+    reply_to - message_id сообщения, на которое это отвечает (0 - не ответ).
+    """
+    __slots__ = ('message_id', 'user_id', 'username', 'text', 'reply_to', 'timestamp')
+
+    def __init__(self, message_id: int, user_id: int, username: str, text: str,
+                 reply_to: int = 0, timestamp: int = None):
+        self.message_id = message_id
+        self.user_id = user_id
+        self.username = sys.intern(username)
+        self.text = text
+        self.reply_to = reply_to
+        self.timestamp = int(time.time()) if timestamp is None else timestamp
+
+    def nbytes(self) -> int:
+        """Примерный размер в памяти (без общей строки имени) плюс место в индексах истории"""
+        return (sys.getsizeof(self) + sys.getsizeof(self.text) + sys.getsizeof(self.message_id)
+                + sys.getsizeof(self.user_id) + sys.getsizeof(self.reply_to) + sys.getsizeof(self.timestamp) + 16)
+
+
+class ChatHistory:
+    """
+    Окно сообщений одного чата, упорядоченное по message_id и ограниченное
+    суммарным размером: длинная копипаста вытесняет больше старых сообщений,
+    чем короткое "ок". id лежат в array для bisect, вытесненные записи
+    отрезаются от начала списков пачками.
+    Граф ответов: у записи есть ссылка reply_to, а для каждой пары
+    пользователей хранятся id последних ответов друг другу.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._ids = array('q')
+        self._items = []
+        self._head = 0  # записи до _head уже вытеснены
+        self._exchanges = {}  # (меньший user_id, больший user_id) -> deque message_id ответов
+
+    def __len__(self):
+        return len(self._items) - self._head
+
+    def __iter__(self):
+        return itertools.islice(self._items, self._head, None)
+
+    def append(self, record: MessageRecord):
+        message_id = record.message_id
+        if len(self) and message_id <= self._ids[-1]:
+            # Сообщение пришло не по порядку (редкость) - вставляем на своё место
+            index = bisect.bisect_left(self._ids, message_id, self._head)
+            if self._ids[index] == message_id:
+                self.nbytes -= self._items[index].nbytes()
+                self._items[index] = record
+            else:
+                self._ids.insert(index, message_id)
+                self._items.insert(index, record)
+        else:
+            self._ids.append(message_id)
+            self._items.append(record)
+        self.nbytes += record.nbytes()
+        if record.reply_to:
+            parent = self.get(record.reply_to)
+            if parent is not None and parent.user_id != record.user_id:
+                pair = (min(parent.user_id, record.user_id), max(parent.user_id, record.user_id))
+                replies = self._exchanges.get(pair)
+                if replies is None:
+                    replies = self._exchanges[pair] = deque(maxlen=REPLY_EXCHANGE_DEPTH)
+                replies.append(message_id)
+        self._evict()
+
+    def _evict(self):
+        # Последнее сообщение остаётся, даже если оно одно больше бюджета
+        while self.nbytes > self.max_bytes and len(self) > 1:
+            self.nbytes -= self._items[self._head].nbytes()
+            self._items[self._head] = None
+            self._head += 1
+        if self._head > 64 and self._head * 2 > len(self._items):
+            del self._ids[:self._head]
+            del self._items[:self._head]
+            self._head = 0
+            # Пары, все ответы которых уже вытеснены
+            oldest = self._ids[0]
+            for pair in [pair for pair, replies in self._exchanges.items() if replies[-1] < oldest]:
+                del self._exchanges[pair]
+
+    def get(self, message_id: int):
+        index = bisect.bisect_left(self._ids, message_id, self._head)
+        if index < len(self._ids) and self._ids[index] == message_id:
+            return self._items[index]
+        return None
+
+    def reply_chain(self, message_id: int, limit: int) -> list:
+        """Сообщения, на которые по цепочке отвечает message_id (ближайшие первыми)"""
+        chain = []
+        record = self.get(message_id)
+        while record is not None and record.reply_to and len(chain) < limit:
+            record = self.get(record.reply_to)
+            if record is not None:
+                chain.append(record)
+        return chain
+
+    def exchanges(self, user_a: int, user_b: int, before_id: int, limit: int) -> list:
+        """Последние ответы user_a и user_b друг другу до before_id вместе с тем, на что отвечали (новые первыми)"""
+        result = []
+        for message_id in reversed(self._exchanges.get((min(user_a, user_b), max(user_a, user_b)), ())):
+            if len(result) >= limit:
+                break
+            if message_id >= before_id:
+                continue
+            record = self.get(message_id)
+            if record is None:
+                continue
+            result.append(record)
+            parent = self.get(record.reply_to)
+            if parent is not None:
+                result.append(parent)
+        return result
+
+    def before(self, message_id: int, limit: int) -> list:
+        """До limit последних сообщений с id меньше message_id, O(log n + limit)"""
+        end = bisect.bisect_left(self._ids, message_id, self._head)
+        return self._items[max(self._head, end - limit):end]
+
+
+class MessageCache:
+    """Истории сообщений по чатам для сбора контекста"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes  # на каждый чат
+        self._chats = {}  # chat_id -> ChatHistory
+        self.appended = None  # [(chat_id, MessageRecord), ...] с прошлого снимка, если снимки включены
+
+    def __len__(self):
+        return sum(len(history) for history in self._chats.values())
+
+    @property
+    def nbytes(self) -> int:
+        return sum(history.nbytes for history in self._chats.values())
+
+    def chat(self, chat_id: int) -> ChatHistory:
+        history = self._chats.get(chat_id)
+        if history is None:
+            history = self._chats[chat_id] = ChatHistory(self.max_bytes)
+        return history
+
+    def append(self, chat_id: int, record: MessageRecord):
+        self.chat(chat_id).append(record)
+        if self.appended is not None:
+            self.appended.append((chat_id, record))
+
+    def restore(self, chat_id: int, records):
+        """Подкладывает сохранённые записи (по возрастанию id) перед сообщениями, пришедшими после старта"""
+        live = self._chats.get(chat_id)
+        history = ChatHistory(self.max_bytes)
+        for record in records:
+            history.append(record)
+        if live is not None:
+            for record in live:
+                history.append(record)
+        self._chats[chat_id] = history
+
+    def before(self, chat_id: int, message_id: int, limit: int = CONTEXT_MESSAGES) -> list:
+        history = self._chats.get(chat_id)
+        return history.before(message_id, limit) if history is not None else []
+
+    def related(self, chat_id: int, message_id: int, target_id: int, reporter_id: int = None,
+                limit: int = CONTEXT_RELATED) -> list:
+        """Связанные с сообщением записи по важности: цепочка ответов, затем переписка автора с жалобщиком"""
+        history = self._chats.get(chat_id)
+        if history is None:
+            return []
+        related = history.reply_chain(message_id, limit)
+        if reporter_id is not None and reporter_id != target_id:
+            related += history.exchanges(target_id, reporter_id, message_id, limit)
+        return related
+
+
+# Кэш последних сообщений по чатам
+message_cache = MessageCache(MESSAGE_HISTORY_BYTES)
+
+
+class AdminRoster:
+    """
+    Список админов каждого чата из get_chat_administrators.
+    Устаревший список обновляется в фоне, а проверка прав - это поиск в set.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._admins = {}  # chat_id -> (fetched_at, {user_id, ...})
+        self._refreshing = {}  # chat_id -> asyncio.Task
+
+    async def refresh(self, chat_id: int) -> set:
+        admins = await bot.get_chat_administrators(chat_id)
+        admin_ids = {member.user.id for member in admins}
+        self._admins[chat_id] = (time.monotonic(), admin_ids)
+        logger.info(f"👮 Список админов чата {chat_id} обновлён: {len(admin_ids)}")
+        return admin_ids
+
+    def _refresh_in_background(self, chat_id: int):
+        if chat_id in self._refreshing:
+            return
+
+        async def run():
+            try:
+                await self.refresh(chat_id)
+            except Exception as e:
+                logger.error(f"❌ Ошибка обновления админов чата {chat_id}: {e}")
+            finally:
+                self._refreshing.pop(chat_id, None)
+
+        self._refreshing[chat_id] = asyncio.create_task(run())
+
+    async def is_admin(self, chat_id: int, user_id: int) -> bool:
+        entry = self._admins.get(chat_id)
+        if entry is None:
+            return user_id in await self.refresh(chat_id)
+        if time.monotonic() - entry[0] > self.ttl:
+            self._refresh_in_background(chat_id)
+        return user_id in entry[1]
+
+    def apply_status(self, chat_id: int, user_id: int, status: str):
+        """Применяет изменение статуса участника из chat_member апдейта"""
+        entry = self._admins.get(chat_id)
+        if entry is None:
+            return
+        if status in ["creator", "administrator"]:
+            entry[1].add(user_id)
+        else:
+            entry[1].discard(user_id)
+
+    def invalidate(self, chat_id: int = None):
+        if chat_id is None:
+            self._admins.clear()
+        else:
+            self._admins.pop(chat_id, None)
+
+
+admin_roster = AdminRoster(ADMIN_CACHE_TTL)
+
+
+class TokenBucket:
+    """Токен-бакет: не больше rate запросов в секунду, всплеск до capacity"""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class BulkExecutor:
+    """
+    Выполняет одно действие для многих объектов (размут, бан, разбан) с ограничением
+    параллельности, лимитами Telegram и повтором при RetryAfter.
+    Прогресс показывается редактированием статусного сообщения.
+    """
+
+    def __init__(self, concurrency: int, global_rate: float, chat_rate: float, max_retries: int):
+        self.concurrency = concurrency
+        self.chat_rate = chat_rate
+        self.max_retries = max_retries
+        self.global_bucket = TokenBucket(global_rate)
+        self._chat_buckets = {}  # chat_id -> TokenBucket
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate)
+        return bucket
+
+    async def _call(self, chat_id: int, action, item):
+        for attempt in range(self.max_retries + 1):
+            await self._chat_bucket(chat_id).acquire()
+            await self.global_bucket.acquire()
+            try:
+                return await action(item)
+            except TelegramRetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                logger.warning(f"⏳ Флуд-лимит Telegram, жду {e.retry_after}с ({item})")
+                await asyncio.sleep(e.retry_after)
+
+    async def run(self, chat_id: int, items, action, status_message: types.Message = None, title: str = ""):
+        """Возвращает (успешные, [(объект, ошибка), ...])"""
+        items = list(items)
+        done = []
+        failed = []
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def worker(item):
+            async with semaphore:
+                try:
+                    await self._call(chat_id, action, item)
+                    done.append(item)
+                except Exception as e:
+                    failed.append((item, e))
+                    logger.error(f"❌ {title}: ошибка для {item}: {e}")
+
+        async def report_progress():
+            while True:
+                await asyncio.sleep(BULK_PROGRESS_INTERVAL)
+                try:
+                    await status_message.edit_text(
+                        f"⏳ {title}: {len(done) + len(failed)}/{len(items)} (ошибок: {len(failed)})"
+                    )
+                except Exception as e:
+                    logger.warning(f"⚠️ Не удалось обновить прогресс: {e}")
+
+        progress = asyncio.create_task(report_progress()) if status_message is not None else None
+        try:
+            await asyncio.gather(*(worker(item) for item in items))
+        finally:
+            if progress is not None:
+                progress.cancel()
+        return done, failed
+
+
+bulk_executor = BulkExecutor(BULK_CONCURRENCY, TG_GLOBAL_RATE, TG_CHAT_RATE, BULK_MAX_RETRIES)
+
+
+class BackgroundJobs:
+    """
+    Очередь некритичных действий, которые не должны задерживать ответ пользователю
+    (уведомления в админ-чат). Ошибки повторяются с растущей паузой, RetryAfter
+    от Telegram соблюдается. При остановке уже принятые задачи дорабатываются.
+    """
+
+    def __init__(self, workers: int, queue_size: int, retries: int, backoff: float):
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.stats = {'done': 0, 'retried': 0, 'failed': 0, 'dropped': 0}
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        self._tasks = []
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = 10):
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"⚠️ Фоновые задачи не завершены при остановке: {self._queue.qsize()}")
+        for task in self._tasks:
+            task.cancel()
+
+    def submit(self, name: str, func) -> bool:
+        """func - функция без аргументов, возвращающая корутину (вызывается заново при повторе)"""
+        try:
+            self._queue.put_nowait((name, func))
+            return True
+        except asyncio.QueueFull:
+            self.stats['dropped'] += 1
+            BACKGROUND_JOBS.inc(job=name, result="dropped")
+            logger.error(f"❌ Очередь фоновых задач переполнена, {name} пропущено")
+            return False
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    async def _run(self, name: str, func):
+        for attempt in range(self.retries + 1):
+            try:
+                await func()
+                self.stats['done'] += 1
+                BACKGROUND_JOBS.inc(job=name, result="done")
+                return
+            except TelegramRetryAfter as e:
+                delay = e.retry_after
+            except Exception as e:
+                if attempt == self.retries:
+                    self.stats['failed'] += 1
+                    BACKGROUND_JOBS.inc(job=name, result="failed")
+                    logger.error(f"❌ Фоновая задача {name} не выполнена после {attempt + 1} попыток: {e}")
+                    return
+                delay = self.backoff * 2 ** attempt
+                logger.warning(f"⚠️ Фоновая задача {name}: {e}, повтор через {delay:.0f}с")
+            self.stats['retried'] += 1
+            await asyncio.sleep(delay)
+
+    async def _worker(self):
+        while True:
+            name, func = await self._queue.get()
+            try:
+                await self._run(name, func)
+            finally:
+                self._queue.task_done()
+
+
+background_jobs = BackgroundJobs(BACKGROUND_WORKERS, BACKGROUND_QUEUE_SIZE, BACKGROUND_RETRIES, BACKGROUND_BACKOFF)
+
+# Задачи "запустил и забыл": ссылки держим до завершения, иначе задачу может собрать GC
+detached_tasks = set()
+
+
+def spawn_detached(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    detached_tasks.add(task)
+    task.add_done_callback(detached_tasks.discard)
+    return task
+
+
+class ExpiringDict:
+    """
+    Словарь, где каждая запись живёт до своего срока. Сроки лежат в heap,
+    так что удаление истёкших - O(log n) на запись, без полного прохода.
+    Устаревшие элементы heap (после перезаписи ключа) пропускаются лениво.
+    """
+
+    def __init__(self, name: str, default_ttl: float, on_expire=None):
+        self.name = name
+        self.default_ttl = default_ttl
+        self.on_expire = on_expire  # callback(key, value)
+        self.expired = 0
+        self.dirty = None  # ключи, изменённые с прошлого снимка, если снимки включены
+        self._data = {}  # key -> (expires_at, value)
+        self._heap = []  # (expires_at, seq, key)
+        self._seq = itertools.count()
+
+    def set(self, key, value, ttl: float = None):
+        expires_at = time.monotonic() + (self.default_ttl if ttl is None else ttl)
+        self._data[key] = (expires_at, value)
+        if self.dirty is not None:
+            self.dirty.add(key)
+        heapq.heappush(self._heap, (expires_at, next(self._seq), key))
+        # Слишком много устаревших элементов - пересобираем heap
+        if len(self._heap) > 2 * len(self._data) + 64:
+            self._heap = [(exp, next(self._seq), k) for k, (exp, _) in self._data.items()]
+            heapq.heapify(self._heap)
+        self.purge()
+
+    def purge(self) -> int:
+        """Удаляет все истёкшие записи"""
+        now = time.monotonic()
+        removed = 0
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            expires_at, _, key = heapq.heappop(heap)
+            entry = self._data.get(key)
+            if entry is None or entry[0] != expires_at:
+                continue
+            del self._data[key]
+            removed += 1
+            if self.on_expire is not None:
+                try:
+                    self.on_expire(key, entry[1])
+                except Exception as e:
+                    logger.error(f"❌ Ошибка on_expire для {self.name}: {e}")
+        self.expired += removed
+        return removed
+
+    def ttl_left(self, key) -> float:
+        entry = self._data.get(key)
+        return max(0.0, entry[0] - time.monotonic()) if entry is not None else 0.0
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __getitem__(self, key):
+        self.purge()
+        return self._data[key][1]
+
+    def get(self, key, default=None):
+        self.purge()
+        entry = self._data.get(key)
+        return entry[1] if entry is not None else default
+
+    def __contains__(self, key):
+        self.purge()
+        return key in self._data
+
+    def __delitem__(self, key):
+        del self._data[key]
+        if self.dirty is not None:
+            self.dirty.add(key)
+
+    def pop(self, key, *default):
+        entry = self._data.pop(key, None)
+        if entry is not None and self.dirty is not None:
+            self.dirty.add(key)
+        if entry is None:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        return entry[1]
+
+    def keys(self):
+        self.purge()
+        return list(self._data.keys())
+
+    def items(self):
+        self.purge()
+        return [(key, entry[1]) for key, entry in self._data.items()]
+
+    def __len__(self):
+        self.purge()
+        return len(self._data)
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def take_changes(self) -> list:
+        """[(ключ, значение, сколько осталось жить), ...] изменённых с прошлого вызова; удалённые - со значением None"""
+        now = time.monotonic()
+        changes = []
+        for key in self.dirty:
+            entry = self._data.get(key)
+            if entry is None or entry[0] <= now:
+                changes.append((key, None, 0.0))
+            else:
+                changes.append((key, entry[1], entry[0] - now))
+        self.dirty = set()
+        return changes
+
+    def stats(self) -> dict:
+        return {
+            'entries': len(self._data),
+            'heap': len(self._heap),
+            'expired': self.expired,
+            'bytes': sys.getsizeof(self._data) + sys.getsizeof(self._heap)
+                     + sum(sys.getsizeof(value) for _, value in self._data.values())
+        }
+
+
+def member_key(chat_id: int, user_id: int) -> str:
+    """Ключ наказания: один пользователь в разных чатах - разные записи (строка, чтобы пройти через JSON)"""
+    return f"{chat_id}:{user_id}"
+
+
+def _log_expired_ban(key, ban_info):
+    logger.warning(f"⌛ BAN {key} не подтверждён за {BAN_CONFIRM_TIMEOUT / 3600:.0f} ч - заявка удалена")
+
+
+# Данные о задействованных пользователях (для размута), ключ - member_key(chat_id, user_id)
+muted_users = ExpiringDict('muted_users', MUTE_STATE_TTL)  # -> {'chat_id': ..., 'message_id': ...}, до конца мута
+banned_users = ExpiringDict('banned_users', BAN_STATE_TTL)  # -> {'chat_id': ..., 'message_id': ...} для разбана
+pending_bans = ExpiringDict('pending_bans', BAN_CONFIRM_TIMEOUT, _log_expired_ban)  # -> {...} для подтверждения BAN
+
+# Кулдаун для /rep команды
+rep_cooldown = ExpiringDict('rep_cooldown', REP_COOLDOWN)  # user_id -> time.time() последнего /rep
+
+moderation_state = (muted_users, banned_users, pending_bans, rep_cooldown)
+
+
+async def sweep_state():
+    """Периодически чистит истёкшие записи, даже если к словарям никто не обращается"""
+    while True:
+        await asyncio.sleep(STATE_SWEEP_INTERVAL)
+        automod.scorer.forget_idle()
+        flood_index.forget_idle()
+        for state in moderation_state:
+            removed = state.purge()
+            if removed:
+                logger.info(f"🧹 {state.name}: удалено истёкших записей {removed}")
+
+
+class StateSnapshot:
+    """
+    Тёплый перезапуск. Раз в interval изменённые записи состояния модерации и новые
+    сообщения истории дописываются в SQLite (WAL) из отдельного потока - event loop
+    только собирает изменения. При старте состояние подгружается в фоне, пока бот
+    уже принимает апдейты: свежие записи не перезаписываются сохранёнными.
+    """
+
+    def __init__(self, path: str, interval: float, states, cache: MessageCache):
+        self.path = path
+        self.interval = interval
+        self.states = {state.name: state for state in states}
+        self.cache = cache
+        self.restored = False
+        self.stats = {'flushes': 0, 'rows': 0, 'errors': 0, 'restored_state': 0, 'restored_messages': 0}
+        self._db = None
+        # Один поток на файл: запись и чтение идут по очереди и не пересекаются
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="snapshot")
+
+    def _track(self, enabled: bool):
+        """Изменения копятся только пока работает run(), иначе буфер рос бы без записи"""
+        for state in self.states.values():
+            state.dirty = set() if enabled else None
+        self.cache.appended = [] if enabled else None
+
+    # ---------- работа с файлом (в потоке) ----------
+
+    def _open(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS state (name TEXT, key TEXT, value TEXT, expires_at REAL,"
+                " PRIMARY KEY (name, key)) WITHOUT ROWID"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS messages (chat_id INTEGER, message_id INTEGER, user_id INTEGER,"
+                " username TEXT, text TEXT, reply_to INTEGER, ts INTEGER, PRIMARY KEY (chat_id, message_id)) WITHOUT ROWID"
+            )
+        return self._db
+
+    def _write(self, upserts, deletes, messages, trims, now):
+        db = self._open()
+        with db:
+            db.executemany("INSERT OR REPLACE INTO state VALUES (?, ?, ?, ?)", upserts)
+            db.executemany("DELETE FROM state WHERE name = ? AND key = ?", deletes)
+            db.execute("DELETE FROM state WHERE expires_at <= ?", (now,))
+            db.executemany("INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?, ?)", messages)
+            db.executemany("DELETE FROM messages WHERE chat_id = ? AND message_id < ?", trims)
+
+    def _read_state(self, now):
+        return self._open().execute(
+            "SELECT name, key, value, expires_at FROM state WHERE expires_at > ?", (now,)
+        ).fetchall()
+
+    def _read_chat(self, chat_id: int, max_bytes: int) -> list:
+        """Самые новые сообщения чата в пределах бюджета истории, по возрастанию id"""
+        cursor = self._open().execute(
+            "SELECT message_id, user_id, username, text, reply_to, ts FROM messages"
+            " WHERE chat_id = ? ORDER BY message_id DESC", (chat_id,)
+        )
+        records = []
+        total = 0
+        while total < max_bytes:
+            rows = cursor.fetchmany(1000)
+            if not rows:
+                break
+            for row in rows:
+                record = MessageRecord(*row)
+                records.append(record)
+                total += record.nbytes()
+                if total >= max_bytes:
+                    break
+        cursor.close()
+        records.reverse()
+        return records
+
+    def _read_chat_ids(self) -> list:
+        return [row[0] for row in self._open().execute("SELECT DISTINCT chat_id FROM messages")]
+
+    def _close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    # ---------- event loop ----------
+
+    async def _in_thread(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def flush(self):
+        """Сбрасывает накопленные изменения; история обрезается только после восстановления"""
+        if self.cache.appended is None:
+            return
+        now = time.time()
+        upserts, deletes = [], []
+        for name, state in self.states.items():
+            for key, value, ttl in state.take_changes():
+                if value is None:
+                    deletes.append((name, json.dumps(key)))
+                else:
+                    upserts.append((name, json.dumps(key), json.dumps(value, ensure_ascii=False), now + ttl))
+        appended, self.cache.appended = self.cache.appended, []
+        messages = [(chat_id, r.message_id, r.user_id, r.username, r.text, r.reply_to, r.timestamp)
+                    for chat_id, r in appended]
+        trims = []
+        if self.restored:
+            for chat_id in {chat_id for chat_id, _ in appended}:
+                oldest = next(iter(self.cache.chat(chat_id)), None)
+                if oldest is not None:
+                    trims.append((chat_id, oldest.message_id))
+        if not (upserts or deletes or messages):
+            return
+        try:
+            await self._in_thread(self._write, upserts, deletes, messages, trims, now)
+            self.stats['flushes'] += 1
+            self.stats['rows'] += len(upserts) + len(deletes) + len(messages)
+        except Exception as e:
+            self.stats['errors'] += 1
+            logger.error(f"❌ Ошибка записи снимка состояния: {e}")
+
+    async def restore(self):
+        """Подгружает сохранённое: сначала небольшое состояние модерации, затем историю по чатам"""
+        started = time.monotonic()
+        try:
+            rows = await self._in_thread(self._read_state, time.time())
+            now = time.time()
+            for name, key, value, expires_at in rows:
+                state = self.states.get(name)
+                key = json.loads(key)
+                # Записи, тронутые после старта, новее сохранённых
+                if state is None or key in state.dirty or key in state or expires_at <= now:
+                    continue
+                state.set(key, json.loads(value), ttl=expires_at - now)
+                state.dirty.discard(key)
+                self.stats['restored_state'] += 1
+
+            chat_ids = await self._in_thread(self._read_chat_ids)
+            for chat_id in chat_ids:
+                if chat_id not in CHAT_ADMINS:
+                    continue
+                records = await self._in_thread(self._read_chat, chat_id, self.cache.max_bytes)
+                self.cache.restore(chat_id, records)
+                self.stats['restored_messages'] += len(records)
+            logger.info(
+                f"💾 Состояние восстановлено за {time.monotonic() - started:.2f}с: "
+                f"записей модерации {self.stats['restored_state']}, сообщений {self.stats['restored_messages']}"
+            )
+            self.restored = True
+        except Exception as e:
+            # Без восстановления старая история на диске не обрезается
+            logger.error(f"❌ Ошибка восстановления состояния: {e}")
+
+    async def run(self):
+        """Восстановление, затем периодические снимки"""
+        self._track(True)
+        await self.restore()
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    async def close(self):
+        """Последний снимок при остановке"""
+        await self.flush()
+        self._track(False)
+        await self._in_thread(self._close)
+        self._executor.shutdown()
+        logger.info(f"💾 Снимок состояния сохранён в {self.path}")
+
+
+snapshot = StateSnapshot(SNAPSHOT_FILE, SNAPSHOT_INTERVAL, moderation_state, message_cache) if SNAPSHOT_FILE else None
 
 # Системный промпт с правилами
 SYSTEM_PROMPT = """
@@ -97,92 +1342,1440 @@ SYSTEM_PROMPT = """
 {"action": "MUTE/BAN/WARN/OK", "duration": число_или_null, "reason": "причина"}
 """
 
-async def check_with_ai(text: str, context: str = ""):
-    try:
-        full_request = f"Текст для проверки: {text}"
-        if context:
-            full_request = f"Контекст:\n{context}\n\n{full_request}"
-        
-        logger.info(f"📤 Запрос к OpenRouter: {text[:100]}...")
-        
-        headers = {
-            "Authorization": f"Bearer {OPENROUTER_KEY}",
-            "HTTP-Referer": "https://github.com",
-            "X-Title": "Report Bot",
-            "Content-Type": "application/json; charset=utf-8"
+_ZERO_WIDTH_RE = re.compile(r"[\u200b-\u200f\u2060\ufeff]")
+_SPACES_RE = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    """Приводит текст к каноничному виду: регистр, юникод-формы, невидимые символы, пробелы"""
+    text = unicodedata.normalize("NFKC", text)
+    text = _ZERO_WIDTH_RE.sub("", text).casefold()
+    return _SPACES_RE.sub(" ", text).strip()
+
+
+def prompt_fingerprint() -> str:
+    """Отпечаток промпта и модели - при их смене старые вердикты перестают совпадать"""
+    return hashlib.sha1(f"{OPENROUTER_MODEL}\n{LLM_BACKENDS}\n{SYSTEM_PROMPT}".encode("utf-8")).hexdigest()[:12]
+
+
+class VerdictCache:
+    """LRU-кэш вердиктов с TTL, ограничением размера и счётчиками попаданий"""
+
+    def __init__(self, max_size=5000, ttl=21600, context_depth=2, path=""):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.context_depth = context_depth
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (expires_at, verdict, normalized_text)
+
+    def make_key(self, text: str, context_messages=(), related=(), flooding: bool = False) -> str:
+        """
+        Ключ: нормализованный текст + отпечаток ближайшего контекста.
+        Копии проверяемого текста в контексте пропускаются, чтобы 20 одинаковых
+        сообщений подряд давали один и тот же ключ. Цепочка ответов (кто и что писал)
+        и пометка о флуде тоже уходят в ИИ, поэтому входят в ключ: вердикт из одной
+        ветки переписки не переносится в другую.
+        """
+        normalized = normalize_text(text)
+        context_lines = []
+        for msg in reversed(context_messages):
+            if len(context_lines) >= self.context_depth:
+                break
+            line = normalize_text(msg.text)
+            if line != normalized:
+                context_lines.append(line)
+        related_lines = [f"{msg.user_id}:{normalize_text(msg.text)}" for msg in related]
+        raw = "\x00".join([prompt_fingerprint(), normalized, *context_lines,
+                           "\x01related", *related_lines, "\x01flood" if flooding else ""])
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry[0] < time.time():
+            del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return dict(entry[1])
+
+    def put(self, key, verdict, text=""):
+        self._entries[key] = (time.time() + self.ttl, dict(verdict), normalize_text(text))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, text=None) -> int:
+        """Удаляет все записи или только те, где нормализованный текст содержит подстроку"""
+        if text is None:
+            removed = len(self._entries)
+            self._entries.clear()
+            return removed
+        needle = normalize_text(text)
+        keys = [key for key, entry in self._entries.items() if needle in entry[2]]
+        for key in keys:
+            del self._entries[key]
+        return len(keys)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0
         }
-        
-        data = {
-            "model": "openrouter/auto",
-            "messages": [
-                {"role": "system", "content": SYSTEM_PROMPT},
-                {"role": "user", "content": full_request}
-            ],
-            "temperature": 0.3,
-            "max_tokens": 500
-        }
-        
-        logger.info(f"📡 Отправляю в OpenRouter с контекстом...")
-        
-        async with httpx.AsyncClient(timeout=30) as client:
-            response = await client.post(
-                "https://openrouter.ai/api/v1/chat/completions",
-                headers=headers,
-                json=data
-            )
-            logger.info(f"📡 Статус ответа: {response.status_code}")
-            
+
+    def load(self):
+        """Загружает кэш с диска (ключи уже содержат отпечаток промпта, чужие просто не совпадут)"""
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('prompt') != prompt_fingerprint():
+                logger.info("🗑️ Промпт изменился - сохранённый кэш вердиктов пропущен")
+                return
+            now = time.time()
+            for key, expires_at, verdict, text in data.get('entries', []):
+                if expires_at > now:
+                    self._entries[key] = (expires_at, verdict, text)
+            logger.info(f"💾 Кэш вердиктов загружен: {len(self._entries)} записей")
+        except Exception as e:
+            logger.error(f"❌ Ошибка загрузки кэша вердиктов: {e}")
+
+    def save(self):
+        if not self.path:
+            return
+        try:
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({
+                    'prompt': prompt_fingerprint(),
+                    'entries': [[key, *entry] for key, entry in self._entries.items()]
+                }, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+            logger.info(f"💾 Кэш вердиктов сохранён: {len(self._entries)} записей")
+        except Exception as e:
+            logger.error(f"❌ Ошибка сохранения кэша вердиктов: {e}")
+
+
+verdict_cache = VerdictCache(
+    max_size=VERDICT_CACHE_SIZE,
+    ttl=VERDICT_CACHE_TTL,
+    context_depth=VERDICT_CACHE_CONTEXT_DEPTH,
+    path=VERDICT_CACHE_FILE
+)
+
+
+class StateBackendError(Exception):
+    pass
+
+
+class InProcessStateBackend:
+    """Общее состояние в памяти этого процесса: пространство имён -> ExpiringDict/VerdictCache"""
+
+    ALLOWED_OPS = {'get', 'set', 'pop', 'put', 'invalidate', 'stats', 'save'}
+
+    def __init__(self, namespaces: dict):
+        self.namespaces = namespaces
+
+    async def call(self, namespace: str, op: str, *args):
+        if op not in self.ALLOWED_OPS or namespace not in self.namespaces:
+            raise StateBackendError(f"Неизвестная операция {namespace}.{op}")
+        return getattr(self.namespaces[namespace], op)(*args)
+
+    async def close(self):
+        pass
+
+
+class SocketStateBackend:
+    """
+    Клиент общего состояния по локальному сокету (JSON построчно).
+    Одно соединение на процесс, ответы сопоставляются запросам по id,
+    так что параллельные хендлеры не ждут друг друга.
+    """
+
+    def __init__(self, path: str, timeout: float):
+        self.path = path
+        self.timeout = timeout
+        self._writer = None
+        self._reader_task = None
+        self._pending = {}  # id -> asyncio.Future
+        self._ids = itertools.count()
+        self._lock = asyncio.Lock()
+
+    async def _connect(self):
+        async with self._lock:
+            if self._writer is None:
+                reader, self._writer = await asyncio.open_unix_connection(self.path, limit=2 ** 20)
+                self._reader_task = asyncio.create_task(self._read_replies(reader))
+
+    async def _read_replies(self, reader: asyncio.StreamReader):
+        try:
+            async for line in reader:
+                reply = json.loads(line)
+                future = self._pending.pop(reply['id'], None)
+                if future is None or future.done():
+                    continue
+                if 'error' in reply:
+                    future.set_exception(StateBackendError(reply['error']))
+                else:
+                    future.set_result(reply.get('result'))
+        except Exception as e:
+            logger.error(f"❌ Общее состояние: ошибка чтения ответа: {e}")
+        finally:
+            self._writer = None
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(StateBackendError("Соединение с общим состоянием закрыто"))
+            self._pending.clear()
+
+    async def call(self, namespace: str, op: str, *args):
+        await self._connect()
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        request = {'id': request_id, 'ns': namespace, 'op': op, 'args': args}
+        self._writer.write(json.dumps(request, ensure_ascii=False).encode('utf-8') + b"\n")
+        try:
+            return await asyncio.wait_for(future, self.timeout)
+        finally:
+            self._pending.pop(request_id, None)
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        if self._reader_task is not None:
+            await asyncio.gather(self._reader_task, return_exceptions=True)
+
+
+class StateServer:
+    """Отдаёт состояние InProcessStateBackend другим процессам по локальному сокету"""
+
+    def __init__(self, backend: InProcessStateBackend, path: str):
+        self.backend = backend
+        self.path = path
+        self._server = None
+
+    async def start(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._server = await asyncio.start_unix_server(self._handle, path=self.path, limit=2 ** 20)
+        logger.info(f"🗄️ Общее состояние доступно на {self.path}")
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            async for line in reader:
+                request = json.loads(line)
+                try:
+                    reply = {'id': request['id'], 'result': await self.backend.call(request['ns'], request['op'], *request['args'])}
+                except Exception as e:
+                    reply = {'id': request['id'], 'error': f"{type(e).__name__}: {e}"}
+                writer.write(json.dumps(reply, ensure_ascii=False).encode('utf-8') + b"\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+
+class SharedNamespace:
+    """
+    Пространство имён общего состояния с async-доступом независимо от бэкенда.
+    Если общее состояние недоступно, работает с состоянием этого процесса (fallback):
+    кулдаун и кэш действуют хотя бы в пределах шарда, а /rep не падает молча.
+    """
+
+    def __init__(self, backend, name: str, fallback=None):
+        self.backend = backend
+        self.name = name
+        self.fallback = fallback
+
+    async def call(self, op: str, *args):
+        if self.fallback is None or self.fallback is self.backend:
+            return await self.backend.call(self.name, op, *args)
+        try:
+            return await self.backend.call(self.name, op, *args)
+        except (StateBackendError, asyncio.TimeoutError, OSError) as e:
+            STATE_FALLBACKS.inc(namespace=self.name)
+            logger.warning(f"⚠️ Общее состояние недоступно ({self.name}.{op}: {type(e).__name__} {e}) - использую состояние процесса")
+            return await self.fallback.call(self.name, op, *args)
+
+    async def get(self, key, default=None):
+        value = await self.call('get', key)
+        return default if value is None else value
+
+    async def set(self, key, value, ttl: float = None):
+        await self.call('set', key, value, ttl)
+
+    async def pop(self, key):
+        return await self.call('pop', key, None)
+
+
+local_state = InProcessStateBackend({
+    'rep_cooldown': rep_cooldown,
+    'pending_bans': pending_bans,
+    'verdicts': verdict_cache
+})
+state_backend = SocketStateBackend(STATE_SOCKET, STATE_TIMEOUT) if STATE_BACKEND == "socket" else local_state
+shared_cooldowns = SharedNamespace(state_backend, 'rep_cooldown', local_state)
+shared_pending_bans = SharedNamespace(state_backend, 'pending_bans', local_state)
+shared_verdicts = SharedNamespace(state_backend, 'verdicts', local_state)
+
+
+def load_word_list(path: str, defaults=()) -> set:
+    """Читает список (по одному значению в строке, # - комментарий) и добавляет к значениям по умолчанию"""
+    words = {normalize_text(word) for word in defaults}
+    if path and os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                line = line.split("#", 1)[0].strip()
+                if line:
+                    words.add(normalize_text(line))
+    return words
+
+
+def compile_multi_pattern(patterns, prefix="", suffix=""):
+    """Один скомпилированный regex на весь список: длинные варианты раньше коротких"""
+    if not patterns:
+        return None
+    alternation = "|".join(re.escape(p) for p in sorted(patterns, key=len, reverse=True))
+    return re.compile(f"{prefix}(?:{alternation}){suffix}")
+
+
+DEFAULT_HARMLESS_WORDS = (
+    "привет", "прив", "ку", "хай", "пока", "да", "нет", "ок", "окей", "ага", "угу", "спасибо", "спс",
+    "лол", "кек", "ахах", "хаха", "ахахах", "хахаха", "ясно", "понятно", "норм", "круто", "класс",
+    "жиза", "реально", "согласен", "+", "++", "гг", "gg", "ok", "lol", "hi", "hello", "thanks", "yes", "no"
+)
+DEFAULT_PHISHING_KEYWORDS = (
+    "free nitro", "бесплатный nitro", "бесплатное nitro", "раздача nitro", "steam gift 50$"
+)
+
+# Рег. выражения для правила 1.11 (слив данных)
+ADDRESS_RE = re.compile(
+    r"(?:\b(?:ул(?:ица)?|пр(?:осп(?:ект)?|-т)?|пер(?:еулок)?|б-р|бульвар|шоссе|наб(?:ережная)?)\.?\s+"
+    r"[\w\-\. ]{2,40}?[,\s]+(?:д(?:ом)?\.?\s*)\d+[а-я]?)"
+    r"|(?:\bд(?:ом)?\.?\s*\d+[а-я]?[,\s]+(?:корп(?:ус)?\.?\s*\d+[,\s]+)?кв(?:артира)?\.?\s*\d+)",
+    re.IGNORECASE
+)
+PHONE_RE = re.compile(r"(?<!\d)(?:\+7|8)[\s\-(]*\d{3}[\s\-)]*\d{3}[\s\-]*\d{2}[\s\-]*\d{2}(?!\d)")
+_WORD_RE = re.compile(r"^[\w+!?.)(]+$")
+
+
+class PreFilter:
+    """
+    Быстрые правила перед ИИ. Возвращает вердикт {"action","duration","reason"}
+    для очевидных случаев или None, если решать должен ИИ.
+    """
+
+    def __init__(self, phishing_domains=(), phishing_keywords=(), harmless_words=(), repeat_threshold=3):
+        self.harmless_words = set(harmless_words)
+        self.repeat_threshold = repeat_threshold
+        # Домен совпадает целиком или как поддомен: evil.com, www.evil.com, http://evil.com/path
+        self._domain_re = compile_multi_pattern(
+            phishing_domains, prefix=r"(?<![\w\-])(?:[\w\-]+\.)*", suffix=r"(?![\w\-])"
+        )
+        self._keyword_re = compile_multi_pattern(phishing_keywords)
+
+    def check(self, text: str, context_messages=(), user_id=None):
+        normalized = normalize_text(text)
+
+        if self._domain_re is not None:
+            match = self._domain_re.search(normalized)
+            if match:
+                return {"action": "BAN", "duration": None, "reason": f"1.10 Фишинговая ссылка: {match.group(0)}"}
+        if self._keyword_re is not None:
+            match = self._keyword_re.search(normalized)
+            if match:
+                return {"action": "BAN", "duration": None, "reason": f"1.10 Фишинг: «{match.group(0)}»"}
+
+        if ADDRESS_RE.search(normalized):
+            return {"action": "BAN", "duration": None, "reason": "1.11 Слив данных: адрес"}
+        if PHONE_RE.search(normalized):
+            return {"action": "BAN", "duration": None, "reason": "1.11 Слив данных: номер телефона"}
+
+        repeats = self.count_repeats(normalized, context_messages, user_id)
+        if repeats >= self.repeat_threshold:
+            return {"action": "MUTE", "duration": 35, "reason": f"1.1 Флуд: одно и то же {repeats} раз подряд"}
+
+        if normalized in self.harmless_words or (
+            _WORD_RE.match(normalized) and normalized.strip("!?.)(") in self.harmless_words
+        ):
+            return {"action": "OK", "duration": None, "reason": "Безобидное сообщение"}
+
+        return None
+
+    @staticmethod
+    def count_repeats(normalized: str, context_messages=(), user_id=None) -> int:
+        """Сколько раз подряд автор отправил этот текст (включая проверяемое сообщение)"""
+        repeats = 1
+        for msg in reversed(context_messages):
+            if user_id is not None and msg.user_id != user_id:
+                continue
+            if normalize_text(msg.text) != normalized:
+                break
+            repeats += 1
+        return repeats
+
+
+prefilter = PreFilter(
+    phishing_domains=load_word_list(PHISHING_DOMAINS_FILE),
+    phishing_keywords=load_word_list(PHISHING_KEYWORDS_FILE, DEFAULT_PHISHING_KEYWORDS),
+    harmless_words=load_word_list(HARMLESS_WORDS_FILE, DEFAULT_HARMLESS_WORDS),
+    repeat_threshold=FLOOD_REPEAT_THRESHOLD
+)
+
+# Сколько вердиктов выдал каждый уровень
+verdict_tiers = {'prefilter': 0, 'cache': 0, 'llm': 0}
+
+# Для SimHash: байт хеша -> его 8 бит, разложенные по 16-битным «дорожкам» большого int,
+# так что счётчики всех 64 бит складываются одним сложением на байт
+_SIMHASH_LANE = 16
+_SIMHASH_TABLES = [
+    [sum(1 << (_SIMHASH_LANE * (8 * k + i)) for i in range(8) if byte >> i & 1) for byte in range(256)]
+    for k in range(8)
+]
+
+
+def simhash(text: str, max_shingles: int = SIMHASH_MAX_SHINGLES) -> int:
+    """64-битный SimHash по 3-граммам нормализованного текста: мелкие правки меняют мало бит"""
+    normalized = normalize_text(text)
+    hashes = [hash(normalized[i:i + 3]) & 0xFFFFFFFFFFFFFFFF for i in range(max(1, len(normalized) - 2))]
+    if len(hashes) > max_shingles:
+        # Для копипасты - одинаковая выборка у похожих текстов (наименьшие хеши)
+        hashes = heapq.nsmallest(max_shingles, hashes)
+    t0, t1, t2, t3, t4, t5, t6, t7 = _SIMHASH_TABLES
+    total = 0
+    for h in hashes:
+        total += (t0[h & 255] + t1[h >> 8 & 255] + t2[h >> 16 & 255] + t3[h >> 24 & 255]
+                  + t4[h >> 32 & 255] + t5[h >> 40 & 255] + t6[h >> 48 & 255] + t7[h >> 56])
+    half = len(hashes) // 2
+    lane_mask = (1 << _SIMHASH_LANE) - 1
+    fingerprint = 0
+    for bit in range(64):
+        if (total >> (_SIMHASH_LANE * bit)) & lane_mask > half:
+            fingerprint |= 1 << bit
+    return fingerprint
+
+
+class FloodSeries:
+    """Серия похожих сообщений: отпечаток, число повторов, время первого и последнего, авторы"""
+    __slots__ = ('fingerprint', 'count', 'first_at', 'last_at', 'users', 'muted')
+
+    def __init__(self, fingerprint: int, now: float, user_id: int):
+        self.fingerprint = fingerprint
+        self.count = 1
+        self.first_at = now
+        self.last_at = now
+        self.users = {user_id}
+        self.muted = False
+
+    @property
+    def span(self) -> float:
+        return self.last_at - self.first_at
+
+
+class FloodIndex:
+    """
+    Инкрементальный индекс почти-повторов. Отпечаток сообщения сравнивается
+    с несколькими последними сериями автора и чата (расстояние Хэмминга),
+    так что на сообщение уходит O(1) независимо от размера истории.
+    """
+
+    def __init__(self, window: float, max_distance: int, series_per_key: int = 8):
+        self.window = window
+        self.max_distance = max_distance
+        self.series_per_key = series_per_key
+        self.messages = 0
+        self.auto_mutes = 0
+        self._users = {}  # (chat_id, user_id) -> [FloodSeries], свежие первыми
+        self._chats = {}  # chat_id -> [FloodSeries]
+
+    def _find(self, series_list: list, fingerprint: int, now: float):
+        for index, series in enumerate(series_list):
+            if now - series.last_at <= self.window and bin(series.fingerprint ^ fingerprint).count("1") <= self.max_distance:
+                return index, series
+        return None, None
+
+    def _track(self, series_list: list, fingerprint: int, now: float, user_id: int) -> FloodSeries:
+        index, series = self._find(series_list, fingerprint, now)
+        if series is None:
+            series_list[:] = [item for item in series_list if now - item.last_at <= self.window]
+            series = FloodSeries(fingerprint, now, user_id)
+            series_list.insert(0, series)
+            del series_list[self.series_per_key:]
+            return series
+        series.count += 1
+        series.last_at = now
+        series.users.add(user_id)
+        if index:
+            series_list.insert(0, series_list.pop(index))
+        return series
+
+    def add(self, chat_id: int, user_id: int, text: str, now: float = None):
+        """Учитывает сообщение; возвращает (серию автора, серию чата)"""
+        now = time.monotonic() if now is None else now
+        fingerprint = simhash(text)
+        self.messages += 1
+        user_series = self._track(self._users.setdefault((chat_id, user_id), []), fingerprint, now, user_id)
+        chat_series = self._track(self._chats.setdefault(chat_id, []), fingerprint, now, user_id)
+        return user_series, chat_series
+
+    def describe(self, chat_id: int, user_id: int, text: str) -> str:
+        """Строка для контекста ИИ о повторах этого текста или пустая строка"""
+        now = time.monotonic()
+        fingerprint = simhash(text)
+        parts = []
+        _, user_series = self._find(self._users.get((chat_id, user_id), ()), fingerprint, now)
+        if user_series is not None and user_series.count >= 2:
+            parts.append(f"автор отправил похожее сообщение {user_series.count} раз за {user_series.span:.0f} с")
+        _, chat_series = self._find(self._chats.get(chat_id, ()), fingerprint, now)
+        if chat_series is not None and len(chat_series.users) >= 3:
+            parts.append(f"в чате похожее сообщение {chat_series.count} раз от {len(chat_series.users)} пользователей")
+        return f"📈 Повторы: {'; '.join(parts)}" if parts else ""
+
+    def forget_idle(self) -> int:
+        """Удаляет авторов и чаты без живых серий"""
+        now = time.monotonic()
+        removed = 0
+        for index in (self._users, self._chats):
+            for key in [key for key, series_list in index.items()
+                        if all(now - series.last_at > self.window for series in series_list)]:
+                del index[key]
+                removed += 1
+        return removed
+
+    def stats(self) -> dict:
+        return {'messages': self.messages, 'users': len(self._users), 'chats': len(self._chats), 'auto_mutes': self.auto_mutes}
+
+
+flood_index = FloodIndex(FLOOD_WINDOW, FLOOD_MAX_DISTANCE)
+
+
+async def get_verdict(text: str, context: str = "", context_messages=(), user_id=None, before_llm=None,
+                      related=(), flooding: bool = False):
+    """
+    Вердикт для сообщения: пре-фильтр, потом кэш, потом ИИ. Ошибки ИИ не кэшируются.
+    before_llm - корутина-функция, которую ждут только перед настоящим запросом к ИИ (бюджет вызовов).
+    related и flooding - то же, что попало в context (цепочка ответов и пометка о флуде), для ключа кэша.
+    """
+    if PREFILTER_ENABLED:
+        result = prefilter.check(text, context_messages, user_id)
+        if result is not None:
+            verdict_tiers['prefilter'] += 1
+            VERDICTS.inc(action=result['action'], tier='prefilter')
+            logger.info(f"🧹 Вердикт пре-фильтра: {result['action']} - {result['reason']}")
+            return result
+
+    key = verdict_cache.make_key(text, context_messages, related, flooding)
+    cached = await shared_verdicts.get(key)
+    if cached is not None:
+        verdict_tiers['cache'] += 1
+        VERDICTS.inc(action=cached.get('action', 'ERROR'), tier='cache')
+        logger.info(f"⚡ Вердикт из кэша: {cached.get('action')}")
+        return cached
+
+    if before_llm is not None:
+        await before_llm()
+    verdict_tiers['llm'] += 1
+    if LLM_BATCH_ENABLED:
+        result = await llm_batcher.submit(text, context)
+    else:
+        result = await check_with_ai(text, context)
+    VERDICTS.inc(action=result.get('action', 'ERROR'), tier='llm')
+    if result.get("action") in ("MUTE", "BAN", "WARN", "OK"):
+        await shared_verdicts.call('put', key, result, text)
+    return result
+
+
+def openrouter_headers() -> dict:
+    return {
+        "Authorization": f"Bearer {OPENROUTER_KEY}",
+        "HTTP-Referer": "https://github.com",
+        "X-Title": "Report Bot",
+        "Content-Type": "application/json; charset=utf-8"
+    }
+
+
+def system_message(*extra: str) -> dict:
+    """
+    Системное сообщение: статичный SYSTEM_PROMPT идёт первым блоком и помечается
+    cache_control, чтобы провайдеры с кэшем промпта (Anthropic, Gemini через OpenRouter)
+    не тарифицировали его каждый раз. OpenAI/DeepSeek кэшируют одинаковый префикс сами.
+    """
+    if not PROMPT_CACHE:
+        return {"role": "system", "content": "".join((SYSTEM_PROMPT, *extra))}
+    parts = [{"type": "text", "text": SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}}]
+    parts += [{"type": "text", "text": text} for text in extra]
+    return {"role": "system", "content": parts}
+
+
+class CircuitBreaker:
+    """
+    Размыкается, когда в последних window вызовах много ошибок или p90 задержки
+    слишком высок. Через cooldown пропускает один пробный запрос (half-open).
+    """
+
+    def __init__(self, window: int, min_calls: int, error_rate: float, slow_seconds: float, cooldown: float):
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_seconds = slow_seconds
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.opened_at = 0.0
+        self._calls = deque(maxlen=window)  # (ok, seconds)
+
+    def is_available(self) -> bool:
+        """Можно ли выбрать бэкенд (без побочных эффектов: пробный запрос здесь не занимается)"""
+        if self.state == "closed":
+            return True
+        return self.state == "open" and time.monotonic() - self.opened_at >= self.cooldown
+
+    def allow(self) -> bool:
+        """Вызывается перед реальной отправкой запроса; после cooldown занимает единственный пробный запрос"""
+        if self.state == "closed":
+            return True
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.cooldown:
+            self.state = "half_open"
+            return True
+        return False
+
+    def claim_probe(self) -> bool:
+        """allow() для уходящего запроса: True, если именно он стал пробным"""
+        return self.state == "open" and self.allow()
+
+    def release_probe(self):
+        """Пробный запрос отменён, результата нет - снова open, следующий запрос станет пробным"""
+        if self.state == "half_open":
+            self.state = "open"
+
+    def record(self, ok: bool, seconds: float):
+        if self.state == "half_open":
+            if ok:
+                self.state = "closed"
+                self._calls.clear()
+            else:
+                self._open()
+            return
+        self._calls.append((ok, seconds))
+        if len(self._calls) < self.min_calls:
+            return
+        errors = sum(1 for call_ok, _ in self._calls if not call_ok)
+        latencies = sorted(seconds for _, seconds in self._calls)
+        p90 = latencies[int(len(latencies) * 0.9) - 1]
+        if errors / len(self._calls) >= self.error_rate or p90 > self.slow_seconds:
+            self._open()
+
+    def _open(self):
+        self.state = "open"
+        self.opened_at = time.monotonic()
+
+
+class LLMBackend:
+    """Модель + эндпоинт со своей статистикой задержек и предохранителем"""
+
+    def __init__(self, model: str, url: str):
+        self.model = model
+        self.url = url
+        self.name = model if url == OPENROUTER_URL else f"{model}@{url}"
+        self.breaker = CircuitBreaker(BREAKER_WINDOW, BREAKER_MIN_CALLS, BREAKER_ERROR_RATE,
+                                      BREAKER_SLOW_SECONDS, BREAKER_COOLDOWN)
+        self.errors = 0
+        self.wins = 0
+        self._recent = deque(maxlen=200)
+
+    def record(self, ok: bool, seconds: float):
+        self.breaker.record(ok, seconds)
+        if not ok:
+            self.errors += 1
+            AI_ERRORS.inc(backend=self.name)
+            return
+        self._recent.append(seconds)
+        LLM_SECONDS.observe(seconds, backend=self.name)
+
+    def p90(self):
+        if len(self._recent) < BREAKER_MIN_CALLS:
+            return None
+        latencies = sorted(self._recent)
+        return latencies[int(len(latencies) * 0.9) - 1]
+
+
+def parse_backends(spec: str) -> list:
+    backends = []
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        model, _, url = item.partition("@")
+        backends.append(LLMBackend(model, url or OPENROUTER_URL))
+    return backends or [LLMBackend(OPENROUTER_MODEL, OPENROUTER_URL)]
+
+
+llm_backends = parse_backends(LLM_BACKENDS)
+
+
+def available_backends() -> list:
+    """Бэкенды с замкнутым предохранителем; если разомкнуты все - пробуем все по порядку"""
+    return [backend for backend in llm_backends if backend.breaker.is_available()] or list(llm_backends)
+
+
+class OpenRouterError(Exception):
+    pass
+
+
+def completion_payload(messages: list, max_tokens: int = 500, stream: bool = False, model: str = None) -> dict:
+    data = {
+        "model": model or OPENROUTER_MODEL,
+        "messages": messages,
+        "temperature": 0.3,
+        "max_tokens": max_tokens,
+        "usage": {"include": True}
+    }
+    if stream:
+        data["stream"] = True
+    return data
+
+
+async def post_completion(messages: list, max_tokens: int = 500, backend: LLMBackend = None):
+    """Один запрос chat/completions через общий клиент"""
+    backend = backend or llm_backends[0]
+    response = await get_http_client().post(
+        backend.url,
+        headers=openrouter_headers(),
+        json=completion_payload(messages, max_tokens, model=backend.model)
+    )
+    logger.info(f"📡 Статус ответа: {response.status_code} ({response.http_version})")
+    return response
+
+
+def parse_ai_json(ai_response: str):
+    """Убирает markdown-обёртку и парсит JSON из ответа модели"""
+    clean_json = ai_response.replace("```json", "").replace("```", "").strip()
+    return json.loads(clean_json)
+
+
+# Токены и задержка на вердикт: одиночные запросы против пакетных
+llm_stats = {
+    mode: {'requests': 0, 'verdicts': 0, 'tokens': 0, 'prompt_tokens': 0, 'completion_tokens': 0,
+           'cached_tokens': 0, 'seconds': 0.0, 'estimated': 0}
+    for mode in ('single', 'batch')
+}
+
+
+def record_llm_usage(mode: str, verdicts: int, usage: dict, seconds: float):
+    usage = usage or {}
+    prompt_tokens = usage.get('prompt_tokens', 0)
+    completion_tokens = usage.get('completion_tokens', 0)
+    cached_tokens = (usage.get('prompt_tokens_details') or {}).get('cached_tokens', 0)
+    stats = llm_stats[mode]
+    stats['requests'] += 1
+    stats['verdicts'] += verdicts
+    stats['tokens'] += usage.get('total_tokens', prompt_tokens + completion_tokens)
+    stats['prompt_tokens'] += prompt_tokens
+    stats['completion_tokens'] += completion_tokens
+    stats['cached_tokens'] += cached_tokens
+    stats['seconds'] += seconds
+    if usage.get('estimated'):
+        stats['estimated'] += 1
+        logger.info(f"🧮 Токены (оценка, поток оборван): промпт ~{prompt_tokens}, ответ ~{completion_tokens}")
+    elif usage:
+        logger.info(f"🧮 Токены: промпт {prompt_tokens} (из кэша {cached_tokens}), ответ {completion_tokens}")
+    else:
+        logger.warning("⚠️ В ответе нет usage - токены и стоимость не учтены")
+
+
+# Потоковый режим: время до вердикта отдельно от полного времени ответа
+stream_stats = {'requests': 0, 'early': 0, 'ttv_seconds': 0.0, 'completed': 0, 'total_seconds': 0.0}
+
+_json_decoder = json.JSONDecoder()
+VERDICT_FIELDS = ("action", "duration", "reason")
+
+
+class VerdictStreamParser:
+    """
+    Инкрементальный разбор JSON-вердикта из кусков потока. Поле считается готовым,
+    только когда за значением уже пришёл следующий символ (',' или '}'),
+    чтобы не принять обрезанное число "3" из "35".
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.fields = {}
+        self._pos = None  # позиция внутри объекта, None - '{' ещё не встретилась
+        self._done = False
+
+    def _skip_spaces(self, pos: int) -> int:
+        while pos < len(self.buffer) and self.buffer[pos] in " \t\r\n":
+            pos += 1
+        return pos
+
+    def feed(self, chunk: str):
+        """Возвращает вердикт, как только action, duration и reason готовы (или объект закрылся)"""
+        if self._done:
+            return None
+        self.buffer += chunk
+        if self._pos is None:
+            start = self.buffer.find("{")
+            if start < 0:
+                return None
+            self._pos = start + 1
+
+        while True:
+            pos = self._skip_spaces(self._pos)
+            if pos >= len(self.buffer):
+                return None
+            if self.buffer[pos] == "}":
+                return self._finish()
+            if self.buffer[pos] == ",":
+                self._pos = pos + 1
+                continue
+            try:
+                key, pos = _json_decoder.raw_decode(self.buffer, pos)
+                pos = self._skip_spaces(pos)
+                if pos >= len(self.buffer) or self.buffer[pos] != ":":
+                    return None
+                value, pos = _json_decoder.raw_decode(self.buffer, self._skip_spaces(pos + 1))
+            except json.JSONDecodeError:
+                return None
+            pos = self._skip_spaces(pos)
+            if pos >= len(self.buffer):
+                return None
+            self.fields[key] = value
+            self._pos = pos
+            if all(field in self.fields for field in VERDICT_FIELDS):
+                return self._finish()
+
+    def _finish(self):
+        self._done = True
+        return dict(self.fields) if "action" in self.fields else None
+
+
+def estimate_usage(messages: list, content: str) -> dict:
+    """Грубая оценка токенов (~4 символа на токен), когда поток закрыт раньше куска с usage"""
+    prompt_chars = 0
+    for message in messages:
+        content_parts = message['content']
+        if isinstance(content_parts, str):
+            prompt_chars += len(content_parts)
+        else:
+            prompt_chars += sum(len(part.get('text', '')) for part in content_parts)
+    prompt_tokens = prompt_chars // 4
+    completion_tokens = len(content) // 4
+    return {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens, 'estimated': True}
+
+
+async def stream_verdict(messages: list, started: float, backend: LLMBackend):
+    """
+    Читает ответ потоком и возвращается, как только вердикт готов; остаток ответа
+    не дочитывается - закрытие соединения останавливает генерацию, токены оцениваются
+    """
+    data = completion_payload(messages, stream=True, model=backend.model)
+    parser = VerdictStreamParser()
+    content = ""
+    usage = None
+    stream_stats['requests'] += 1
+    client = get_http_client()
+    response = await client.send(
+        client.build_request("POST", backend.url, headers=openrouter_headers(), json=data), stream=True
+    )
+    try:
+        logger.info(f"📡 Статус ответа (поток, {backend.name}): {response.status_code} ({response.http_version})")
+        if response.status_code != 200:
+            body = (await response.aread()).decode("utf-8", "replace")
+            logger.error(f"❌ Статус: {response.status_code}, Ответ: {body}")
+            raise OpenRouterError(f"OpenRouter ошибка {response.status_code}")
+
+        async for line in response.aiter_lines():
+            # SSE: полезные строки начинаются с "data:", остальное - комментарии/keep-alive
+            if not line.startswith("data:"):
+                continue
+            payload = line[5:].strip()
+            if payload == "[DONE]":
+                break
+            chunk = json.loads(payload)
+            usage = chunk.get("usage") or usage
+            choices = chunk.get("choices") or []
+            delta = (choices[0].get("delta") or {}).get("content") if choices else None
+            if not delta:
+                continue
+            content += delta
+            verdict = parser.feed(delta)
+            if verdict is not None:
+                ttv = time.monotonic() - started
+                stream_stats['early'] += 1
+                stream_stats['ttv_seconds'] += ttv
+                logger.info(f"📥 Вердикт из потока за {ttv:.2f}с (остаток ответа отброшен): {content}")
+                record_llm_usage('single', 1, usage or estimate_usage(messages, content), ttv)
+                return verdict
+    finally:
+        await response.aclose()
+
+    # Поток закончился, а вердикт так и не собрался - разбираем целиком, как раньше
+    total = time.monotonic() - started
+    stream_stats['completed'] += 1
+    stream_stats['ttv_seconds'] += total
+    stream_stats['total_seconds'] += total
+    record_llm_usage('single', 1, usage, total)
+    logger.info(f"📥 Ответ OpenRouter (поток, {total:.2f}с): {content}")
+    return parse_ai_json(content)
+
+
+async def request_verdict(backend: LLMBackend, messages: list) -> dict:
+    """Одна попытка на одном бэкенде; при ошибке или негодном ответе - исключение"""
+    started = time.monotonic()
+    # Пробный запрос занимается только здесь, когда запрос действительно уходит
+    probe = backend.breaker.claim_probe()
+    try:
+        if OPENROUTER_STREAM:
+            result = await stream_verdict(messages, started, backend)
+        else:
+            response = await post_completion(messages, backend=backend)
             if response.status_code != 200:
                 logger.error(f"❌ Статус: {response.status_code}, Ответ: {response.text}")
-                return {"action": "ERROR", "reason": f"OpenRouter ошибка {response.status_code}"}
-            
+                raise OpenRouterError(f"OpenRouter ошибка {response.status_code}")
+
             result_data = response.json()
-            
-        # Извлекаем текст ответа
-        ai_response = result_data['choices'][0]['message']['content']
-        logger.info(f"📥 Ответ OpenRouter: {ai_response}")
+            record_llm_usage('single', 1, result_data.get('usage'), time.monotonic() - started)
+
+            # Извлекаем текст ответа
+            ai_response = result_data['choices'][0]['message']['content']
+            logger.info(f"📥 Ответ OpenRouter ({backend.name}): {ai_response}")
+
+            # Парсим JSON
+            result = parse_ai_json(ai_response)
+        if not isinstance(result, dict) or result.get("action") not in ("MUTE", "BAN", "WARN", "OK"):
+            raise OpenRouterError(f"Некорректный вердикт от {backend.name}: {result}")
+    except asyncio.CancelledError:
+        # Проиграл в хедже - это не ошибка бэкенда
+        if probe:
+            backend.breaker.release_probe()
+        raise
+    except Exception:
+        backend.record(False, time.monotonic() - started)
+        raise
+    backend.record(True, time.monotonic() - started)
+    return result
+
+
+def hedge_delay(backend: LLMBackend) -> float:
+    if HEDGE_DELAY != "p90":
+        return float(HEDGE_DELAY)
+    p90 = backend.p90()
+    return HEDGE_DEFAULT_DELAY if p90 is None else max(HEDGE_MIN_DELAY, p90)
+
+
+async def hedged_verdict(messages: list) -> dict:
+    """
+    Запрос к первому доступному бэкенду; если он не ответил за hedge_delay (или упал),
+    параллельно запускается следующий. Побеждает первый корректный вердикт.
+    """
+    candidates = available_backends()
+    running = {}  # task -> backend
+    last_error = None
+    try:
+        while candidates or running:
+            if candidates and (not running or HEDGE_ENABLED):
+                backend = candidates.pop(0)
+                if running:
+                    logger.warning(f"🪁 Хедж: {backend.name} запущен параллельно")
+                running[asyncio.create_task(request_verdict(backend, messages))] = backend
+                first = next(iter(running.values()))
+                timeout = hedge_delay(first) if candidates and HEDGE_ENABLED else None
+            else:
+                timeout = None
+
+            done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                backend = running.pop(task)
+                try:
+                    result = task.result()
+                except Exception as e:
+                    last_error = e
+                    logger.error(f"❌ {backend.name}: {e}")
+                    continue
+                backend.wins += 1
+                return result
+    finally:
+        for task in running:
+            task.cancel()
+    raise last_error or OpenRouterError("Нет доступных моделей")
+
+
+async def check_with_ai(text: str, context: str = ""):
+    try:
+        full_request = f"Текст для проверки: {text}"
+        if context:
+            full_request = f"Контекст:\n{context}\n\n{full_request}"
         
-        # Парсим JSON
-        clean_json = ai_response.replace("```json", "").replace("```", "").strip()
-        result = json.loads(clean_json)
-        return result
+        logger.info(f"📤 Запрос к OpenRouter: {text[:100]}...")
+        logger.info(f"📡 Отправляю в OpenRouter с контекстом...")
         
+        messages = [
+            system_message(),
+            {"role": "user", "content": full_request}
+        ]
+        return await hedged_verdict(messages)
+        
+    except OpenRouterError as e:
+        return {"action": "ERROR", "reason": str(e)}
     except Exception as e:
         logger.error(f"❌ Ошибка OpenRouter: {e}")
         import traceback
         logger.error(traceback.format_exc())
         return {"action": "ERROR", "reason": f"Ошибка ИИ: {e}"}
 
-@dp.message(Command("rep"))
-async def report_command(message: types.Message):
-    user_id = message.from_user.id
-    
-    # Проверяем кулдаун
-    if user_id in rep_cooldown:
-        time_passed = (datetime.now() - rep_cooldown[user_id]).total_seconds()
-        if time_passed < 30:
-            time_left = 30 - time_passed
-            logger.warning(f"⏱️ КУЛДАУН: {message.from_user.first_name} попытался использовать /rep (осталось {time_left:.1f}с)")
-            await message.reply(f"⏱️ Подождите {time_left:.1f} сек перед следующим /rep")
-            return
-    
-    # Кулдаун истёк или пользователя нет - устанавливаем новый
-    rep_cooldown[user_id] = datetime.now()
-    
-    # Проверяем что это в разрешённом чате
-    if message.chat.id != ALLOWED_CHAT_ID:
-        logger.warning(f"⚠️ Попытка использовать /rep в чате {message.chat.id} (разрешён только {ALLOWED_CHAT_ID})")
-        await message.reply("❌ Эта команда работает только в определённом чате")
-        return
-    
-    # Проверяем что это ответ на сообщение
-    if not message.reply_to_message:
-        logger.warning(f"⚠️ {message.from_user.first_name} вызвал /rep не на сообщение")
-        await message.reply("❌ Используй /rep в ответ на сообщение")
-        return
 
-    replied_msg = message.reply_to_message
-    reporter = message.from_user.first_name
+BATCH_INSTRUCTIONS = """
+Сейчас тебе пришлют НЕСКОЛЬКО НЕЗАВИСИМЫХ случаев, каждый начинается с [номер].
+Проверь каждый отдельно по правилам выше, контекст одного случая не относится к другим.
+Отвечай ТОЛЬКО JSON-массивом, по одному объекту на каждый случай:
+[{"id": номер, "action": "MUTE/BAN/WARN/OK", "duration": число_или_null, "reason": "причина"}]
+"""
+
+
+class LLMBatcher:
+    """
+    Собирает проверки за короткое окно (или до max_items штук) и отправляет их
+    одним запросом. Случаи, для которых модель вернула битый ответ, перепроверяются по одному.
+    """
+
+    def __init__(self, window: float, max_items: int):
+        self.window = window
+        self.max_items = max_items
+        self._pending = []  # (text, context, future, submitted_at)
+        self._timer = None
+        self._tasks = set()
+
+    async def submit(self, text: str, context: str = ""):
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((text, context, future, time.monotonic()))
+        if len(self._pending) >= self.max_items:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.create_task(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: list):
+        if len(batch) == 1:
+            text, context, future, _ = batch[0]
+            result = await check_with_ai(text, context)
+            if not future.done():
+                future.set_result(result)
+            return
+
+        verdicts = {}
+        backend = None
+        started = time.monotonic()
+        try:
+            cases = []
+            for i, (text, context, _, _) in enumerate(batch, 1):
+                case = f"[{i}]\n"
+                if context:
+                    case += f"Контекст:\n{context}\n\n"
+                cases.append(case + f"Текст для проверки: {text}")
+
+            logger.info(f"📦 Пакетный запрос к OpenRouter: {len(batch)} случаев")
+            # Тот же выбор бэкенда и тот же предохранитель, что у одиночных запросов
+            backend = available_backends()[0]
+            probe = backend.breaker.claim_probe()
+            try:
+                response = await post_completion([
+                    system_message(BATCH_INSTRUCTIONS),
+                    {"role": "user", "content": "\n\n".join(cases)}
+                ], max_tokens=200 * len(batch), backend=backend)
+            except asyncio.CancelledError:
+                if probe:
+                    backend.breaker.release_probe()
+                raise
+
+            if response.status_code != 200:
+                logger.error(f"❌ Пакет: статус {response.status_code}, Ответ: {response.text}")
+                backend.record(False, time.monotonic() - started)
+                backend = None
+            else:
+                result_data = response.json()
+                ai_response = result_data['choices'][0]['message']['content']
+                logger.info(f"📥 Пакетный ответ OpenRouter: {ai_response}")
+                parsed = parse_ai_json(ai_response)
+                for item in parsed if isinstance(parsed, list) else []:
+                    if isinstance(item, dict) and item.get("action") in ("MUTE", "BAN", "WARN", "OK"):
+                        verdicts[item.get("id")] = {
+                            "action": item["action"],
+                            "duration": item.get("duration"),
+                            "reason": item.get("reason", "")
+                        }
+                now = time.monotonic()
+                resolved = [i for i in range(1, len(batch) + 1) if i in verdicts]
+                # Пакет без единого годного вердикта - ошибка бэкенда
+                backend.record(bool(resolved), now - started)
+                if resolved:
+                    backend.wins += 1
+                backend = None
+                record_llm_usage('batch', len(resolved), result_data.get('usage'),
+                                 sum(now - batch[i - 1][3] for i in resolved))
+                logger.info(f"📦 Пакет: {len(resolved)}/{len(batch)} вердиктов за {now - started:.2f}с")
+        except Exception as e:
+            if backend is not None:
+                backend.record(False, time.monotonic() - started)
+            logger.error(f"❌ Ошибка пакетного запроса: {e}")
+
+        retries = []
+        for i, (text, context, future, _) in enumerate(batch, 1):
+            if future.done():
+                continue
+            if i in verdicts:
+                future.set_result(verdicts[i])
+            else:
+                retries.append((text, context, future))
+
+        # Битые или пропущенные ответы - перепроверяем по одному
+        if retries:
+            logger.warning(f"⚠️ Пакет: {len(retries)} случаев перепроверяются по одному")
+            results = await asyncio.gather(*(check_with_ai(text, context) for text, context, _ in retries))
+            for (_, _, future), result in zip(retries, results):
+                if not future.done():
+                    future.set_result(result)
+
+
+llm_batcher = LLMBatcher(LLM_BATCH_WINDOW, LLM_BATCH_MAX)
+
+@dp.message(Command("rep"))
+async def report_command(message: types.Message):
+    started = time.monotonic()
+    user_id = message.from_user.id
+    
+    # Проверяем кулдаун
+    last_rep = await shared_cooldowns.get(user_id)
+    if last_rep is not None:
+        time_passed = time.time() - last_rep
+        if time_passed < REP_COOLDOWN:
+            time_left = REP_COOLDOWN - time_passed
+            logger.warning(f"⏱️ КУЛДАУН: {message.from_user.first_name} попытался использовать /rep (осталось {time_left:.1f}с)")
+            await message.reply(f"⏱️ Подождите {time_left:.1f} сек перед следующим /rep")
+            return
+    
+    # Кулдаун истёк или пользователя нет - устанавливаем новый
+    await shared_cooldowns.set(user_id, time.time())
+    
+    # Проверяем что это в разрешённом чате
+    if message.chat.id not in CHAT_ADMINS:
+        logger.warning(f"⚠️ Попытка использовать /rep в чате {message.chat.id} (разрешены только {', '.join(map(str, CHAT_ADMINS))})")
+        await message.reply("❌ Эта команда работает только в определённом чате")
+        return
+    
+    # Проверяем что это ответ на сообщение
+    if not message.reply_to_message:
+        logger.warning(f"⚠️ {message.from_user.first_name} вызвал /rep не на сообщение")
+        await message.reply("❌ Используй /rep в ответ на сообщение")
+        return
+
+    replied_msg = message.reply_to_message
+    reporter = message.from_user.first_name
+
+    # Если это сообщение уже проверяется - присоединяемся к идущей проверке,
+    # вердикт и наказание применяются только один раз
+    report_key = (replied_msg.chat.id, replied_msg.message_id)
+    pending = inflight_reports.get(report_key)
+    if pending is not None:
+        logger.info(f"🔗 {reporter} присоединился к проверке сообщения {replied_msg.message_id}")
+        result = await asyncio.shield(pending)
+        text_to_check = replied_msg.text or replied_msg.caption or "[медиа без текста]"
+        log_reported(result, replied_msg.from_user, text_to_check, reporter)
+        return
+
+    inflight = asyncio.get_running_loop().create_future()
+    inflight_reports[report_key] = inflight
+    try:
+        await process_report(replied_msg, reporter, inflight, started, reporter_id=user_id,
+                             deadline=Deadline(REP_DEADLINE, "rep", started))
+    finally:
+        if not inflight.done():
+            inflight.set_result({"action": "ERROR", "reason": "Проверка прервана"})
+        inflight_reports.pop(report_key, None)
+
+
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка без токенайзера: ~3 символа на токен для смеси кириллицы и латиницы"""
+    return len(text) // 3 + 1
+
+
+def truncate_text(text: str, max_chars: int) -> str:
+    return text if len(text) <= max_chars else text[:max_chars - 1] + "…"
+
+
+def build_context(context_messages: list, target_user: str, text_to_check: str,
+                  budget: int = CONTEXT_TOKEN_BUDGET, max_chars: int = CONTEXT_MESSAGE_MAX_CHARS,
+                  related=(), max_messages: int = CONTEXT_MESSAGES) -> str:
+    """
+    Собирает историю диалога в пределах бюджета токенов и числа сообщений.
+    Сначала берутся связанные сообщения (related, по важности), остаток
+    заполняется по времени от новых к старым; длинные сообщения обрезаются.
+    В подсказке всё идёт по порядку, ответы помечены стрелкой.
+    """
+    by_id = {msg.message_id: msg for msg in itertools.chain(context_messages, related)}
+    chosen = {}  # message_id -> строка
+    used = 0
+    related_count = 0
+    for is_related, msg in itertools.chain(((True, msg) for msg in related), ((False, msg) for msg in reversed(context_messages))):
+        if len(chosen) >= max_messages:
+            break
+        if msg.message_id in chosen:
+            continue
+        parent = by_id.get(msg.reply_to) if msg.reply_to else None
+        author = f"{msg.username} → {parent.username}" if parent is not None else msg.username
+        line = f"{author}: {truncate_text(msg.text, max_chars)}\n"
+        cost = estimate_tokens(line)
+        if used + cost > budget:
+            if is_related:
+                continue
+            break
+        chosen[msg.message_id] = line
+        used += cost
+        related_count += is_related
+    lines = [chosen[message_id] for message_id in sorted(chosen)]
+
+    if not lines:
+        return f"Сообщение от {target_user}: {text_to_check}"
+    logger.info(f"📜 Контекст собран: {len(lines)} сообщений (связанных {related_count}), ~{used} токенов")
+    return (
+        "📜 История диалога перед этим сообщением:\n"
+        + "".join(lines)
+        + f"\n⚠️ Проверяемое сообщение:\n{target_user}: {text_to_check}"
+    )
+
+
+def mute_minutes(duration) -> int:
+    """Длительность мута из вердикта: null, строка или мусор от ИИ - срок по умолчанию"""
+    try:
+        minutes = float(duration)
+    except (TypeError, ValueError):
+        return MUTE_DEFAULT_MINUTES
+    if not minutes > 0:
+        return MUTE_DEFAULT_MINUTES
+    return max(1, round(min(minutes, MUTE_MAX_MINUTES)))
+
+
+def log_reported(result: dict, target, text_to_check: str, reporter: str,
+                 context: str = None, context_messages=()):
+    """
+    Пишет жалобу в журнал reported сообщений (только для MUTE/BAN/WARN).
+    Контекст, с которым выносился вердикт, сохраняется для reevaluate.py.
+    """
+    label = {"MUTE": "MUTE", "BAN": "REPORTED", "WARN": "WARN"}.get(result.get("action"))
+    if label is None:
+        return
+    reason = result.get('reason', '')
+    audit = {
+        'label': label,
+        'action': result.get('action'),
+        'duration': result.get('duration'),
+        'user': target.first_name,
+        'user_id': target.id,
+        'text': text_to_check,
+        'reason': reason,
+        'reporter': reporter
+    }
+    if context is not None:
+        audit['context'] = context
+        audit['context_messages'] = [[msg.message_id, msg.user_id, msg.username, msg.text, msg.reply_to]
+                                     for msg in context_messages]
+    reported_logger.info(
+        f"{label} | Пользователь: {target.first_name} ({target.id}) | Сообщение: {text_to_check} | Причина: {reason} | От кого: {reporter}",
+        extra={'audit': audit}
+    )
+
+
+class SideEffects:
+    """
+    Побочные действия после вердикта как маленький граф зависимостей: действие
+    стартует, когда готовы его зависимости, независимые идут параллельно.
+    Ошибка действия затрагивает только зависящие от него.
+    """
+
+    def __init__(self, timeout: float = None):
+        self.timeout = timeout  # на каждое действие; не успевшее падает с TimeoutError
+        self._tasks = {}  # имя -> asyncio.Task
+
+    def add(self, name: str, func, after=()):
+        """func получает результаты зависимостей в порядке after"""
+        deps = [self._tasks[dep] for dep in after]
+
+        async def run():
+            results = await asyncio.gather(*deps)
+            with stage(name):
+                return await asyncio.wait_for(func(*results), self.timeout)
+
+        self._tasks[name] = asyncio.create_task(run())
+
+    async def wait(self) -> dict:
+        """Дожидается всех действий; возвращает {имя: исключение} для упавших"""
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+        return {name: task.exception() for name, task in self._tasks.items() if task.exception() is not None}
+
+    def result(self, name: str):
+        task = self._tasks.get(name)
+        if task is None or not task.done() or task.exception() is not None:
+            return None
+        return task.result()
+
+
+class Deadline:
+    """Общий срок обработки команды: этапы берут остаток, первый сорвавший срок этап засчитывается"""
+
+    def __init__(self, seconds: float, command: str, started: float = None):
+        started = time.monotonic() if started is None else started
+        self.expires_at = started + seconds if seconds > 0 else None
+        self.command = command
+        self.missed_stage = None
+
+    def remaining(self):
+        """Сколько осталось (None - срока нет)"""
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def miss(self, stage_name: str):
+        if self.missed_stage is None:
+            self.missed_stage = stage_name
+            DEADLINE_MISSES.inc(command=self.command, stage=stage_name)
+            logger.warning(f"⏰ /{self.command}: общий срок {REP_DEADLINE:.0f}с превышен на этапе {stage_name}")
+
+    def check(self, stage_name: str) -> bool:
+        """Засчитывает промах этапу, если срок уже вышел"""
+        if self.expires_at is not None and time.monotonic() > self.expires_at:
+            self.miss(stage_name)
+            return True
+        return False
+
+    async def run(self, coro, stage_name: str):
+        """Выполняет корутину не дольше остатка срока; не успела - промах и asyncio.TimeoutError"""
+        remaining = self.remaining()
+        if remaining is None:
+            return await coro
+        try:
+            return await asyncio.wait_for(coro, remaining)
+        except asyncio.TimeoutError:
+            self.miss(stage_name)
+            raise
+
+    async def wait(self, task: asyncio.Task, stage_name: str) -> bool:
+        """Ждёт задачу не дольше остатка срока (задача не отменяется); False - не успела"""
+        done, _ = await asyncio.wait({task}, timeout=self.remaining())
+        if not done:
+            self.miss(stage_name)
+        return bool(done)
+
+
+async def send_ban_confirmation(chat_id: int, admin_chat_id: int, target_user: str, target_id: int,
+                                reason: str, reporter: str, text_to_check: str,
+                                title: str = "🚫 ТРЕБУЕТСЯ ПОДТВЕРЖДЕНИЕ BAN"):
+    """Заявка на BAN в админ-чат (фоновая задача, повторяется при ошибках)"""
+    ban_confirm_text = f"{title}\n\n👤 Пользователь: {target_user} ({target_id})\n📝 Причина: {reason}\n💬 От кого: {reporter}\n📋 Сообщение: {text_to_check}"
+    keyboard = InlineKeyboardMarkup(
+        inline_keyboard=[[
+            InlineKeyboardButton(text="✅ Подтвердить BAN", callback_data=f"confirm_ban_{target_id}_{chat_id}"),
+            InlineKeyboardButton(text="❌ Отменить", callback_data=f"cancel_ban_{target_id}_{chat_id}")
+        ]]
+    )
+    msg = await bot.send_message(chat_id=admin_chat_id, text=ban_confirm_text, reply_markup=keyboard)
+    logger.info(f"📤 BAN отправлен на подтверждение админам")
+
+    # Сохраняем в pending_bans (общие для всех шардов: подтверждение приходит из админ-чата)
+    key = member_key(chat_id, target_id)
+    pending = {
+        'chat_id': chat_id,
+        'target_id': target_id,
+        'reason': reason,
+        'message_id': msg.message_id,
+        'admin_chat_id': admin_chat_id
+    }
+    try:
+        await shared_pending_bans.set(key, pending)
+    except Exception as e:
+        # Заявка уже у админов: повтор всей задачи прислал бы её второй раз, поэтому повторяется только запись
+        logger.warning(f"⚠️ Не удалось сохранить заявку на BAN, повторим отдельно: {type(e).__name__} {e}")
+        background_jobs.submit("pending_ban", lambda: shared_pending_bans.set(key, pending))
+
+
+async def report_late_verdict(verdict_task: asyncio.Task, admin_chat_id: int, target_user: str, target_id: int,
+                              started: float, title: str):
+    """Дожидается ИИ после срыва срока и присылает вердикт админам"""
+    result = await verdict_task
+    text = (
+        f"{title} ({time.monotonic() - started:.0f}с)\n\n"
+        f"👤 Пользователь: {target_user} ({target_id})\n"
+        f"⚙️ Действие: {result.get('action', 'ERROR')}\n"
+        f"⏱️ Длительность: {result.get('duration', 0)} мин\n"
+        f"📋 Причина: {result.get('reason', '')}"
+    )
+    background_jobs.submit("late_verdict", lambda: bot.send_message(chat_id=admin_chat_id, text=text))
+    logger.info(f"🤖 Запоздавший вердикт для {target_user}: {result.get('action')}")
+
+
+def submit_review_request(replied_msg: types.Message, reporter: str, note: str):
+    """Дело - админам с кнопками BAN через фоновую очередь (не ждёт Telegram)"""
+    target_user = replied_msg.from_user.first_name
+    target_id = replied_msg.from_user.id
+    text_to_check = replied_msg.text or replied_msg.caption or "[медиа без текста]"
+    logger.warning(f"⏳ Жалоба на {target_user} ({target_id}) передана админам: {note}")
+    background_jobs.submit("review_request", lambda: send_ban_confirmation(
+        replied_msg.chat.id, CHAT_ADMINS[replied_msg.chat.id], target_user, target_id, note, reporter, text_to_check,
+        title="⏳ ТРЕБУЕТСЯ РЕШЕНИЕ АДМИНОВ"
+    ))
+
+
+async def queue_for_review(replied_msg: types.Message, reporter: str, started: float, note: str,
+                           verdict_task: asyncio.Task = None):
+    """ИИ не успел к сроку: ответ "на проверке", дело - админам с кнопками BAN, анализ - в фоне"""
+    submit_review_request(replied_msg, reporter, note)
+    if verdict_task is not None:
+        spawn_detached(report_late_verdict(
+            verdict_task, CHAT_ADMINS[replied_msg.chat.id], replied_msg.from_user.first_name,
+            replied_msg.from_user.id, started, "🤖 ВЕРДИКТ ИИ С ОПОЗДАНИЕМ"
+        ))
+    try:
+        # Срок уже вышел - на ответ даётся только короткий отдельный таймаут
+        await asyncio.wait_for(replied_msg.reply("⏳ Жалоба передана администраторам на проверку"), REP_FALLBACK_TIMEOUT)
+        REPLY_SECONDS.observe(time.monotonic() - started, action="QUEUED")
+    except Exception as e:
+        logger.error(f"❌ Не удалось ответить на сообщение: {type(e).__name__} {e}")
+
+
+async def process_report(replied_msg: types.Message, reporter: str, inflight: asyncio.Future,
+                         started: float = None, verdict: dict = None, reporter_id: int = None,
+                         deadline: Deadline = None):
+    """
+    Проверка и наказание по /rep; inflight получает вердикт, как только он готов.
+    Готовый verdict (антифлуд, автомодерация) применяется без обращения к ИИ. Если ИИ не успел
+    к сроку deadline, дело передаётся админам.
+    """
+    started = time.monotonic() if started is None else started
+    deadline = deadline or Deadline(0, "rep", started)
     target_user = replied_msg.from_user.first_name
     target_id = replied_msg.from_user.id
     
@@ -192,41 +2785,62 @@ async def report_command(message: types.Message):
     logger.info(f"📋 РЕПОРТ: {reporter} пожаловался на {target_user} ({target_id})")
     logger.info(f"   Текст: {text_to_check[:100]}...")
 
-    # Собираем контекст из кэша - последние 5 сообщений ДО этого
-    context_messages = []
-    for msg_data in message_cache:
-        if msg_data['message_id'] < replied_msg.message_id:
-            context_messages.append(msg_data)
-    
-    # Берём последние 15 сообщений (для анализа конфликтов)
-    context_messages = context_messages[-15:]
-    
-    # Форматируем контекст
-    context = ""
-    if context_messages:
-        context = "📜 История диалога перед этим сообщением:\n"
-        for msg in context_messages:
-            context += f"{msg['username']}: {msg['text']}\n"
-        context += f"\n⚠️ Проверяемое сообщение:\n{target_user}: {text_to_check}"
-        logger.info(f"📜 Контекст собран: {len(context_messages)} сообщений")
-    else:
-        context = f"Сообщение от {target_user}: {text_to_check}"
+    context = None
+    context_messages = ()
+    if verdict is None:
+        with stage("context"):
+            # Собираем контекст из кэша - последние 15 сообщений ДО этого (для анализа конфликтов)
+            context_messages = message_cache.before(replied_msg.chat.id, replied_msg.message_id, CONTEXT_MESSAGES)
+            
+            # Сначала цепочка ответов и переписка с жалобщиком, потом недавние сообщения
+            related = message_cache.related(replied_msg.chat.id, replied_msg.message_id, target_id, reporter_id)
+            context = build_context(context_messages, target_user, text_to_check, related=related)
+            flood_note = flood_index.describe(replied_msg.chat.id, target_id, text_to_check)
+            if flood_note:
+                context += f"\n\n{flood_note}"
+        deadline.check("context")
 
-    # Проверяем через ИИ с контекстом
-    result = await check_with_ai(text_to_check, context)
+        # Проверяем через ИИ с контекстом, но не дольше остатка срока
+        with stage("verdict"):
+            verdict_task = asyncio.create_task(get_verdict(text_to_check, context, context_messages, target_id,
+                                                           related=related, flooding=bool(flood_note)))
+            in_time = await deadline.wait(verdict_task, "verdict")
+        if not in_time:
+            inflight.set_result({"action": "QUEUED", "reason": "ИИ не успел"})
+            await queue_for_review(replied_msg, reporter, started, f"ИИ не ответил за {REP_DEADLINE:.0f}с", verdict_task)
+            return
+        result = verdict_task.result()
+    else:
+        result = verdict
+    inflight.set_result(result)
     action = result.get("action", "ERROR")
     reason = result.get("reason", "")
     duration = result.get("duration", 0)
+    if action == "MUTE":
+        duration = mute_minutes(duration)
+    admin_chat_id = CHAT_ADMINS[replied_msg.chat.id]
+
+    # Журнал жалоб пишется через очередь логов и не ждёт диска (только MUTE/BAN/WARN)
+    log_reported(result, replied_msg.from_user, text_to_check, reporter, context, context_messages)
+
+    async def reply(text, keyboard=None):
+        msg = await replied_msg.reply(text, reply_markup=keyboard)
+        REPLY_SECONDS.observe(time.monotonic() - started, action=action)
+        return msg
 
-    # Формируем ответное сообщение
+    async def delete_original(_):
+        await replied_msg.delete()
+        logger.info(f"🗑️ Сообщение удалено")
+
+    # Побочные действия: ответ и ограничение параллельно, удаление - после ответа
+    # (ответ ссылается на исходное сообщение), уведомления админам - в фоне.
+    # Вердикт уже есть, поэтому общий срок их не обрывает: у каждого свой таймаут
+    effects = SideEffects(REP_EFFECT_TIMEOUT or None)
     if action == "MUTE":
         response_text = f"🔇 MUTE {duration} минут\n{reason}"
         logger.warning(f"🔇 МУТЕ: {target_user} на {duration} мин. Причина: {reason}")
-        
-        # Логируем reported сообщение
-        reported_logger.info(f"MUTE | Пользователь: {target_user} ({target_id}) | Сообщение: {text_to_check} | Причина: {reason} | От кого: {reporter}")
-        
-        try:
+
+        async def restrict():
             until = datetime.now() + timedelta(minutes=duration)
             await bot.restrict_chat_member(
                 chat_id=replied_msg.chat.id,
@@ -245,114 +2859,99 @@ async def report_command(message: types.Message):
                 ),
                 until_date=until
             )
-            logger.info(f"✅ Мут успешно применен (запрещено всё)")
-        except Exception as e:
-            logger.error(f"❌ Ошибка при применении мута: {e}")
-            response_text += f"\n⚠️ Ошибка: {e}"
+
+        effects.add("restrict", restrict)
+        keyboard = InlineKeyboardMarkup(
+            inline_keyboard=[[
+                InlineKeyboardButton(text="🔓 Размутить", callback_data=f"unmute_{target_id}_{replied_msg.chat.id}")
+            ]]
+        )
+        effects.add("reply", lambda: reply(response_text, keyboard))
 
     elif action == "BAN":
         response_text = f"🚫 BAN {target_user}\n{reason}"
         logger.critical(f"🚫 БАН ОЖИДАЕТ ПОДТВЕРЖДЕНИЯ: {target_user} ({target_id}). Причина: {reason}")
-        
-        # Логируем reported сообщение
-        reported_logger.info(f"REPORTED | Пользователь: {target_user} ({target_id}) | Сообщение: {text_to_check} | Причина: {reason} | От кого: {reporter}")
-        
-        # Отправляем в админ чат для подтверждения
-        try:
-            ban_confirm_text = f"🚫 ТРЕБУЕТСЯ ПОДТВЕРЖДЕНИЕ BAN\n\n👤 Пользователь: {target_user} ({target_id})\n📝 Причина: {reason}\n💬 От кого: {reporter}\n📋 Сообщение: {text_to_check}"
-            
-            keyboard = InlineKeyboardMarkup(
-                inline_keyboard=[[
-                    InlineKeyboardButton(text="✅ Подтвердить BAN", callback_data=f"confirm_ban_{target_id}_{replied_msg.chat.id}"),
-                    InlineKeyboardButton(text="❌ Отменить", callback_data=f"cancel_ban_{target_id}")
-                ]]
-            )
-            
-            msg = await bot.send_message(chat_id=ADMIN_CHAT_ID, text=ban_confirm_text, reply_markup=keyboard)
-            
-            # Сохраняем в pending_bans
-            pending_bans[target_id] = {
-                'chat_id': replied_msg.chat.id,
-                'target_id': target_id,
-                'reason': reason,
-                'message_id': msg.message_id,
-                'admin_chat_id': ADMIN_CHAT_ID
-            }
-            
-            logger.info(f"📤 BAN отправлен на подтверждение админам")
-        except Exception as e:
-            logger.error(f"❌ Ошибка отправки BAN на подтверждение: {e}")
-            response_text = f"🚫 БАН ОШИБКА\n{str(e)}"
+        background_jobs.submit("ban_confirm", lambda: send_ban_confirmation(
+            replied_msg.chat.id, admin_chat_id, target_user, target_id, reason, reporter, text_to_check
+        ))
+        keyboard = InlineKeyboardMarkup(
+            inline_keyboard=[[
+                InlineKeyboardButton(text="🔓 Разбанить", callback_data=f"unban_{target_id}_{replied_msg.chat.id}")
+            ]]
+        )
+        effects.add("reply", lambda: reply(response_text, keyboard))
 
     elif action == "WARN":
-        response_text = f"⚠️ WARN\n{reason}"
+        response_text = f"⚠️ WARN {target_user}\n{reason}"
         logger.warning(f"⚠️ ВАРН: {target_user} ({target_id}). Причина: {reason}")
-        
-        # Логируем reported сообщение
-        reported_logger.info(f"WARN | Пользователь: {target_user} ({target_id}) | Сообщение: {text_to_check} | Причина: {reason} | От кого: {reporter}")
+        admin_warn_text = f"⚠️ ВАРН ВЫДАН\n\n👤 Пользователь: {target_user} ({target_id})\n📝 Причина: {reason}\n💬 От кого: {reporter}"
+        background_jobs.submit("warn_notice", lambda: bot.send_message(chat_id=admin_chat_id, text=admin_warn_text))
+        effects.add("reply", lambda: reply(response_text))
 
     elif action == "OK":
         response_text = f"✅ OK\n{reason}"
         logger.info(f"✅ Сообщение одобрено: {reason}")
+        effects.add("reply", lambda: reply(response_text))
 
     else:
         response_text = f"❌ Ошибка\n{reason}"
         logger.error(f"❌ Ошибка обработки: {reason}")
+        effects.add("reply", lambda: reply(response_text))
 
-    # Отправляем ответ на исходное сообщение с кнопками
-    if action == "MUTE":
-        keyboard = InlineKeyboardMarkup(
-            inline_keyboard=[[
-                InlineKeyboardButton(text="🔓 Размутить", callback_data=f"unmute_{target_id}")
-            ]]
-        )
-        msg = await replied_msg.reply(response_text, reply_markup=keyboard)
-        muted_users[target_id] = {
-            'chat_id': replied_msg.chat.id,
-            'message_id': msg.message_id
-        }
-    elif action == "BAN":
-        keyboard = InlineKeyboardMarkup(
-            inline_keyboard=[[
-                InlineKeyboardButton(text="🔓 Разбанить", callback_data=f"unban_{target_id}")
-            ]]
+    # ПОТОМ удаляем исходное сообщение если было наказание
+    if action in ["MUTE", "BAN", "WARN"]:
+        effects.add("delete", delete_original, after=("reply",))
+
+    errors = await effects.wait()
+    deadline.check("effects")
+    msg = effects.result("reply")
+    timed_out = [name for name, error in errors.items() if isinstance(error, asyncio.TimeoutError)]
+    if timed_out and action in ("MUTE", "WARN"):
+        # Telegram не ответил вовремя - запрос мог и пройти, пусть админы проверят (BAN и так ждёт их подтверждения)
+        submit_review_request(
+            replied_msg, reporter,
+            f"{action} {duration or ''}: Telegram не подтвердил за {REP_EFFECT_TIMEOUT:.0f}с ({', '.join(timed_out)}): {reason}"
         )
-        msg = await replied_msg.reply(response_text, reply_markup=keyboard)
-        banned_users[target_id] = {
+    if "reply" in errors:
+        logger.error(f"❌ Не удалось ответить на сообщение: {errors['reply']}")
+    elif "delete" in errors:
+        logger.warning(f"⚠️ Не удалось удалить сообщение: {errors['delete']}")
+
+    if action == "MUTE":
+        if "restrict" in errors:
+            logger.error(f"❌ Ошибка при применении мута: {errors['restrict']}")
+            if msg is not None:
+                with contextlib.suppress(Exception):
+                    await asyncio.wait_for(
+                        msg.edit_text(f"{response_text}\n⚠️ Ошибка: {errors['restrict']}", reply_markup=keyboard),
+                        REP_FALLBACK_TIMEOUT
+                    )
+        else:
+            logger.info(f"✅ Мут успешно применен (запрещено всё)")
+        restrict_error = errors.get("restrict")
+        if restrict_error is None or isinstance(restrict_error, asyncio.TimeoutError):
+            # Запись живёт до конца мута; после таймаута тоже - Telegram мог мут применить, /unmuteall его снимет
+            muted_users.set(member_key(replied_msg.chat.id, target_id), {
+                'chat_id': replied_msg.chat.id,
+                'message_id': msg.message_id if msg is not None else None
+            }, ttl=duration * 60)
+    elif action == "BAN" and msg is not None:
+        banned_users[member_key(replied_msg.chat.id, target_id)] = {
             'chat_id': replied_msg.chat.id,
             'message_id': msg.message_id
         }
-    elif action == "WARN":
-        warn_text = f"⚠️ WARN {target_user}\n{reason}"
-        msg = await replied_msg.reply(warn_text)
-        
-        # Отправляем варн в админ чат
-        try:
-            admin_warn_text = f"⚠️ ВАРН ВЫДАН\n\n👤 Пользователь: {target_user} ({target_id})\n📝 Причина: {reason}\n💬 От кого: {reporter}"
-            await bot.send_message(chat_id=ADMIN_CHAT_ID, text=admin_warn_text)
-            logger.info(f"📤 Варн отправлен в админ чат")
-        except Exception as e:
-            logger.error(f"❌ Ошибка отправки варна в админ чат: {e}")
-    else:
-        await replied_msg.reply(response_text)
-    
-    # ПОТОМ удаляем исходное сообщение если было наказание
-    if action in ["MUTE", "BAN", "WARN"]:
-        try:
-            await replied_msg.delete()
-            logger.info(f"🗑️ Сообщение удалено")
-        except Exception as e:
-            logger.warning(f"⚠️ Не удалось удалить сообщение: {e}")
     
     logger.info(f"📤 Ответ отправлен: {response_text.replace(chr(10), ' | ')}")
 
 @dp.message(Command("repno"))
 async def repno_command(message: types.Message):
     """Анализирует сообщение через ИИ БЕЗ наказания, отправляет результат админам"""
+    started = time.monotonic()
+    deadline = Deadline(REP_DEADLINE, "repno", started)
     user_id = message.from_user.id
     
     # Проверяем что это в разрешённом чате
-    if message.chat.id != ALLOWED_CHAT_ID:
+    if message.chat.id not in CHAT_ADMINS:
         logger.warning(f"⚠️ Попытка использовать /repno в чате {message.chat.id}")
         await message.reply("❌ Эта команда работает только в определённом чате")
         return
@@ -373,26 +2972,36 @@ async def repno_command(message: types.Message):
     logger.info(f"🔍 РЕПНО (анализ): {reporter} проверяет {target_user} ({target_id})")
     logger.info(f"   Текст: {text_to_check[:100]}...")
 
-    # Собираем контекст из кэша - последние 15 сообщений
-    context_messages = []
-    for msg_data in message_cache:
-        if msg_data['message_id'] < replied_msg.message_id:
-            context_messages.append(msg_data)
-    
-    context_messages = context_messages[-15:]
-    
-    # Форматируем контекст
-    context = ""
-    if context_messages:
-        context = "📜 История диалога перед этим сообщением:\n"
-        for msg in context_messages:
-            context += f"{msg['username']}: {msg['text']}\n"
-        context += f"\n⚠️ Проверяемое сообщение:\n{target_user}: {text_to_check}"
-    else:
-        context = f"Сообщение от {target_user}: {text_to_check}"
+    with stage("context"):
+        # Собираем контекст из кэша - последние 15 сообщений
+        context_messages = message_cache.before(replied_msg.chat.id, replied_msg.message_id, CONTEXT_MESSAGES)
+        
+        # Сначала цепочка ответов и переписка с заметившим, потом недавние сообщения
+        related = message_cache.related(replied_msg.chat.id, replied_msg.message_id, target_id, message.from_user.id)
+        context = build_context(context_messages, target_user, text_to_check, related=related)
+        flood_note = flood_index.describe(replied_msg.chat.id, target_id, text_to_check)
+        if flood_note:
+            context += f"\n\n{flood_note}"
+    deadline.check("context")
 
-    # Проверяем через ИИ с контекстом
-    result = await check_with_ai(text_to_check, context)
+    # Проверяем через ИИ с контекстом, но не дольше остатка срока
+    with stage("verdict"):
+        verdict_task = asyncio.create_task(get_verdict(text_to_check, context, context_messages, target_id,
+                                                       related=related, flooding=bool(flood_note)))
+        in_time = await deadline.wait(verdict_task, "verdict")
+    if not in_time:
+        # Анализ дойдёт до админов, когда ИИ ответит
+        spawn_detached(report_late_verdict(
+            verdict_task, CHAT_ADMINS[message.chat.id], target_user, target_id, started,
+            f"🔍 АНАЛИЗ БЕЗ НАКАЗАНИЯ (repno) С ОПОЗДАНИЕМ, заметил {reporter}"
+        ))
+        with contextlib.suppress(Exception):
+            await asyncio.wait_for(
+                message.reply("⏳ Анализ занимает больше времени - результат придёт администраторам"),
+                REP_FALLBACK_TIMEOUT
+            )
+        return
+    result = verdict_task.result()
     action = result.get("action", "ERROR")
     reason = result.get("reason", "")
     duration = result.get("duration", 0)
@@ -412,35 +3021,54 @@ async def repno_command(message: types.Message):
 💬 Заметил: {reporter}
 """
     
-    # Отправляем админам
+    # Отправляем админам, не дольше остатка срока; не успели - отправка уходит в фоновую очередь
+    admin_chat_id = CHAT_ADMINS[message.chat.id]
     try:
-        await bot.send_message(
-            chat_id=ADMIN_CHAT_ID,
-            text=analysis_text
-        )
+        await deadline.run(bot.send_message(chat_id=admin_chat_id, text=analysis_text), "admin_send")
+        reply_text = "✅ Анализ отправлен администраторам (наказание НЕ применено)"
         logger.info(f"📤 Анализ отправлен админам: {action} - {reason}")
-        await message.reply("✅ Анализ отправлен администраторам (наказание НЕ применено)")
+    except asyncio.TimeoutError:
+        background_jobs.submit("repno_analysis", lambda: bot.send_message(chat_id=admin_chat_id, text=analysis_text))
+        reply_text = "⏳ Анализ готов и будет доставлен администраторам (наказание НЕ применено)"
     except Exception as e:
         logger.error(f"❌ Ошибка отправки анализа админам: {e}")
-        await message.reply(f"⚠️ Анализ выполнен, но не удалось отправить админам: {e}")
+        reply_text = f"⚠️ Анализ выполнен, но не удалось отправить админам: {e}"
+
+    # На ответ - остаток срока, но не меньше короткого отдельного таймаута
+    timeout = deadline.remaining()
+    try:
+        await asyncio.wait_for(message.reply(reply_text), None if timeout is None else max(timeout, REP_FALLBACK_TIMEOUT))
+    except Exception as e:
+        if isinstance(e, asyncio.TimeoutError):
+            deadline.miss("reply")
+        logger.error(f"❌ Не удалось ответить на /repno: {type(e).__name__} {e}")
+
+def parse_member_callback(data: str):
+    """(user_id, chat_id) из "действие_user_chat"; None для старых кнопок без chat_id"""
+    parts = data.rsplit("_", 2)
+    try:
+        return int(parts[1]), int(parts[2])
+    except (IndexError, ValueError):
+        return None
 
 # Хендлер для подтверждения/отмены BAN (только для админов в админ чате)
 @dp.callback_query(F.data.startswith("confirm_ban_"))
 async def confirm_ban_callback(callback: types.CallbackQuery):
-    # Проверяем что это админ
-    member = await bot.get_chat_member(callback.message.chat.id, callback.from_user.id)
-    if member.status not in ["creator", "administrator"]:
+    parsed = parse_member_callback(callback.data)
+    if parsed is None:
+        await callback.answer("❌ Кнопка устарела", show_alert=True)
+        return
+    target_id, chat_id = parsed
+
+    # Проверяем что это админ админ-чата именно этого чата
+    if (CHAT_ADMINS.get(chat_id) != callback.message.chat.id
+            or not await admin_roster.is_admin(callback.message.chat.id, callback.from_user.id)):
         await callback.answer("❌ Только администраторы могут подтвердить BAN", show_alert=True)
         return
     
-    data = callback.data.split("_")
-    target_id = int(data[2])
-    chat_id = int(data[3])
-    
     try:
-        if target_id in pending_bans:
-            ban_info = pending_bans[target_id]
-            
+        ban_info = await shared_pending_bans.get(member_key(chat_id, target_id))
+        if ban_info is not None:
             # Баним пользователя
             await bot.ban_chat_member(chat_id=chat_id, user_id=target_id)
             
@@ -448,7 +3076,7 @@ async def confirm_ban_callback(callback: types.CallbackQuery):
             await callback.answer("✅ BAN применен", show_alert=False)
             logger.warning(f"🚫 BAN ПРИМЕНЕН: Администратор {callback.from_user.first_name} подтвердил бан пользователя {target_id}")
             
-            del pending_bans[target_id]
+            await shared_pending_bans.pop(member_key(chat_id, target_id))
         else:
             await callback.answer("❌ BAN не найден", show_alert=True)
     except Exception as e:
@@ -457,21 +3085,25 @@ async def confirm_ban_callback(callback: types.CallbackQuery):
 
 @dp.callback_query(F.data.startswith("cancel_ban_"))
 async def cancel_ban_callback(callback: types.CallbackQuery):
-    # Проверяем что это админ
-    member = await bot.get_chat_member(callback.message.chat.id, callback.from_user.id)
-    if member.status not in ["creator", "administrator"]:
+    parsed = parse_member_callback(callback.data)
+    if parsed is None:
+        await callback.answer("❌ Кнопка устарела", show_alert=True)
+        return
+    target_id, chat_id = parsed
+
+    # Проверяем что это админ админ-чата именно этого чата
+    if (CHAT_ADMINS.get(chat_id) != callback.message.chat.id
+            or not await admin_roster.is_admin(callback.message.chat.id, callback.from_user.id)):
         await callback.answer("❌ Только администраторы могут отменить BAN", show_alert=True)
         return
     
-    target_id = int(callback.data.split("_")[2])
-    
     try:
-        if target_id in pending_bans:
+        if await shared_pending_bans.get(member_key(chat_id, target_id)) is not None:
             await callback.message.edit_text(f"❌ BAN ОТМЕНЕН администратором {callback.from_user.first_name}")
             await callback.answer("✅ BAN отменен", show_alert=False)
             logger.warning(f"❌ BAN ОТМЕНЕН: Администратор {callback.from_user.first_name} отменил бан пользователя {target_id}")
             
-            del pending_bans[target_id]
+            await shared_pending_bans.pop(member_key(chat_id, target_id))
         else:
             await callback.answer("❌ BAN не найден", show_alert=True)
     except Exception as e:
@@ -481,25 +3113,26 @@ async def cancel_ban_callback(callback: types.CallbackQuery):
 # Хендлер для размута по кнопке (только для админов)
 @dp.callback_query(F.data.startswith("unmute_"))
 async def unmute_callback(callback: types.CallbackQuery):
-    user_id = int(callback.data.split("_")[1])
-    logger.info(f"📋 Попытка размута: user_id={user_id}")
+    parsed = parse_member_callback(callback.data)
+    if parsed is None:
+        await callback.answer("❌ Кнопка устарела", show_alert=True)
+        return
+    user_id, chat_id = parsed
+    key = member_key(chat_id, user_id)
+    logger.info(f"📋 Попытка размута: user_id={user_id}, chat_id={chat_id}")
     
     # Получаем информацию о муте
-    if user_id not in muted_users:
-        logger.warning(f"⚠️ Мут не найден для user_id={user_id}")
+    if key not in muted_users:
+        logger.warning(f"⚠️ Мут не найден для {key}")
         await callback.answer("❌ Мут не найден", show_alert=True)
         return
     
-    mute_info = muted_users[user_id]
-    chat_id = mute_info['chat_id']
-    logger.info(f"📋 Chat ID из muted_users: {chat_id}")
-    
     # Проверяем что это админ В ОСНОВНОМ ЧАТЕ
     try:
-        member = await bot.get_chat_member(chat_id, callback.from_user.id)
-        logger.info(f"📋 Статус администратора {callback.from_user.first_name}: {member.status}")
+        is_admin = await admin_roster.is_admin(chat_id, callback.from_user.id)
+        logger.info(f"📋 {callback.from_user.first_name} админ: {is_admin}")
         
-        if member.status not in ["creator", "administrator"]:
+        if not is_admin:
             await callback.answer("❌ Только администраторы могут размутить", show_alert=True)
             return
     except Exception as e:
@@ -527,7 +3160,7 @@ async def unmute_callback(callback: types.CallbackQuery):
         await callback.answer("✅ Пользователь размучен", show_alert=False)
         logger.warning(f"🔓 РАЗМУТ: Администратор {callback.from_user.first_name} размутил пользователя {user_id}")
         
-        del muted_users[user_id]
+        muted_users.pop(key, None)
             
     except Exception as e:
         logger.error(f"❌ Ошибка при размуте: {str(e)}")
@@ -537,14 +3170,16 @@ async def unmute_callback(callback: types.CallbackQuery):
 # Хендлер для разбана по кнопке (только для админов)
 @dp.callback_query(F.data.startswith("unban_"))
 async def unban_callback(callback: types.CallbackQuery):
-    # Проверяем что это админ
-    member = await bot.get_chat_member(callback.message.chat.id, callback.from_user.id)
-    if member.status not in ["creator", "administrator"]:
-        await callback.answer("❌ Только администраторы могут разбанить", show_alert=True)
+    parsed = parse_member_callback(callback.data)
+    if parsed is None:
+        await callback.answer("❌ Кнопка устарела", show_alert=True)
         return
+    user_id, chat_id = parsed
 
-    user_id = int(callback.data.split("_")[1])
-    chat_id = callback.message.chat.id
+    # Проверяем что это админ того чата, где был бан
+    if not await admin_roster.is_admin(chat_id, callback.from_user.id):
+        await callback.answer("❌ Только администраторы могут разбанить", show_alert=True)
+        return
     
     try:
         # Разбаним пользователя
@@ -554,8 +3189,7 @@ async def unban_callback(callback: types.CallbackQuery):
         await callback.answer("✅ Пользователь разбанен", show_alert=False)
         logger.warning(f"🔓 РАЗБАН: Администратор {callback.from_user.first_name} разбанил пользователя {user_id}")
         
-        if user_id in banned_users:
-            del banned_users[user_id]
+        banned_users.pop(member_key(chat_id, user_id), None)
             
     except Exception as e:
         logger.error(f"❌ Ошибка при разбане: {e}")
@@ -564,65 +3198,762 @@ async def unban_callback(callback: types.CallbackQuery):
 # Команда /unmuteall для размута всех (только админы)
 @dp.message(Command("unmuteall"))
 async def unmuteall_command(message: types.Message):
+    # Проверяем что это в разрешённом чате (до списка админов: в личке его не получить)
+    if message.chat.id not in CHAT_ADMINS:
+        await message.reply("❌ Команда работает только в определённом чате")
+        return
+    
     # Проверяем что это админ
-    member = await bot.get_chat_member(message.chat.id, message.from_user.id)
-    if member.status not in ["creator", "administrator"]:
+    if not await admin_roster.is_admin(message.chat.id, message.from_user.id):
         await message.reply("❌ Только администраторы могут использовать эту команду")
         logger.warning(f"⚠️ Попытка /unmuteall от {message.from_user.first_name} (не админ)")
         return
     
-    # Проверяем что это в разрешённом чате
-    if message.chat.id != ALLOWED_CHAT_ID:
-        await message.reply("❌ Команда работает только в определённом чате")
-        return
-    
-    if not muted_users:
+    prefix = member_key(message.chat.id, "")
+    user_ids = [int(str(key)[len(prefix):]) for key in muted_users.keys() if str(key).startswith(prefix)]
+    if not user_ids:
         await message.reply("✅ Нет мученых пользователей")
         return
     
-    unmuted_count = 0
-    failed_count = 0
-    
-    for user_id in list(muted_users.keys()):
-        try:
-            # Разрешаем всё
-            await bot.restrict_chat_member(
-                chat_id=message.chat.id,
-                user_id=user_id,
-                permissions=ChatPermissions()
-            )
-            unmuted_count += 1
-            logger.info(f"🔓 Размучен: {user_id}")
-            # Удаляем из списка ТОЛЬКО если успешно
-            del muted_users[user_id]
-        except Exception as e:
-            failed_count += 1
-            logger.error(f"❌ Ошибка при размуте {user_id}: {e}")
-            # НЕ удаляем из списка, чтобы попробовать в следующий раз
+    status = await message.reply(f"⏳ Размут: 0/{len(user_ids)}")
+
+    async def unmute(user_id):
+        # Разрешаем всё
+        await bot.restrict_chat_member(
+            chat_id=message.chat.id,
+            user_id=user_id,
+            permissions=ChatPermissions()
+        )
+        logger.info(f"🔓 Размучен: {user_id}")
+        # Удаляем из списка ТОЛЬКО если успешно
+        muted_users.pop(member_key(message.chat.id, user_id), None)
+
+    # Неудачные НЕ удаляем из списка, чтобы попробовать в следующий раз
+    done, failed = await bulk_executor.run(message.chat.id, user_ids, unmute, status, "Размут")
+    unmuted_count = len(done)
+    failed_count = len(failed)
     
-    await message.reply(f"✅ Размучено: {unmuted_count}\n❌ Ошибок: {failed_count}")
+    result_text = f"✅ Размучено: {unmuted_count}\n❌ Ошибок: {failed_count}"
+    try:
+        await status.edit_text(result_text)
+    except Exception:
+        await message.reply(result_text)
     logger.warning(f"🔓 РАЗМУТ ВСЕ: {unmuted_count} пользователей размучено")
 
+async def allow_service_command(message: types.Message, command: str) -> bool:
+    """Служебные команды: только чаты из конфига (модерируемые и админские) и только их админы"""
+    if message.chat.type == "private" or (message.chat.id not in CHAT_ADMINS and message.chat.id not in ADMIN_CHATS):
+        logger.warning(f"⚠️ Попытка /{command} в чате {message.chat.id}")
+        await message.reply("❌ Команда работает только в определённом чате")
+        return False
+    if not await admin_roster.is_admin(message.chat.id, message.from_user.id):
+        logger.warning(f"⚠️ Попытка /{command} от {message.from_user.first_name} (не админ)")
+        await message.reply("❌ Только администраторы могут использовать эту команду")
+        return False
+    return True
+
+# Команда /clearcache для сброса кэша вердиктов (только админы)
+@dp.message(Command("clearcache"))
+async def clearcache_command(message: types.Message):
+    if not await allow_service_command(message, "clearcache"):
+        return
+
+    # /clearcache - сбросить всё, /clearcache <текст> - только записи с этим текстом
+    parts = (message.text or "").split(maxsplit=1)
+    needle = parts[1] if len(parts) > 1 else None
+    removed = await shared_verdicts.call('invalidate', needle)
+    await shared_verdicts.call('save')
+
+    stats = await shared_verdicts.call('stats')
+    await message.reply(
+        f"🗑️ Удалено из кэша вердиктов: {removed}\n"
+        f"📦 Осталось: {stats['size']}\n"
+        f"⚡ Попаданий: {stats['hits']}, промахов: {stats['misses']} ({stats['hit_rate']:.0%})"
+    )
+    logger.warning(f"🗑️ КЭШ ВЕРДИКТОВ: {message.from_user.first_name} удалил {removed} записей")
+
+# Команда /stats со статистикой модерации (только админы)
+@dp.message(Command("stats"))
+async def stats_command(message: types.Message):
+    if not await allow_service_command(message, "stats"):
+        return
+
+    cache_stats = await shared_verdicts.call('stats')
+    text = (
+        f"📊 Вердикты по уровням\n"
+        f"🧹 Пре-фильтр: {verdict_tiers['prefilter']}\n"
+        f"⚡ Кэш: {verdict_tiers['cache']}\n"
+        f"🤖 ИИ: {verdict_tiers['llm']}\n\n"
+        f"📦 Кэш вердиктов: {cache_stats['size']} записей, попаданий {cache_stats['hit_rate']:.0%}"
+    )
+    for mode, title in (('single', "Одиночные"), ('batch', "Пакетные")):
+        stats = llm_stats[mode]
+        if stats['verdicts']:
+            text += (
+                f"\n{title} запросы к ИИ: {stats['requests']} запросов, {stats['verdicts']} вердиктов, "
+                f"{stats['tokens'] / stats['verdicts']:.0f} токенов и {stats['seconds'] / stats['verdicts']:.2f}с на вердикт, "
+                f"из кэша промпта {stats['cached_tokens'] / max(stats['prompt_tokens'], 1):.0%}"
+            )
+            if stats['estimated']:
+                text += f" (токены оценены в {stats['estimated']} из {stats['requests']} запросов)"
+    if stream_stats['requests']:
+        answered = stream_stats['early'] + stream_stats['completed']
+        text += f"\nПоток: время до вердикта {stream_stats['ttv_seconds'] / max(answered, 1):.2f}с, досрочно {stream_stats['early']}/{stream_stats['requests']}"
+        if stream_stats['completed']:
+            text += f", полный ответ {stream_stats['total_seconds'] / stream_stats['completed']:.2f}с"
+    for backend in llm_backends:
+        p90 = backend.p90()
+        text += (
+            f"\n🧠 {backend.name}: {backend.breaker.state}, побед {backend.wins}, ошибок {backend.errors}, "
+            f"p90 {f'{p90:.2f}с' if p90 is not None else '—'}"
+        )
+    text += f"\n📝 Очередь логов: {log_queue_depth()}"
+    text += (
+        f"\n📬 Фоновые задачи: в очереди {background_jobs.queue_depth()}, выполнено {background_jobs.stats['done']}, "
+        f"повторов {background_jobs.stats['retried']}, ошибок {background_jobs.stats['failed']}"
+    )
+    if AUTOMOD_ENABLED:
+        text += (
+            f"\n🚨 Автомодерация: оценено {automod.stats['scored']}, в ИИ {automod.stats['escalated']}, "
+            f"отброшено {automod.stats['dropped']}, наказано {automod.stats['acted']}, в очереди {len(automod.queue)}"
+        )
+    if BOT_MODE == "webhook":
+        text += f"\n🌐 Очередь webhook: {webhook_workers.queue_depth()}, отклонено {webhook_workers.rejected}"
+    text += f"\n💬 История сообщений: {len(message_cache)}, ~{message_cache.nbytes / 2**20:.1f} МБ"
+    if snapshot is not None:
+        text += (
+            f"\n💾 Снимок: записей {snapshot.stats['rows']}, ошибок {snapshot.stats['errors']}, "
+            f"восстановлено {snapshot.stats['restored_state']} + {snapshot.stats['restored_messages']} сообщений"
+            f"{'' if snapshot.restored else ' (идёт)'}"
+        )
+    flood_stats = flood_index.stats()
+    text += (
+        f"\n📈 Антифлуд: проверено {flood_stats['messages']}, авторов с сериями {flood_stats['users']}, "
+        f"автомутов {flood_stats['auto_mutes']}"
+    )
+    text += "\n\n🗂️ Состояние модерации"
+    for state in moderation_state:
+        state_stats = state.stats()
+        text += f"\n{state.name}: {state_stats['entries']} записей, ~{state_stats['bytes'] / 1024:.1f} КБ, истекло {state_stats['expired']}"
+    await message.reply(text)
+
+# Обновляем кэш админов при смене статуса участника
+@dp.chat_member()
+async def chat_member_update(update: types.ChatMemberUpdated):
+    member = update.new_chat_member
+    admin_roster.apply_status(update.chat.id, member.user.id, member.status)
+    if member.status != update.old_chat_member.status:
+        logger.info(f"👮 Статус {member.user.first_name} ({member.user.id}) в чате {update.chat.id}: {update.old_chat_member.status} -> {member.status}")
+
+# Прямые оскорбления из правила 1.2 и ссылки - признаки для оценки
+INSULT_RE = re.compile(r"\bты\s+(?:\w+\s+)?(?:урод|говно|мусор|идиот|дебил|тварь|чмо|ничтожество|мразь)", re.IGNORECASE)
+LINK_RE = re.compile(r"(?:https?://|www\.|t\.me/|discord\.gg/)\S+", re.IGNORECASE)
+AUTOMOD_EVENTS = metrics.counter("report_bot_automod_total", "События автомодерации", ["event"])
+
+
+class MessageScorer:
+    """
+    Дешёвая оценка подозрительности сообщения (0..1) по локальным признакам
+    и частоте сообщений пользователя. Ничего не ждёт и не ходит в сеть.
+    """
+
+    def __init__(self, rate_window: float):
+        self.rate_window = rate_window
+        self._user_times = {}  # (chat_id, user_id) -> deque времён сообщений
+
+    def _user_rate(self, chat_id: int, user_id: int) -> int:
+        now = time.monotonic()
+        times = self._user_times.get((chat_id, user_id))
+        if times is None:
+            times = self._user_times[(chat_id, user_id)] = deque(maxlen=50)
+        times.append(now)
+        while times and now - times[0] > self.rate_window:
+            times.popleft()
+        return len(times)
+
+    def forget_idle(self):
+        """Убирает пользователей, которые давно молчат"""
+        now = time.monotonic()
+        for key in [key for key, times in self._user_times.items() if not times or now - times[-1] > self.rate_window]:
+            del self._user_times[key]
+
+    def score(self, chat_id: int, user_id: int, text: str, context_messages=()) -> float:
+        score = 0.0
+        if PREFILTER_ENABLED:
+            verdict = prefilter.check(text, context_messages, user_id)
+            if verdict is not None and verdict["action"] != "OK":
+                return 1.0
+        if INSULT_RE.search(text):
+            score += 0.6
+        if LINK_RE.search(text):
+            score += 0.3
+        letters = [ch for ch in text if ch.isalpha()]
+        if len(letters) >= 10 and sum(ch.isupper() for ch in letters) / len(letters) > 0.7:
+            score += 0.2
+        rate = self._user_rate(chat_id, user_id)
+        if rate >= 5:
+            score += min(0.4, 0.1 * (rate - 4))
+        return min(score, 1.0)
+
+
+class BoundedPriorityQueue:
+    """Очередь по приоритету фиксированного размера: при переполнении выкидывается наименее важное"""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._heap = []  # (-priority, seq, item)
+        self._seq = itertools.count()
+        self._not_empty = asyncio.Event()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def put_nowait(self, priority: float, item) -> bool:
+        """False - элемент не поместился (он наименее важный)"""
+        entry = (-priority, next(self._seq), item)
+        if len(self._heap) >= self.maxsize:
+            lowest = max(range(len(self._heap)), key=lambda i: self._heap[i])
+            if self._heap[lowest] < entry:
+                return False
+            self._heap[lowest] = self._heap[-1]
+            self._heap.pop()
+            heapq.heapify(self._heap)
+        heapq.heappush(self._heap, entry)
+        self._not_empty.set()
+        return True
+
+    async def get(self):
+        while not self._heap:
+            self._not_empty.clear()
+            await self._not_empty.wait()
+        priority, _, item = heapq.heappop(self._heap)
+        return -priority, item
+
+
+class AutoModerator:
+    """
+    Проверяет каждое сообщение без участия людей: оценка в cache_messages,
+    подозрительные уходят в очередь, воркеры отправляют их в ИИ в пределах
+    бюджета вызовов в минуту и наказывают тем же путём, что и /rep.
+    """
+
+    def __init__(self, threshold: float, per_minute: float, queue_size: int, workers: int):
+        self.threshold = threshold
+        self.workers = workers
+        self.scorer = MessageScorer(AUTOMOD_RATE_WINDOW)
+        self.queue = BoundedPriorityQueue(queue_size)
+        self.budget = TokenBucket(per_minute / 60, capacity=max(1.0, per_minute))
+        self.stats = {'scored': 0, 'escalated': 0, 'dropped': 0, 'acted': 0}
+        self._tasks = []
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        logger.info(f"🤖 Автомодерация включена: порог {self.threshold}, до {AUTOMOD_LLM_PER_MINUTE:.0f} вызовов ИИ в минуту")
+
+    def stop(self):
+        for task in self._tasks:
+            task.cancel()
+
+    def observe(self, message: types.Message, text: str):
+        """Вызывается из cache_messages; только считает и кладёт в очередь, никогда не ждёт"""
+        context_messages = message_cache.before(message.chat.id, message.message_id, FLOOD_REPEAT_THRESHOLD + 5)
+        score = self.scorer.score(message.chat.id, message.from_user.id, text, context_messages)
+        self.stats['scored'] += 1
+        if score < self.threshold:
+            return
+        if self.queue.put_nowait(score, message):
+            self.stats['escalated'] += 1
+            AUTOMOD_EVENTS.inc(event="escalated")
+            logger.info(f"🚨 Автомодерация: сообщение {message.message_id} от {message.from_user.first_name} (оценка {score:.2f}) в очереди")
+        else:
+            self.stats['dropped'] += 1
+            AUTOMOD_EVENTS.inc(event="dropped")
+
+    async def _worker(self):
+        while True:
+            score, message = await self.queue.get()
+            try:
+                await self._check(message, score)
+            except Exception as e:
+                logger.error(f"❌ Автомодерация: ошибка проверки {message.message_id}: {e}")
+
+    async def _check(self, message: types.Message, score: float):
+        report_key = (message.chat.id, message.message_id)
+        if report_key in inflight_reports:
+            return
+        if await admin_roster.is_admin(message.chat.id, message.from_user.id):
+            return
+
+        text_to_check = message.text or message.caption or "[медиа без текста]"
+        context_messages = message_cache.before(message.chat.id, message.message_id, CONTEXT_MESSAGES)
+        related = message_cache.related(message.chat.id, message.message_id, message.from_user.id)
+        context = build_context(context_messages, message.from_user.first_name, text_to_check, related=related)
+        flood_note = flood_index.describe(message.chat.id, message.from_user.id, text_to_check)
+        if flood_note:
+            context += f"\n\n{flood_note}"
+        # Бюджет тратится только на настоящий запрос к ИИ, пре-фильтр и кэш бесплатны
+        result = await get_verdict(text_to_check, context, context_messages, message.from_user.id,
+                                   before_llm=self.budget.acquire, related=related, flooding=bool(flood_note))
+        if result.get("action") not in ("MUTE", "BAN", "WARN") or report_key in inflight_reports:
+            return
+
+        # Наказание тем же путём, что и /rep, с уже готовым вердиктом (метрики вердиктов не считаются дважды)
+        self.stats['acted'] += 1
+        AUTOMOD_EVENTS.inc(event="acted")
+        inflight = asyncio.get_running_loop().create_future()
+        inflight_reports[report_key] = inflight
+        try:
+            await process_report(message, "🤖 Автомодерация", inflight, verdict=result)
+        finally:
+            if not inflight.done():
+                inflight.set_result(result)
+            inflight_reports.pop(report_key, None)
+
+
+automod = AutoModerator(AUTOMOD_THRESHOLD, AUTOMOD_LLM_PER_MINUTE, AUTOMOD_QUEUE_SIZE, AUTOMOD_WORKERS)
+
+
+async def mute_flood(message: types.Message, series: FloodSeries):
+    """Автоматический MUTE за серию почти-повторов (FLOOD_AUTO_MUTE)"""
+    report_key = (message.chat.id, message.message_id)
+    if report_key in inflight_reports:
+        return
+    try:
+        if await admin_roster.is_admin(message.chat.id, message.from_user.id):
+            return
+    except Exception as e:
+        logger.error(f"❌ Антифлуд: не удалось проверить права {message.from_user.id}: {e}")
+        return
+    flood_index.auto_mutes += 1
+    verdict = {
+        "action": "MUTE",
+        "duration": FLOOD_MUTE_MINUTES,
+        "reason": f"1.1 Флуд: похожее сообщение {series.count} раз за {series.span:.0f} с"
+    }
+    logger.warning(f"📈 Антифлуд: {message.from_user.first_name} ({message.from_user.id}) - {verdict['reason']}")
+    inflight = asyncio.get_running_loop().create_future()
+    inflight_reports[report_key] = inflight
+    try:
+        await process_report(message, "📈 Антифлуд", inflight, verdict=verdict)
+    except Exception as e:
+        logger.error(f"❌ Антифлуд: ошибка наказания {message.from_user.id}: {e}")
+    finally:
+        if not inflight.done():
+            inflight.set_result(verdict)
+        inflight_reports.pop(report_key, None)
+
+
 # Кэшируем все сообщения из чата для контекста
 @dp.message()
 async def cache_messages(message: types.Message):
-    if message.chat.id == ALLOWED_CHAT_ID:
-        message_cache.append({
-            'message_id': message.message_id,
-            'username': message.from_user.first_name or "unknown",
-            'text': message.text or message.caption or "[медиа]",
-            'timestamp': datetime.now()
-        })
+    if message.chat.id in CHAT_ADMINS:
+        text = message.text or message.caption or "[медиа]"
+        message_cache.append(message.chat.id, MessageRecord(
+            message.message_id,
+            message.from_user.id,
+            message.from_user.first_name or "unknown",
+            text[:MESSAGE_TEXT_MAX_CHARS] if MESSAGE_TEXT_MAX_CHARS else text,
+            message.reply_to_message.message_id if message.reply_to_message else 0
+        ))
+        if not message.from_user.is_bot:
+            user_series, _ = flood_index.add(message.chat.id, message.from_user.id, text)
+            if FLOOD_AUTO_MUTE and user_series.count >= FLOOD_AUTO_MUTE_COUNT and not user_series.muted:
+                user_series.muted = True
+                spawn_detached(mute_flood(message, user_series))
+            if AUTOMOD_ENABLED:
+                automod.observe(message, text)
     
     # Логируем ЛС
     if message.chat.type == "private":
         logger.info(f"💬 ЛС от {message.from_user.first_name} ({message.from_user.id}): {message.text or message.caption or '[медиа]'}")
 
+def update_chat_id(update: types.Update) -> int:
+    """chat_id апдейта (0, если чата нет) - по нему апдейты раскладываются по воркерам"""
+    if update.message:
+        return update.message.chat.id
+    if update.edited_message:
+        return update.edited_message.chat.id
+    if update.callback_query and update.callback_query.message:
+        return update.callback_query.message.chat.id
+    if update.chat_member:
+        return update.chat_member.chat.id
+    if update.my_chat_member:
+        return update.my_chat_member.chat.id
+    return 0
+
+
+class ChatOrderedWorkers:
+    """
+    Пул воркеров для апдейтов из webhook. Апдейты одного чата всегда попадают
+    в одну очередь, поэтому обычные сообщения обрабатываются строго по порядку
+    (cache_messages и антифлуд видят их последовательно), а разные чаты идут
+    параллельно. Команды и кнопки запускаются отдельными задачами: долгий /rep
+    не держит очередь, а одновременные /rep на одно сообщение склеиваются.
+    """
+
+    def __init__(self, workers: int, queue_size: int):
+        self._queues = [asyncio.Queue(maxsize=queue_size) for _ in range(workers)]
+        self._tasks = []
+        self._handlers = set()  # задачи команд и кнопок
+        self.processed = 0
+        self.rejected = 0
+        self.latencies = deque(maxlen=10000)  # секунды от получения до конца обработки
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker(q)) for q in self._queues]
+
+    async def stop(self):
+        """Дожидается обработки уже принятых апдейтов и останавливает воркеров"""
+        for q in self._queues:
+            await q.join()
+        if self._handlers:
+            await asyncio.wait(set(self._handlers))
+        for task in self._tasks:
+            task.cancel()
+
+    def submit(self, update: types.Update) -> bool:
+        q = self._queues[update_chat_id(update) % len(self._queues)]
+        try:
+            q.put_nowait((time.monotonic(), update))
+            return True
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return False
+
+    async def put(self, update: types.Update):
+        """Как submit, но при полной очереди ждёт (обратное давление для шардов)"""
+        q = self._queues[update_chat_id(update) % len(self._queues)]
+        await q.put((time.monotonic(), update))
+
+    def queue_depth(self) -> int:
+        return sum(q.qsize() for q in self._queues)
+
+    @staticmethod
+    def _is_ordered(update: types.Update) -> bool:
+        """По порядку идут обычные сообщения и события чата; команды и нажатия кнопок - параллельно"""
+        if update.callback_query is not None:
+            return False
+        message = update.message or update.edited_message
+        if message is None:
+            return True
+        return not (message.text or message.caption or "").startswith("/")
+
+    async def _feed(self, received_at: float, update: types.Update):
+        try:
+            await dp.feed_update(bot, update)
+        except Exception as e:
+            logger.error(f"❌ Ошибка обработки апдейта {update.update_id}: {e}")
+        finally:
+            self.processed += 1
+            self.latencies.append(time.monotonic() - received_at)
+
+    async def _worker(self, q: asyncio.Queue):
+        while True:
+            received_at, update = await q.get()
+            try:
+                if self._is_ordered(update):
+                    await self._feed(received_at, update)
+                else:
+                    task = asyncio.create_task(self._feed(received_at, update))
+                    self._handlers.add(task)
+                    task.add_done_callback(self._handlers.discard)
+            finally:
+                q.task_done()
+
+
+webhook_workers = ChatOrderedWorkers(WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE)
+
+
+async def handle_webhook(request: web.Request) -> web.Response:
+    if not secrets.compare_digest(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), WEBHOOK_SECRET):
+        logger.warning(f"⚠️ Webhook: неверный секрет от {request.remote}")
+        return web.Response(status=401)
+
+    update = types.Update.model_validate(await request.json(), context={"bot": bot})
+    if shard_router is not None:
+        await shard_router.route(update)
+        return web.Response()
+    if not webhook_workers.submit(update):
+        # Telegram повторит доставку позже
+        logger.warning(f"⚠️ Webhook: очередь переполнена, апдейт {update.update_id} отклонён")
+        return web.Response(status=503)
+    return web.Response()
+
+
+def create_webhook_app() -> web.Application:
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle_webhook)
+    return app
+
+
+async def run_webhook():
+    if shard_router is None:
+        webhook_workers.start()
+    runner = web.AppRunner(create_webhook_app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    await bot.set_webhook(
+        WEBHOOK_URL,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types()
+    )
+    logger.info(f"🌐 Webhook слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH} ({WEBHOOK_WORKERS} воркеров)")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+        if shard_router is None:
+            await webhook_workers.stop()
+
+
+class HashRing:
+    """
+    Консистентное хеширование chat_id на узлы. У каждого узла много виртуальных
+    точек на кольце, поэтому чаты распределяются ровно, а при изменении числа
+    шардов переезжает только ~1/N чатов.
+    """
+
+    def __init__(self, nodes, vnodes: int = 100):
+        self._ring = sorted((self._hash(f"{node}#{i}"), node) for node in nodes for i in range(vnodes))
+        self._points = [point for point, _ in self._ring]
+
+    @staticmethod
+    def _hash(value) -> int:
+        return int.from_bytes(hashlib.md5(str(value).encode()).digest()[:8], "big")
+
+    def node_for(self, key) -> str:
+        index = bisect.bisect(self._points, self._hash(key)) % len(self._points)
+        return self._ring[index][1]
+
+
+class ShardRouter:
+    """
+    Координатор: запускает процессы-шарды (этот же скрипт с SHARD_SOCKET)
+    и пересылает им апдейты JSON-строками через локальные сокеты.
+    Апдейты одного чата всегда идут в один шард и сохраняют порядок.
+    """
+
+    def __init__(self, shards: int, socket_dir: str):
+        self.nodes = [f"shard{i}" for i in range(shards)]
+        self.ring = HashRing(self.nodes, SHARD_VNODES)
+        self.socket_dir = socket_dir
+        self.routed = {node: 0 for node in self.nodes}
+        self._processes = {}  # node -> asyncio.subprocess.Process
+        self._writers = {}  # node -> asyncio.StreamWriter
+        self._watchers = []
+        self._stopping = False
+
+    def _socket_path(self, node: str) -> str:
+        return os.path.join(self.socket_dir, f"{node}.sock")
+
+    def _shard_env(self, index: int, node: str) -> dict:
+        base, ext = os.path.splitext(REPORTED_LOG_FILE)
+        snapshot_base, snapshot_ext = os.path.splitext(SNAPSHOT_FILE)
+        return {
+            **os.environ,
+            "SHARD_WORKERS": "0",
+            "SHARD_SOCKET": self._socket_path(node),
+            "STATE_BACKEND": "socket",
+            "STATE_SOCKET": STATE_SOCKET,
+            "BOT_MODE": "polling",
+            "METRICS_PORT": str(METRICS_PORT + 1 + index) if METRICS_PORT else "0",
+            # Каждый шард ротирует свой журнал жалоб и пишет свой снимок состояния
+            "REPORTED_LOG_FILE": f"{base}.{node}{ext}",
+            "SNAPSHOT_FILE": f"{snapshot_base}.{node}{snapshot_ext}" if SNAPSHOT_FILE else ""
+        }
+
+    async def _spawn(self, index: int, node: str):
+        path = self._socket_path(node)
+        if os.path.exists(path):
+            os.unlink(path)
+        self._processes[node] = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__), env=self._shard_env(index, node)
+        )
+        # Ждём, пока шард поднимет сокет
+        for _ in range(300):
+            try:
+                _, self._writers[node] = await asyncio.open_unix_connection(path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                await asyncio.sleep(0.1)
+        else:
+            raise RuntimeError(f"Шард {node} не запустился")
+        logger.info(f"🧩 Шард {node} запущен (pid {self._processes[node].pid})")
+
+    async def _watch(self, index: int, node: str):
+        """Перезапускает упавший шард"""
+        while not self._stopping:
+            code = await self._processes[node].wait()
+            if self._stopping:
+                return
+            logger.error(f"❌ Шард {node} завершился с кодом {code} - перезапуск")
+            self._writers.pop(node, None)
+            try:
+                await self._spawn(index, node)
+            except Exception as e:
+                logger.error(f"❌ Не удалось перезапустить шард {node}: {e}")
+                await asyncio.sleep(5)
+
+    async def start(self):
+        os.makedirs(self.socket_dir, exist_ok=True)
+        await asyncio.gather(*(self._spawn(i, node) for i, node in enumerate(self.nodes)))
+        self._watchers = [asyncio.create_task(self._watch(i, node)) for i, node in enumerate(self.nodes)]
+
+    async def route(self, update: types.Update):
+        node = self.ring.node_for(update_chat_id(update))
+        writer = self._writers.get(node)
+        if writer is None:
+            logger.error(f"❌ Шард {node} недоступен, апдейт {update.update_id} потерян")
+            return
+        writer.write(update.model_dump_json(exclude_unset=True).encode('utf-8') + b"\n")
+        await writer.drain()
+        self.routed[node] += 1
+
+    async def stop(self):
+        """Закрывает сокеты (шард дорабатывает принятые апдейты и выходит) и ждёт процессы"""
+        self._stopping = True
+        for task in self._watchers:
+            task.cancel()
+        for writer in self._writers.values():
+            writer.close()
+        for node, process in self._processes.items():
+            try:
+                await asyncio.wait_for(process.wait(), 30)
+            except asyncio.TimeoutError:
+                logger.warning(f"⚠️ Шард {node} не завершился вовремя - останавливаю")
+                process.terminate()
+                await process.wait()
+
+
+shard_router = ShardRouter(SHARD_WORKERS, SHARD_SOCKET_DIR) if SHARD_WORKERS > 0 else None
+
+
+async def poll_to_shards():
+    """Long polling в координаторе: апдейты не обрабатываются здесь, а раздаются шардам"""
+    await bot.delete_webhook()
+    allowed_updates = dp.resolve_used_update_types()
+    offset = None
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed_updates, request_timeout=40)
+        except Exception as e:
+            logger.error(f"❌ Ошибка getUpdates: {e}")
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            offset = update.update_id + 1
+            await shard_router.route(update)
+
+
+async def run_shard():
+    """Процесс-шард: принимает апдейты от координатора и обрабатывает их как обычно"""
+    webhook_workers.start()
+    closed = asyncio.Event()
+
+    async def handle_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            async for line in reader:
+                await webhook_workers.put(types.Update.model_validate_json(line, context={"bot": bot}))
+        finally:
+            writer.close()
+            closed.set()
+
+    server = await asyncio.start_unix_server(handle_connection, path=SHARD_SOCKET, limit=2 ** 22)
+    logger.info(f"🧩 Шард слушает {SHARD_SOCKET}")
+    try:
+        await closed.wait()
+    finally:
+        server.close()
+        await webhook_workers.stop()
+        await state_backend.close()
+
+
+metrics.gauge("report_bot_verdict_cache_hits_total", "Попадания в кэш вердиктов", lambda: verdict_cache.hits, "counter")
+metrics.gauge("report_bot_verdict_cache_misses_total", "Промахи кэша вердиктов", lambda: verdict_cache.misses, "counter")
+metrics.gauge("report_bot_verdict_cache_size", "Записей в кэше вердиктов", lambda: verdict_cache.stats()['size'])
+metrics.gauge("report_bot_log_queue_depth", "Записи логов, ожидающие записи на диск", log_queue_depth)
+metrics.gauge("report_bot_webhook_queue_depth", "Апдейты в очередях webhook-воркеров", lambda: webhook_workers.queue_depth())
+metrics.gauge("report_bot_llm_batch_pending", "Проверки, ожидающие пакетной отправки", lambda: len(llm_batcher._pending))
+metrics.gauge("report_bot_inflight_reports", "Идущие проверки /rep", lambda: len(inflight_reports))
+metrics.gauge("report_bot_background_queue_depth", "Фоновые задачи в очереди", lambda: background_jobs.queue_depth())
+metrics.gauge("report_bot_message_cache_size", "Сообщений в истории чатов", lambda: len(message_cache))
+metrics.gauge("report_bot_flood_messages_total", "Сообщения, прошедшие через индекс повторов", lambda: flood_index.messages, "counter")
+metrics.gauge("report_bot_flood_auto_mutes_total", "Автоматические MUTE за флуд", lambda: flood_index.auto_mutes, "counter")
+metrics.gauge("report_bot_message_cache_bytes", "Примерный размер истории чатов в памяти", lambda: message_cache.nbytes)
+if snapshot is not None:
+    metrics.gauge("report_bot_snapshot_rows_total", "Строки, записанные в снимок состояния", lambda: snapshot.stats['rows'], "counter")
+    metrics.gauge("report_bot_snapshot_errors_total", "Ошибки записи снимка состояния", lambda: snapshot.stats['errors'], "counter")
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+
+async def start_metrics_server():
+    """Локальный HTTP-сервер с /metrics; возвращает runner для остановки"""
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    logger.info(f"📈 Метрики: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return runner
+
+
 async def main():
     logger.info("="*50)
     logger.info("🤖 Report бот запущен...")
     logger.info("="*50)
-    await dp.start_polling(bot)
+    get_http_client()
+    if state_backend is local_state:
+        verdict_cache.load()
+    # Сохранённое состояние подгружается в фоне, приём апдейтов его не ждёт
+    snapshot_task = asyncio.create_task(snapshot.run()) if snapshot is not None else None
+    sweeper = asyncio.create_task(sweep_state())
+    background_jobs.start()
+    if AUTOMOD_ENABLED and shard_router is None:
+        automod.start()
+    metrics_runner = await start_metrics_server() if METRICS_PORT else None
+    state_server = None
+    try:
+        if shard_router is not None:
+            # Координатор: общее состояние и раздача апдейтов шардам
+            state_server = StateServer(local_state, STATE_SOCKET)
+            await state_server.start()
+            await shard_router.start()
+            logger.info(f"🧩 Координатор: {SHARD_WORKERS} шардов, чатов в конфиге {len(CHAT_ADMINS)}")
+            if BOT_MODE == "webhook":
+                await run_webhook()
+            else:
+                await poll_to_shards()
+        elif SHARD_SOCKET:
+            await run_shard()
+        elif BOT_MODE == "webhook":
+            await run_webhook()
+        else:
+            await bot.delete_webhook()
+            await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+    finally:
+        sweeper.cancel()
+        automod.stop()
+        # Доделываем начатое: хендлеры, отложенные задачи, затем фоновая очередь
+        if not await active_handlers.drain(SHUTDOWN_DRAIN_TIMEOUT):
+            logger.warning(f"⚠️ Хендлеры не завершились за {SHUTDOWN_DRAIN_TIMEOUT:.0f}с: {active_handlers.count}")
+        if detached_tasks:
+            await asyncio.wait(set(detached_tasks), timeout=SHUTDOWN_DRAIN_TIMEOUT)
+        await background_jobs.stop()
+        if shard_router is not None:
+            await shard_router.stop()
+        if state_server is not None:
+            await state_server.stop()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        if state_backend is local_state:
+            verdict_cache.save()
+        if snapshot is not None:
+            snapshot_task.cancel()
+            await snapshot.close()
+        await close_http_client()
 
 if __name__ == "__main__":
     asyncio.run(main())
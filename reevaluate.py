@@ -0,0 +1,199 @@
+"""
+Офлайн-перепроверка журнала жалоб текущим промптом/моделью.
+
+Читает reported_messages.log (старый текстовый формат) или reported_messages.jsonl
+потоково, прогоняет каждую запись через get_verdict с ограниченной параллельностью
+и пишет в отчёт (JSON Lines) только записи, где изменились действие или длительность.
+Прогресс сохраняется в <отчёт>.checkpoint, так что прерванный прогон продолжается
+с того же места. Кэш вердиктов прогона - отдельный, <отчёт>.cache: файлы работающего
+бота не читаются и не перезаписываются.
+
+Записи JSONL хранят контекст, с которым выносился исходный вердикт, и перепроверяются
+с ним же. В старом текстовом журнале (и в JSONL до появления поля context) контекста
+нет: такие записи проверяются только по самому сообщению, и их вердикты сравнимы
+с исходными лишь приблизительно (в отчёте у них "context": false).
+
+Запуск:
+  python reevaluate.py reported_messages.log -o reeval.jsonl
+  python reevaluate.py reported_messages.jsonl -o reeval.jsonl --concurrency 8
+  python reevaluate.py old.log -o dry.jsonl --openrouter-url http://127.0.0.1:8081/api/v1/chat/completions
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import re
+import sys
+from collections import Counter
+
+# Старый формат: "2025-01-01 12:00:00,123 - MUTE | Пользователь: Имя (123) | Сообщение: ... | Причина: ... | От кого: ..."
+LEGACY_LINE_RE = re.compile(
+    r"^(?P<ts>\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d+) - (?P<label>[A-Z]+) \| Пользователь: (?P<user>.*?) \((?P<user_id>-?\d+)\)"
+    r" \| Сообщение: (?P<text>.*) \| Причина: (?P<reason>.*?) \| От кого: (?P<reporter>.*)$",
+    re.DOTALL
+)
+LEGACY_START_RE = re.compile(r"^\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d+ - ")
+LABEL_ACTIONS = {"MUTE": "MUTE", "REPORTED": "BAN", "WARN": "WARN"}
+
+
+def parse_legacy(lines):
+    """Текстовый журнал; строки без метки времени - продолжение многострочного сообщения"""
+    buffer = None
+    for line in lines:
+        line = line.rstrip("\n")
+        if LEGACY_START_RE.match(line):
+            if buffer is not None:
+                yield buffer
+            buffer = line
+        elif buffer is not None:
+            buffer += "\n" + line
+    if buffer is not None:
+        yield buffer
+
+
+def legacy_entry(raw: str):
+    match = LEGACY_LINE_RE.match(raw)
+    if match is None:
+        return None
+    entry = match.groupdict()
+    entry['user_id'] = int(entry['user_id'])
+    entry['action'] = LABEL_ACTIONS.get(entry['label'], entry['label'])
+    entry['duration'] = None  # в старом формате длительность не записывалась
+    return entry
+
+
+def read_entries(path: str):
+    """Потоково отдаёт записи журнала любого из двух форматов"""
+    with open(path, encoding='utf-8') as f:
+        first = f.readline()
+        f.seek(0)
+        if first.lstrip().startswith("{"):
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    entry.setdefault('action', LABEL_ACTIONS.get(entry.get('label'), entry.get('label')))
+                    yield entry
+        else:
+            for raw in parse_legacy(f):
+                entry = legacy_entry(raw)
+                if entry is not None:
+                    yield entry
+
+
+def load_checkpoint(path: str) -> int:
+    if not os.path.exists(path):
+        return 0
+    with open(path, encoding='utf-8') as f:
+        return json.load(f).get('processed', 0)
+
+
+def save_checkpoint(path: str, processed: int):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'processed': processed}, f)
+    os.replace(tmp_path, path)
+
+
+async def reevaluate(entry: dict, semaphore: asyncio.Semaphore, bot_report) -> dict:
+    async with semaphore:
+        text = entry.get('text') or ""
+        context = entry.get('context')
+        if context is not None:
+            context_messages = [bot_report.MessageRecord(*row) for row in entry.get('context_messages') or ()]
+        else:
+            context = f"Сообщение от {entry.get('user', 'unknown')}: {text}"
+            context_messages = ()
+        result = await bot_report.get_verdict(text, context, context_messages, entry.get('user_id'))
+    new_action = result.get("action", "ERROR")
+    new_duration = result.get("duration")
+    changed = new_action != "ERROR" and (
+        new_action != entry.get('action')
+        or (entry.get('duration') is not None and new_duration != entry.get('duration'))
+    )
+    return {
+        'ts': entry.get('ts'),
+        'user_id': entry.get('user_id'),
+        'text': text,
+        'old_action': entry.get('action'),
+        'old_duration': entry.get('duration'),
+        'new_action': new_action,
+        'new_duration': new_duration,
+        'new_reason': result.get("reason", ""),
+        'context': entry.get('context') is not None,
+        'changed': changed
+    }
+
+
+def summarize(report_path: str, processed: int):
+    transitions = Counter()
+    errors = 0
+    with open(report_path, encoding='utf-8') as f:
+        for line in f:
+            item = json.loads(line)
+            if item['new_action'] == "ERROR":
+                errors += 1
+            else:
+                transitions[(item['old_action'], item['new_action'])] += 1
+    print(f"\nПроверено записей: {processed}")
+    print(f"Изменилось: {sum(transitions.values())}, ошибок ИИ: {errors}")
+    for (old, new), count in transitions.most_common():
+        print(f"  {old} -> {new}: {count}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("log", help="reported_messages.log или reported_messages.jsonl")
+    parser.add_argument("-o", "--output", default="reeval.jsonl", help="отчёт с изменившимися вердиктами")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--chunk", type=int, default=200, help="записей между сохранениями прогресса")
+    parser.add_argument("--openrouter-url", help="другой эндпоинт (например локальная заглушка для пробного прогона)")
+    parser.add_argument("--restart", action="store_true", help="начать заново, игнорируя checkpoint")
+    args = parser.parse_args()
+
+    if args.openrouter_url:
+        os.environ["OPENROUTER_URL"] = args.openrouter_url
+    # Telegram здесь не нужен, но Bot создаётся при импорте и проверяет формат токена
+    os.environ.setdefault("BOT_TOKEN_REPORT", "123456:reevaluate")
+    # Не трогать сохранённое состояние и кэш вердиктов работающего бота: у прогона свой кэш рядом с отчётом
+    os.environ["SNAPSHOT_FILE"] = ""
+    cache_path = f"{args.output}.cache"
+    os.environ["VERDICT_CACHE_FILE"] = cache_path
+    import bot_report
+
+    checkpoint_path = f"{args.output}.checkpoint"
+    if args.restart:
+        for path in (checkpoint_path, cache_path, args.output):
+            if os.path.exists(path):
+                os.remove(path)
+    processed = load_checkpoint(checkpoint_path)
+    if processed:
+        bot_report.logger.info(f"⏩ Продолжаю с записи {processed}")
+
+    bot_report.verdict_cache.load()
+    semaphore = asyncio.Semaphore(args.concurrency)
+    entries = itertools.islice(read_entries(args.log), processed, None)
+    try:
+        with open(args.output, 'a', encoding='utf-8') as report:
+            while True:
+                chunk = list(itertools.islice(entries, args.chunk))
+                if not chunk:
+                    break
+                results = await asyncio.gather(*(reevaluate(entry, semaphore, bot_report) for entry in chunk))
+                for item in results:
+                    if item['changed'] or item['new_action'] == "ERROR":
+                        report.write(json.dumps(item, ensure_ascii=False) + "\n")
+                report.flush()
+                processed += len(chunk)
+                save_checkpoint(checkpoint_path, processed)
+                bot_report.verdict_cache.save()
+                print(f"\r⏳ Проверено: {processed}", end="", file=sys.stderr)
+    finally:
+        await bot_report.close_http_client()
+        await bot_report.bot.session.close()
+
+    summarize(args.output, processed)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())